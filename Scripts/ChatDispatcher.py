@@ -0,0 +1,110 @@
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+
+
+class ChatDispatcher:
+    def __init__(self, max_workers=8, max_queue=5, on_busy=None):
+        """
+        Диспетчер обновлений: разные чаты обрабатываются параллельно,
+        сообщения одного чата - строго по порядку.
+
+        :param max_workers: Размер пула рабочих потоков
+        :param max_queue: Максимум ожидающих сообщений на один чат
+        :param on_busy: Функция on_busy(chat_id), вызываемая при переполнении очереди чата
+        """
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="chat")
+        self.max_queue = max_queue
+        self.on_busy = on_busy
+        self.lock = threading.Lock()
+        self.queues = {}  # chat_id -> deque[(время постановки, функция, args, kwargs)]
+        self.active = set()  # чаты, для которых задача уже находится в пуле
+        self.processed = 0
+        self.rejected = 0
+        self.waits = deque(maxlen=1000)  # последние времена ожидания в очереди (сек)
+        self.last_activity = time.monotonic()  # когда закончилась последняя задача
+
+    def submit(self, chat_id, function, *args, **kwargs):
+        """Ставит задачу в очередь чата. Возвращает False, если очередь переполнена."""
+        with self.lock:
+            queue = self.queues.setdefault(chat_id, deque())
+            if len(queue) >= self.max_queue:
+                self.rejected += 1
+                accepted = False
+            else:
+                queue.append((time.monotonic(), function, args, kwargs))
+                accepted = True
+                schedule = chat_id not in self.active
+                if schedule:
+                    self.active.add(chat_id)
+
+        if not accepted:
+            if self.on_busy is not None:
+                self.on_busy(chat_id)
+            return False
+
+        if schedule:
+            self.executor.submit(self._run_next, chat_id)
+        return True
+
+    def _run_next(self, chat_id):
+        with self.lock:
+            enqueued_at, function, args, kwargs = self.queues[chat_id].popleft()
+            self.waits.append(time.monotonic() - enqueued_at)
+
+        try:
+            function(*args, **kwargs)
+        except Exception as e:
+            print(f"Ошибка обработки сообщения: {e}")
+
+        with self.lock:
+            self.processed += 1
+            if self.queues[chat_id]:
+                # Следующее сообщение чата встает в конец общей очереди пула,
+                # чтобы активный чат не занимал поток в ущерб остальным
+                self.executor.submit(self._run_next, chat_id)
+            else:
+                del self.queues[chat_id]
+                self.active.discard(chat_id)
+            self.last_activity = time.monotonic()
+
+    def handler(self, function):
+        """Декоратор для обработчиков telebot: переносит вызов в очередь чата."""
+        @wraps(function)
+        def wrapper(update):
+            # Message хранит чат напрямую, CallbackQuery - в исходном сообщении
+            message = getattr(update, 'message', None) or update
+            self.submit(message.chat.id, function, update)
+        return wrapper
+
+    def idle_seconds(self):
+        """Сколько секунд диспетчер простаивает; 0, пока есть задачи в очередях или в работе."""
+        with self.lock:
+            if self.active:
+                return 0.0
+            return time.monotonic() - self.last_activity
+
+    def metrics(self):
+        with self.lock:
+            waits = sorted(self.waits)
+            queued = sum(len(queue) for queue in self.queues.values())
+            in_progress = len(self.active)
+
+        def percentile(p):
+            return waits[min(len(waits) - 1, int(len(waits) * p))] if waits else 0.0
+
+        return {
+            "processed": self.processed,
+            "rejected": self.rejected,
+            "queued": queued,
+            "active_chats": in_progress,
+            "wait_avg": sum(waits) / len(waits) if waits else 0.0,
+            "wait_p50": percentile(0.5),
+            "wait_p95": percentile(0.95),
+            "wait_max": waits[-1] if waits else 0.0
+        }
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,169 @@
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+
+def estimate_tokens(text):
+    """Грубая оценка числа токенов: ~4 байта UTF-8 на токен (кириллица - ~2 символа)."""
+    if not text:
+        return 0
+    return len(text.encode('utf-8')) // 4 + 1
+
+
+class ContextBuilder:
+    def __init__(self, db, token_budget=3072, tokenizer=estimate_tokens, cache_size=10000,
+                 prefix_stable=False, window_keep=0.5, memory=None):
+        """
+        Собирает контекст для /api/chat по бюджету токенов, а не по числу сообщений.
+
+        :param db: ChatDatabase
+        :param token_budget: Сколько токенов может занять весь список сообщений
+        :param tokenizer: Функция text -> число токенов; можно подставить точный токенизатор модели
+        :param cache_size: Сколько подсчетов для сообщений базы держать в памяти
+        :param prefix_stable: Режим для кэша промпта на сервере Ollama: окно истории только
+            дополняется новыми сообщениями, а его начало сдвигается редко и крупным шагом
+        :param window_keep: Какую долю бюджета оставить после сдвига начала окна
+        :param memory: SemanticMemory - вспоминать старые сообщения, не вошедшие в окно
+            (под них резервируется memory.token_budget)
+        """
+        self.db = db
+        self.token_budget = token_budget
+        self.tokenizer = tokenizer
+        self.cache_size = cache_size
+        # Один ContextBuilder обычно разделяют несколько чатов из разных потоков
+        self.lock = threading.Lock()
+        self.message_tokens = OrderedDict()  # message_id -> число токенов
+        # Системные промпты повторяются от запроса к запросу - кэшируем по тексту
+        self.count_text = lru_cache(maxsize=256)(tokenizer)
+        self.prefix_stable = prefix_stable
+        self.window_keep = window_keep
+        self.window_start = {}  # chat_id -> message_id первого сообщения окна
+        self.memory = memory
+
+    def count_message(self, message_id, content):
+        with self.lock:
+            tokens = self.message_tokens.get(message_id)
+            if tokens is not None:
+                self.message_tokens.move_to_end(message_id)
+                return tokens
+
+        tokens = self.tokenizer(content)
+        with self.lock:
+            self.message_tokens[message_id] = tokens
+            if len(self.message_tokens) > self.cache_size:
+                self.message_tokens.popitem(last=False)
+        return tokens
+
+    def build(self, chat_id, system_prompt=None, limit=None, token_budget=None, recall=True):
+        """
+        Возвращает сообщения для Ollama API: закрепленные системный промпт и последнее
+        сжатое резюме, затем сообщения от новых к старым, пока хватает бюджета.
+        Самое новое сообщение включается всегда, даже если оно одно больше бюджета.
+
+        :param limit: Необязательное ограничение на число сообщений истории
+        :param recall: Добавлять воспоминания memory; False - когда последнее сообщение служебное
+            (например, промежуточный шаг агента), и искать по нему нечего
+        """
+        budget = self.token_budget if token_budget is None else token_budget
+
+        pinned = []
+        if system_prompt:
+            pinned.append({"role": "system", "content": system_prompt})
+
+        summary = self.db.get_latest_summary(chat_id)
+        after_id = 0
+        if summary:
+            content, after_id = summary
+            pinned.append({"role": "system", "content": content})
+
+        remaining = budget - sum(self.count_text(message["content"]) for message in pinned)
+        # Резерв под воспоминания постоянный, чтобы граница окна не зависела от их размера
+        memory_budget = self.memory.token_budget if self.memory is not None else 0
+        remaining -= memory_budget
+
+        if self.prefix_stable:
+            rows = self._stable_window(chat_id, after_id, remaining)
+        else:
+            rows = []
+            for message_id, role, content, _ in self.db.iter_chat_history(chat_id, after_id=after_id):
+                if limit is not None and len(rows) >= limit:
+                    break
+                tokens = self.count_message(message_id, content)
+                if rows and tokens > remaining:
+                    break
+                remaining -= tokens
+                rows.append((message_id, role, content))
+
+        history = [{"role": "user" if role == "user" else "assistant", "content": content}
+                   for _, role, content in reversed(rows)]
+        recalled = self._recall(chat_id, rows, memory_budget) if recall else None
+        if recalled:
+            # Перед последним сообщением: меняющийся от хода к ходу блок не сдвигает начало промпта
+            history.insert(len(history) - 1, recalled)
+        return pinned + history
+
+    def _recall(self, chat_id, rows, budget):
+        """Системное сообщение со старыми сообщениями, похожими на последний вопрос, или None."""
+        if self.memory is None or not rows:
+            return None
+        message_id, role, content = rows[0]
+        if role != 'user':
+            return None
+
+        hits = self.memory.recall(chat_id, message_id, content, before_id=rows[-1][0])
+        messages = self.db.get_messages(hit_id for _, hit_id in hits)
+        header = self.memory.HEADER
+        used = self.count_text(header)
+        lines = []
+        for _, hit_id in hits:
+            if hit_id not in messages:
+                continue
+            hit_role, hit_content, timestamp = messages[hit_id]
+            line = f"[{timestamp}] {hit_role}: {hit_content}"
+            tokens = self.tokenizer(line)
+            if used + tokens > budget:
+                continue
+            lines.append((hit_id, line))
+            used += tokens
+
+        if not lines:
+            return None
+        # В промпте воспоминания идут в хронологическом порядке
+        lines.sort()
+        return {"role": "system", "content": "\n".join([header] + [line for _, line in lines])}
+
+    def _stable_window(self, chat_id, after_id, remaining):
+        """
+        Окно истории с неподвижным началом: пока оно помещается в бюджет, промпт
+        каждого следующего хода начинается байт в байт как предыдущий. При переполнении
+        начало сдвигается так, чтобы осталась доля window_keep бюджета.
+        Ограничение limit в этом режиме не применяется: оно сдвигало бы окно каждый ход.
+        """
+        key = str(chat_id)
+        start = max(self.window_start.get(key, 0), after_id + 1)
+
+        rows = []
+        total = 0
+        overflow = False
+        for message_id, role, content, _ in self.db.iter_chat_history(chat_id, after_id=start - 1):
+            tokens = self.count_message(message_id, content)
+            rows.append((message_id, role, content, tokens))
+            total += tokens
+            if total > remaining:
+                overflow = True
+                break
+
+        if overflow:
+            keep = remaining * self.window_keep
+            kept = []
+            size = 0
+            for row in rows:
+                if kept and size + row[3] > keep:
+                    break
+                kept.append(row)
+                size += row[3]
+            rows = kept
+
+        if rows:
+            self.window_start[key] = rows[-1][0]
+        return [row[:3] for row in rows]
@@ -2,15 +2,24 @@ from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 
 class EnglishTeacher:
-    def __init__(self, chat_manager):
+    EXERCISE_TYPES = ['grammar', 'vocabulary', 'translation']
+    EXERCISE_SYSTEM_PROMPT = "You are an English teacher creating learning exercises."
+
+    def __init__(self, chat_manager, pool=None, user_id=None):
+        """
+        :param pool: ExercisePool - готовые упражнения выдаются из него без ожидания генерации
+        :param user_id: Пользователь, для которого пул запоминает выданные упражнения
+        """
         self.chat_manager = chat_manager
+        self.pool = pool
+        self.user_id = user_id
         self.modes = {
             'chat': "Свободный чат на английском",
             'correction': "Исправления ошибок",
             'exercises': "Упражнения"
         }
         self.current_mode = None
-        self.exercise_types = ['grammar', 'vocabulary', 'translation']
+        self.exercise_types = list(self.EXERCISE_TYPES)
         self.current_exercise = None
         self.user_level = 'beginner'  # Можно определить через тест
 
@@ -32,8 +41,9 @@ class EnglishTeacher:
             ))
         return keyboard
 
-    def generate_exercise(self, ex_type):
-        prompt = f"""
+    @staticmethod
+    def exercise_prompt(ex_type, user_level):
+        return f"""
             You are an AI that generates English language learning exercises.
 
             Follow these instructions carefully:
@@ -41,7 +51,7 @@ class EnglishTeacher:
             1. **EXERCISE TYPE**: {ex_type}  
                - Example types: Fill-in-the-blanks, Multiple Choice, Sentence Building, Error Correction, Reading Comprehension, Dialogue Completion, etc.
             
-            2. **LEVEL**: {self.user_level}  
+            2. **LEVEL**: {user_level}  
                - The level is based on the CEFR (Common European Framework of Reference for Languages), e.g., A1, A2, B1, B2, C1, C2. Tailor the vocabulary, grammar, and complexity to this level.
             
             3. Always write your answer in **English**.
@@ -62,23 +72,62 @@ class EnglishTeacher:
             
             Now generate an exercise with:
             - **EXERCISE TYPE**: {ex_type}  
-            - **LEVEL**: {self.user_level}
+            - **LEVEL**: {user_level}
         """
 
+    @classmethod
+    def exercise_messages(cls, ex_type, user_level):
+        """Запрос упражнения без истории чата - так упражнения генерирует ExercisePool."""
+        return [{"role": "system", "content": cls.EXERCISE_SYSTEM_PROMPT},
+                {"role": "user", "content": cls.exercise_prompt(ex_type, user_level)}]
+
+    def generate_exercise(self, ex_type, stream=False):
+        prompt = self.exercise_prompt(ex_type, self.user_level)
+
+        if self.pool is not None:
+            content = self.pool.take(self.user_id, ex_type, self.user_level)
+            if content is not None:
+                # Готовое упражнение записывается в чат так же, как сгенерированное в нем
+                self.chat_manager.record_exchange(prompt, content)
+                self._set_exercise(ex_type, content)
+                return iter((content,)) if stream else content
+
         response = self.chat_manager.send_message(
             prompt,
-            system_prompt="You are an English teacher creating learning exercises.",
-            chat_id=self.chat_manager.current_chat_id
+            system_prompt=self.EXERCISE_SYSTEM_PROMPT,
+            chat_id=self.chat_manager.current_chat_id,
+            stream=stream
         )
 
+        if stream:
+            return self._stream_exercise(ex_type, response)
+        self._set_exercise(ex_type, ''.join(response))
+        self._share_exercise(ex_type)
+        return self.current_exercise['content']
+
+    def _stream_exercise(self, ex_type, chunks):
+        # Упражнение запоминается, когда поток ответа прочитан до конца
+        content = ""
+        for chunk in chunks:
+            content += chunk
+            yield chunk
+        self._set_exercise(ex_type, content)
+        self._share_exercise(ex_type)
+
+    def _share_exercise(self, ex_type):
+        # Сгенерированное вживую упражнение пополняет пул для других пользователей
+        content = self.current_exercise['content'].strip()
+        if self.pool is not None and content:
+            self.pool.add(ex_type, self.user_level, content, seen_by=self.user_id)
+
+    def _set_exercise(self, ex_type, content):
         self.current_exercise = {
             'type': ex_type,
-            'content': ''.join(response),
+            'content': content,
             'answered': False
         }
-        return self.current_exercise['content']
 
-    def correct_text(self, text):
+    def correct_text(self, text, stream=False):
         prompt = f"""
             **Task:** Please correct the English text and explain all detected errors in detail.
             
@@ -114,13 +163,17 @@ class EnglishTeacher:
             prompt,
             system_prompt="You are an English teacher correcting student's work.",
             chat_id=self.chat_manager.current_chat_id,
-            temperature=0.4
+            temperature=0.4,
+            stream=stream
         )
 
-    def simple_converse(self, message):
+    def simple_converse(self, message, stream=False):
         answer = self.chat_manager.send_message(
             message.text,
             chat_id=self.chat_manager.current_chat_id,
-            system_prompt="You are an English teacher. Respond in English, correct mistakes when you see them."
+            system_prompt="You are an English teacher. Respond in English, correct mistakes when you see them.",
+            stream=stream
         )
+        if stream:
+            return answer
         return ''.join(answer) if hasattr(answer, '__iter__') else str(answer)
\ No newline at end of file
@@ -0,0 +1,119 @@
+import sys
+import threading
+from itertools import product
+from Scripts.EnglishTeacher import EnglishTeacher
+
+
+class ExercisePool:
+    def __init__(self, chat, exercise_types=None, levels=("beginner",), depth=3, max_per_key=100,
+                 idle=None, poll_interval=5.0, temperature=0.9, log=None):
+        """
+        Пул заранее сгенерированных упражнений по ключу (ex_type, user_level), хранится в
+        ChatDatabase. Фоновый поток дополняет пул, пока бот простаивает, а кнопка упражнения
+        получает готовое упражнение сразу, без ожидания генерации.
+
+        :param chat: OllamaChat для генерации (его база хранит пул)
+        :param exercise_types: Типы упражнений (по умолчанию - как у EnglishTeacher)
+        :param levels: Уровни, для которых пул заполняется сразу; остальные - после первого запроса
+        :param depth: Сколько ни разу не выданных упражнений держать для каждого ключа
+        :param max_per_key: Сколько упражнений ключа хранить всего
+        :param idle: Функция без аргументов: True, если сейчас можно занимать модель
+            (например, диспетчер простаивает). Генерация прерывается, как только она вернет False,
+            и потом начинается заново, а не продолжается: если пауз дольше порога idle нет совсем,
+            пул не пополняется, и упражнения генерируются по запросу, как без пула
+        :param poll_interval: Как часто проверять пул (сек)
+        :param log: Куда писать ошибки фонового потока (по умолчанию - sys.stderr); в боте -
+            только в консоль, у этого потока нет чата Telegram
+        """
+        self.chat = chat
+        self.db = chat.db
+        self.depth = depth
+        self.max_per_key = max_per_key
+        self.idle = idle or (lambda: True)
+        self.poll_interval = poll_interval
+        self.temperature = temperature
+        self.log = log or sys.stderr.write
+        self.lock = threading.Lock()
+        self.keys = set(product(exercise_types or EnglishTeacher.EXERCISE_TYPES, levels))
+        self.wakeup = threading.Event()
+        self.stopped = False
+        self.worker = None
+        self.generated = 0
+        self.interrupted = 0
+
+    def start(self):
+        self.worker = threading.Thread(target=self._run, name="exercise-pool", daemon=True)
+        self.worker.start()
+        return self
+
+    def take(self, user_id, ex_type, user_level):
+        """Упражнение, которое пользователь еще не видел, или None, если такого в пуле нет."""
+        key = (ex_type, user_level)
+        with self.lock:
+            if key not in self.keys:
+                self.keys.add(key)
+        content = self.db.take_exercise(user_id, ex_type, user_level)
+        # Выданное или недостающее упражнение нужно заменить
+        self.wakeup.set()
+        return content
+
+    def add(self, ex_type, user_level, content, seen_by=None):
+        """Добавляет упражнение, сгенерированное вне пула, чтобы его получили и другие пользователи."""
+        self.db.add_exercise(ex_type, user_level, content, seen_by=seen_by, max_per_key=self.max_per_key)
+
+    def _next_key(self):
+        fresh = self.db.count_fresh_exercises()
+        with self.lock:
+            keys = sorted(self.keys)
+        # Первым дополняется самый опустевший ключ
+        key = min(keys, key=lambda key: fresh.get(key, 0), default=None)
+        if key is None or fresh.get(key, 0) >= self.depth:
+            return None
+        return key
+
+    def _run(self):
+        while not self.stopped:
+            self.wakeup.wait(self.poll_interval)
+            self.wakeup.clear()
+            # Пул пополняется только в простое: интерактивные запросы не ждут фоновую генерацию
+            while not self.stopped and self.idle():
+                key = self._next_key()
+                if key is None:
+                    break
+                try:
+                    content = self.generate(*key)
+                except Exception as e:
+                    self.log(f"Ошибка генерации упражнения: {e}\n")
+                    self.wakeup.wait(60)
+                    break
+                if content is None:
+                    break
+                self.db.add_exercise(*key, content, max_per_key=self.max_per_key)
+                self.generated += 1
+
+    def generate(self, ex_type, user_level):
+        """Генерирует упражнение потоком; если бот перестал простаивать, прерывает генерацию и возвращает None."""
+        chunks = self.chat.complete(EnglishTeacher.exercise_messages(ex_type, user_level),
+                                    temperature=self.temperature, stream=True)
+        parts = []
+        try:
+            for chunk in chunks:
+                if self.stopped or not self.idle():
+                    self.interrupted += 1
+                    return None
+                parts.append(chunk)
+        finally:
+            # Закрытое соединение останавливает генерацию на сервере
+            chunks.close()
+        content = "".join(parts).strip()
+        return content or None
+
+    def stats(self):
+        fresh = self.db.count_fresh_exercises()
+        return {"fresh": sum(fresh.values()), "generated": self.generated, "interrupted": self.interrupted}
+
+    def shutdown(self, timeout=10):
+        self.stopped = True
+        self.wakeup.set()
+        if self.worker is not None:
+            self.worker.join(timeout)
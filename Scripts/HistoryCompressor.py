@@ -0,0 +1,138 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class HistoryCompressor:
+    SYSTEM_PROMPT = """
+Ты — ассистент, который превращает переписку в связный и сжатый конспект.
+
+Формат вывода:
+Наша история чата выглядит следующим образом...
+[Краткий связный текст на русском]
+
+Требования:
+• Преобразуй диалог в связный рассказ  
+• Сохрани:
+  – Главные вопросы и решения  
+  – Технические детали (код, ошибки, команды)  
+  – Изменения контекста  
+  - Информацию о пользователе
+• Удали:  
+  – Повторы  
+  – Приветствия/прощания  
+  – Несущественные уточнения  
+
+Стиль:
+• Четкий, деловой  
+• Используй `обратные кавычки` для кода  
+• Маркеры • для списков  
+• Без интерпретаций и домыслов  
+
+Примечания:
+• Для технических тем — точно сохраняй команды и ошибки  
+• Для творческих — фиксируй ключевые идеи  
+• При потере контекста — добавь [пояснение]
+• Если дано предыдущее резюме — дополни его новыми сообщениями, ничего важного из него не теряя
+
+Пример:
+assistant: Наша история чата выглядит следующим образом...  
+Пользователь спрашивал о Python.  
+• Предложили Pandas для CSV (`pd.read_csv()`)  
+• Обнаружили проблему кодировки — исправили `encoding='utf-8'`
+"""
+
+    def __init__(self, chat, threshold_tokens=2048, segment_tokens=1024, keep_messages=4, lock_stripes=64):
+        """
+        Фоновое инкрементальное сжатие истории: когда горячий контекст чата (резюме и
+        сообщения после него) превышает порог, самый старый отрезок сообщений сворачивается
+        в новое резюме, построенное из предыдущего. Сами сообщения остаются в базе.
+
+        :param chat: OllamaChat, через который вызывается модель и читается база
+        :param threshold_tokens: Размер горячего контекста, после которого запускается сжатие
+        :param segment_tokens: Сколько токенов самых старых сообщений сжимать за один раз
+        :param keep_messages: Сколько последних сообщений никогда не сжимать автоматически
+        :param lock_stripes: Число блокировок, между которыми распределяются чаты: память
+            не растет с числом чатов, а разные чаты редко ждут друг друга
+        """
+        self.chat = chat
+        self.threshold_tokens = threshold_tokens
+        self.segment_tokens = segment_tokens
+        self.keep_messages = keep_messages
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="compress")
+        self.lock = threading.Lock()
+        self.scheduled = set()
+        self.chat_locks = [threading.Lock() for _ in range(lock_stripes)]
+
+    def schedule(self, chat_id):
+        """Ставит проверку чата в фоновую очередь (не более одной на чат)."""
+        with self.lock:
+            if chat_id in self.scheduled:
+                return
+            self.scheduled.add(chat_id)
+        self.executor.submit(self._run, chat_id)
+
+    def _run(self, chat_id):
+        with self.lock:
+            self.scheduled.discard(chat_id)
+        try:
+            # Каждый проход сворачивает один отрезок; повторяем, пока контекст выше порога
+            while self.compress(chat_id):
+                pass
+        except Exception as e:
+            print(f"Ошибка при сжатии истории: {str(e)}")
+
+    def _chat_lock(self, chat_id):
+        return self.chat_locks[hash(str(chat_id)) % len(self.chat_locks)]
+
+    def compress(self, chat_id, force=False):
+        """
+        Сжимает самый старый отрезок горячей истории. При force=True сжимает
+        всю горячую историю независимо от порога. Возвращает True, если резюме создано.
+        """
+        # Ручное и фоновое сжатие одного чата не должны выполняться одновременно
+        with self._chat_lock(chat_id):
+            db = self.chat.db
+            context = self.chat.context
+
+            summary = db.get_latest_summary(chat_id)
+            previous, after_id = summary if summary else (None, 0)
+
+            rows = list(db.iter_chat_history(chat_id, after_id=after_id))
+            rows.reverse()  # от старых к новым
+            if not rows:
+                return False
+
+            tokens = [context.count_message(message_id, content) for message_id, _, content, _ in rows]
+            total = context.count_text(previous) + sum(tokens)
+
+            if force:
+                segment = rows
+            else:
+                if total < self.threshold_tokens or len(rows) <= self.keep_messages:
+                    return False
+                segment = []
+                size = 0
+                for row, row_tokens in zip(rows[:len(rows) - self.keep_messages], tokens):
+                    segment.append(row)
+                    size += row_tokens
+                    if size >= self.segment_tokens:
+                        break
+            if not segment:
+                return False
+
+            dialog = "\n".join(f"{role}: {content}" for _, role, content, _ in segment if content)
+            if previous:
+                request = f"Предыдущее резюме:\n{previous}\n\nНовые сообщения:\n{dialog}"
+            else:
+                request = f"Сообщения:\n{dialog}"
+
+            new_summary = self.chat.complete(
+                [{"role": "system", "content": self.SYSTEM_PROMPT},
+                 {"role": "user", "content": request}],
+                temperature=0.7
+            )
+            db.add_summary(chat_id, new_summary, segment[-1][0])
+            return True
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
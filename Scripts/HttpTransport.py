@@ -0,0 +1,48 @@
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+class HttpTransport:
+    def __init__(self, pool_size=10, connect_timeout=5.0, read_timeout=120.0,
+                 retries=3, backoff_factor=0.5):
+        """
+        Общий HTTP-транспорт: пул keep-alive соединений, таймауты и повторы.
+
+        :param pool_size: Максимум соединений к одному хосту
+        :param connect_timeout: Таймаут установки соединения (сек)
+        :param read_timeout: Таймаут чтения ответа (сек)
+        :param retries: Число повторов при ошибках соединения
+        :param backoff_factor: Множитель экспоненциальной задержки между повторами
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+
+        # Повторяем только ошибки установки соединения: запрос к модели
+        # не идемпотентен, и повтор после отправки дал бы двойную генерацию
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            status=0,
+            other=0,
+            backoff_factor=backoff_factor,
+            allowed_methods=None,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,223 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Границы корзин по умолчанию (секунды) - от миллисекунд до долгой генерации
+TIME_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+COUNT_BUCKETS = (16, 64, 256, 512, 1024, 2048, 4096, 8192)
+
+# Поля итогового ответа Ollama (длительности - в наносекундах)
+OLLAMA_DURATIONS = ("total_duration", "load_duration", "prompt_eval_duration", "eval_duration")
+OLLAMA_COUNTS = ("prompt_eval_count", "eval_count")
+# Замеры клиента, которые OllamaChat складывает в turn (секунды)
+CLIENT_TIMINGS = ("user_write", "history", "build", "ttft", "response")
+
+
+class Histogram:
+    def __init__(self, buckets=TIME_BUCKETS, window=1000):
+        """
+        Гистограмма с накопительными корзинами (для Prometheus) и скользящим
+        окном последних значений (для перцентилей в JSON).
+        """
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # последняя корзина - +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def snapshot(self):
+        recent = sorted(self.recent)
+
+        def percentile(p):
+            return recent[min(len(recent) - 1, int(len(recent) * p))] if recent else 0.0
+
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "avg": sum(recent) / len(recent) if recent else 0.0,
+            "p50": percentile(0.5),
+            "p95": percentile(0.95),
+            "p99": percentile(0.99),
+            "max": recent[-1] if recent else 0.0
+        }
+
+
+class Metrics:
+    def __init__(self, window=1000):
+        """
+        Реестр метрик процесса: гистограммы по имени и меткам, последние ходы
+        модели и сторонние источники (например, ChatDispatcher.metrics).
+
+        :param window: Сколько последних значений хранит каждая гистограмма
+        """
+        self.window = window
+        self.lock = threading.Lock()
+        self.histograms = {}  # (имя, метки) -> Histogram
+        self.turns = deque(maxlen=window)
+        self.collectors = {}  # префикс -> функция, возвращающая словарь чисел
+        self.server = None
+
+    def observe(self, name, value, buckets=TIME_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets, self.window)
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def record_turn(self, turn, model):
+        """Учитывает один ответ модели: счетчики Ollama и замеры клиента из turn."""
+        for key in OLLAMA_DURATIONS:
+            if turn.get(key) is not None:
+                self.observe(f"ollama_{key}_seconds", turn[key] / 1e9, model=model)
+        for key in OLLAMA_COUNTS:
+            if turn.get(key) is not None:
+                self.observe(f"ollama_{key}", turn[key], COUNT_BUCKETS, model=model)
+        if turn.get("eval_count") and turn.get("eval_duration"):
+            self.observe("ollama_tokens_per_second", turn["eval_count"] / turn["eval_duration"] * 1e9,
+                         COUNT_BUCKETS, model=model)
+
+        for key in CLIENT_TIMINGS:
+            if turn.get(key) is not None:
+                self.observe(f"client_{key}_seconds", turn[key], model=model)
+        # Все, что сверх total_duration сервера: сеть, очереди и разбор ответа на клиенте
+        if turn.get("response") is not None and turn.get("total_duration") is not None:
+            self.observe("client_overhead_seconds", max(0.0, turn["response"] - turn["total_duration"] / 1e9),
+                         model=model)
+
+        with self.lock:
+            self.turns.append(dict(turn, model=model))
+
+    def add_collector(self, prefix, function):
+        """Подключает источник мгновенных значений: function() -> {имя: число}."""
+        self.collectors[prefix] = function
+
+    def prompt_cache_report(self, last=20):
+        """
+        Сводка по последним ходам: сколько токенов промпта сервер вычислил заново и за какое время.
+        Попадания в кэш видны по ходам одного чата: если префикс взят из кэша, prompt_eval_count
+        следующего хода близок к числу новых токенов, а не ко всему промпту. Долю кэша не выводим: prompt_tokens -
+        оценка нашего токенизатора, с prompt_eval_count модели ее сравнивать нельзя.
+
+        :param last: Сколько последних ходов вывести по отдельности
+        """
+        with self.lock:
+            turns = [turn for turn in self.turns if turn.get("prompt_eval_count") is not None]
+        if not turns:
+            return {"turns": 0}
+
+        return {
+            "turns": len(turns),
+            "avg_prompt_eval_count": sum(turn["prompt_eval_count"] for turn in turns) / len(turns),
+            "avg_prompt_eval_ms": sum(turn["prompt_eval_duration"] or 0 for turn in turns) / len(turns) / 1e6,
+            "recent": [{"chat_id": turn.get("chat_id"),
+                        "prompt_eval_count": turn["prompt_eval_count"],
+                        "prompt_eval_ms": (turn["prompt_eval_duration"] or 0) / 1e6,
+                        "eval_count": turn.get("eval_count")}
+                       for turn in turns[-last:]]
+        }
+
+    def _gauges(self):
+        gauges = {}
+        for prefix, function in list(self.collectors.items()):
+            try:
+                values = function()
+            except Exception as e:
+                print(f"Ошибка сбора метрик {prefix}: {e}")
+                continue
+            for name, value in values.items():
+                if isinstance(value, (int, float)):
+                    gauges[f"{prefix}_{name}"] = value
+        return gauges
+
+    def to_json(self):
+        with self.lock:
+            histograms = [(name, dict(labels), histogram.snapshot())
+                          for (name, labels), histogram in self.histograms.items()]
+        return {
+            "histograms": [dict(snapshot, name=name, labels=labels) for name, labels, snapshot in histograms],
+            "gauges": self._gauges(),
+            "prompt_cache": self.prompt_cache_report()
+        }
+
+    def to_prometheus(self):
+        lines = []
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            typed = set()
+            for (name, labels), histogram in histograms:
+                if name not in typed:
+                    lines.append(f"# TYPE {name} histogram")
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_labels(labels, le=bound)} {cumulative}")
+                lines.append(f"{name}_sum{_labels(labels)} {histogram.sum}")
+                lines.append(f"{name}_count{_labels(labels)} {histogram.count}")
+
+        for name, value in sorted(self._gauges().items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port=9100, host="127.0.0.1"):
+        """Запускает HTTP-сервер метрик в фоне: /metrics (Prometheus) и /metrics.json."""
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body, content_type = metrics.to_prometheus().encode(), "text/plain; version=0.0.4"
+                elif self.path == "/metrics.json":
+                    body, content_type = json.dumps(metrics.to_json(), ensure_ascii=False).encode(), "application/json"
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+        return self.server
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+
+def _labels(labels, **extra):
+    pairs = list(labels) + list(extra.items())
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in pairs) + "}"
+
+
+# Общий реестр процесса: его используют все OllamaChat, если не передан свой
+metrics = Metrics()
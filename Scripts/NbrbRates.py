@@ -0,0 +1,142 @@
+import threading
+import time
+from array import array
+import requests
+
+NBRB_URL = "https://api.nbrb.by/exrates"
+
+
+class NbrbRates:
+    def __init__(self, transport=None, ttl=3600):
+        """
+        Таблица официальных курсов НБРБ в памяти: вся дневная таблица загружается
+        одним запросом, конвертация любых пар выполняется без сети.
+
+        :param transport: HttpTransport (или requests) для запросов к api.nbrb.by
+        :param ttl: Через сколько секунд таблица загружается заново
+        """
+        self.transport = transport or requests
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # (код -> индекс, курсы за одну единицу валюты в BYN) - подменяется одним присваиванием
+        self.table = ({"BYN": 0}, array('d', [1.0]))
+        self.date = None
+        self.loaded_at = None
+        self.unknown = set()  # коды, которых нет у НБРБ, - не запрашиваем их повторно до обновления
+
+    def refresh(self):
+        """Загружает дневную таблицу курсов; при ошибке остается прежняя."""
+        try:
+            response = self.transport.get(f"{NBRB_URL}/rates?periodicity=0", timeout=10)
+            response.raise_for_status()
+            table = response.json()
+        except requests.RequestException as e:
+            print(f"Ошибка при запросе к API: {e}")
+            return False
+
+        codes = {"BYN": 0}
+        rates = array('d', [1.0])
+        date = None
+        for row in table:
+            # Одна испорченная строка не должна лишать агента всей таблицы
+            try:
+                code, rate = row["Cur_Abbreviation"], row["Cur_OfficialRate"] / row["Cur_Scale"]
+            except (KeyError, TypeError, ZeroDivisionError) as e:
+                print(f"Пропущена строка курсов НБРБ {row!r}: {e!r}")
+                continue
+            codes[code] = len(rates)
+            rates.append(rate)
+            date = date or row.get("Date")
+
+        # Новая таблица подменяет старую целиком: читатели видят либо одну, либо другую
+        self.table = (codes, rates)
+        self.unknown = set()
+        self.date = date
+        self.loaded_at = time.monotonic()
+        return True
+
+    def _stale(self):
+        return self.loaded_at is None or time.monotonic() - self.loaded_at >= self.ttl
+
+    def _ensure_fresh(self):
+        if not self._stale():
+            return
+        with self.lock:
+            # Пока ждали блокировку, таблицу мог обновить другой поток
+            if self._stale():
+                if not self.refresh():
+                    # Не повторяем неудачный запрос на каждом вызове
+                    self.loaded_at = time.monotonic() - self.ttl + 60
+
+    def _fetch_one(self, code):
+        # Валюты с ежемесячным курсом в дневную таблицу не входят - запрашиваем отдельно
+        try:
+            response = self.transport.get(f"{NBRB_URL}/rates/{code}?parammode=2", timeout=10)
+            if response.status_code == 404:
+                raise KeyError(code)
+            response.raise_for_status()
+            data = response.json()
+            rate = data["Cur_OfficialRate"] / data["Cur_Scale"]
+        except requests.RequestException as e:
+            print(f"Ошибка при запросе к API: {e}")
+            return None
+        except KeyError:
+            print(f"Валюта {code} не найдена или API изменилось.")
+            self.unknown.add(code)
+            return None
+        except (TypeError, ZeroDivisionError) as e:
+            print(f"Некорректный курс {code} в ответе API: {e!r}")
+            return None
+
+        with self.lock:
+            codes, rates = self.table
+            if code not in codes:
+                # Новая пара вместо дописывания на месте: читатель без блокировки
+                # не увидит код, для которого в массиве еще нет курса
+                codes = dict(codes)
+                codes[code] = len(rates)
+                self.table = (codes, rates + array('d', [rate]))
+        return rate
+
+    def _lookup(self, codes):
+        """Возвращает таблицу (codes, rates), в которой есть все известные НБРБ валюты из codes."""
+        self._ensure_fresh()
+        missing = {code for code in codes if code not in self.table[0] and code not in self.unknown}
+        for code in missing:
+            self._fetch_one(code)
+        return self.table
+
+    def rate(self, code):
+        """Курс одной единицы валюты в BYN или None."""
+        code = code.strip().upper()
+        codes, rates = self._lookup([code])
+        index = codes.get(code)
+        return rates[index] if index is not None else None
+
+    def convert(self, from_currency, to_currency, amount=1):
+        return self.convert_batch([(from_currency, to_currency, amount)])[0]
+
+    def convert_batch(self, conversions):
+        """
+        Конвертирует пачку (from_currency, to_currency, amount) по одной таблице курсов
+        одним векторным выражением numpy. Для неизвестной валюты результат - None.
+        """
+        # numpy загружается при первой конвертации, а не при импорте агента
+        import numpy as np
+
+        conversions = [(from_currency.strip().upper(), to_currency.strip().upper(), amount)
+                       for from_currency, to_currency, amount in conversions]
+        codes, rates = self._lookup({code for conversion in conversions for code in conversion[:2]})
+
+        count = len(conversions)
+        # -1 - неизвестная валюта; массив курсов читается без копирования
+        source = np.fromiter((codes.get(from_currency, -1) for from_currency, _, _ in conversions),
+                             dtype=np.intp, count=count)
+        target = np.fromiter((codes.get(to_currency, -1) for _, to_currency, _ in conversions),
+                             dtype=np.intp, count=count)
+        amounts = np.fromiter((amount for _, _, amount in conversions), dtype=np.float64, count=count)
+        values = np.frombuffer(rates, dtype=np.float64)
+
+        known = (source >= 0) & (target >= 0)
+        results = np.round(amounts * values[np.where(known, source, 0)] / values[np.where(known, target, 0)], 4)
+        return [float(result) if ok else None for result, ok in zip(results.tolist(), known.tolist())]
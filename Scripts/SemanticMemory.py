@@ -0,0 +1,181 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from Scripts.HttpTransport import HttpTransport
+
+
+class SemanticMemory:
+    HEADER = "Фрагменты более ранней переписки, которые могут относиться к вопросу:"
+
+    def __init__(self, db, transport=None, base_url="http://localhost:11434", model="nomic-embed-text",
+                 batch_size=32, top_k=4, min_score=0.35, token_budget=512, max_chats=256, keep_alive=None):
+        """
+        Долговременная память чата: сообщения индексируются эмбеддингами Ollama (/api/embed)
+        в фоне, а перед запросом к модели в контекст добавляются самые похожие на вопрос
+        старые сообщения, не попавшие в окно истории.
+
+        :param db: ChatDatabase - векторы хранятся в message_embeddings (float32 в BLOB)
+        :param transport: HttpTransport для запросов к Ollama
+        :param model: Модель эмбеддингов
+        :param batch_size: Сколько сообщений отправлять в одном запросе при индексации
+        :param top_k: Сколько сообщений вспоминать за ход
+        :param min_score: Минимальное косинусное сходство вспоминаемого сообщения
+        :param token_budget: Сколько токенов контекста отводится под воспоминания
+        :param max_chats: Для скольких чатов держать матрицы векторов в памяти
+        :param keep_alive: Сколько модель эмбеддингов держится в памяти сервера после запроса
+        """
+        self.db = db
+        self._owns_transport = transport is None
+        self.transport = transport or HttpTransport()
+        self.base_url = base_url
+        self.model = model
+        self.batch_size = batch_size
+        self.top_k = top_k
+        self.min_score = min_score
+        self.token_budget = token_budget
+        self.max_chats = max_chats
+        self.keep_alive = keep_alive
+
+        self.lock = threading.Lock()
+        # chat_id -> (message_id: int64[n], нормированные векторы: float32[n, dim])
+        self.indexes = OrderedDict()
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory")
+        self.scheduled = set()
+        self.retry_at = 0.0  # после ошибки сервера эмбеддингов память временно не используется
+
+    def embed(self, texts):
+        """Эмбеддинги texts одним запросом: float32[len(texts), dim], строки нормированы."""
+        # numpy загружается при первом обращении к памяти, а не при запуске бота
+        import numpy as np
+        payload = {"model": self.model, "input": list(texts)}
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        response = self.transport.post(f"{self.base_url}/api/embed", json=payload)
+        if response.status_code != 200:
+            raise Exception(f"Ошибка API: {response.status_code} - {response.text}")
+
+        vectors = np.asarray(response.json()["embeddings"], dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+    def _available(self):
+        return time.monotonic() >= self.retry_at
+
+    def _failed(self, error):
+        # Не повторяем запрос к недоступному серверу на каждом ходе
+        self.retry_at = time.monotonic() + 60
+        print(f"Ошибка семантической памяти: {error}")
+
+    def _index(self, chat_id):
+        """Матрица векторов чата; при первом обращении читается из базы."""
+        import numpy as np
+        key = str(chat_id)
+        with self.lock:
+            index = self.indexes.get(key)
+            if index is not None:
+                self.indexes.move_to_end(key)
+                return index
+
+        rows = self.db.load_embeddings(chat_id, self.model)
+        if rows:
+            ids = np.fromiter((message_id for message_id, _ in rows), dtype=np.int64, count=len(rows))
+            vectors = np.frombuffer(b"".join(vector for _, vector in rows), dtype=np.float32).reshape(len(rows), -1)
+        else:
+            ids, vectors = np.empty(0, dtype=np.int64), None
+
+        with self.lock:
+            # Пока читали базу, другой поток мог уже загрузить и дополнить индекс
+            index = self.indexes.setdefault(key, (ids, vectors))
+            self.indexes.move_to_end(key)
+            while len(self.indexes) > self.max_chats:
+                self.indexes.popitem(last=False)
+        return index
+
+    def _add(self, chat_id, message_ids, vectors):
+        import numpy as np
+        self.db.save_embeddings(chat_id, self.model, [(message_id, vector.tobytes())
+                                                      for message_id, vector in zip(message_ids, vectors)])
+        key = str(chat_id)
+        with self.lock:
+            index = self.indexes.get(key)
+            if index is None:
+                return  # индекс чата не загружен - его прочитают из базы целиком
+            ids, matrix = index
+            known = np.isin(message_ids, ids)
+            if known.all():
+                return
+            new_ids = np.asarray(message_ids, dtype=np.int64)[~known]
+            new_vectors = vectors[~known]
+            # Новая пара массивов подменяет старую: поиск в другом потоке видит либо одну, либо другую
+            self.indexes[key] = (np.concatenate([ids, new_ids]),
+                                 new_vectors if matrix is None else np.vstack([matrix, new_vectors]))
+
+    def schedule(self, chat_id):
+        """Ставит индексацию новых сообщений чата в фоновую очередь (не более одной на чат)."""
+        key = str(chat_id)
+        with self.lock:
+            if key in self.scheduled:
+                return
+            self.scheduled.add(key)
+        self.executor.submit(self._run, chat_id)
+
+    def _run(self, chat_id):
+        with self.lock:
+            self.scheduled.discard(str(chat_id))
+        if not self._available():
+            return
+        try:
+            while self.index_pending(chat_id):
+                pass
+        except Exception as e:
+            self._failed(e)
+
+    def index_pending(self, chat_id):
+        """Индексирует одну пачку еще не проиндексированных сообщений. Возвращает число обработанных."""
+        rows = self.db.get_unembedded_messages(chat_id, self.model, limit=self.batch_size)
+        if not rows:
+            return 0
+        vectors = self.embed([content for _, content in rows])
+        self._add(chat_id, [message_id for message_id, _ in rows], vectors)
+        return len(rows)
+
+    def rebuild(self, chat_id):
+        """Удаляет векторы чата и индексирует его заново в фоне."""
+        self.db.clear_embeddings(chat_id)
+        with self.lock:
+            self.indexes.pop(str(chat_id), None)
+        self.retry_at = 0.0
+        self.schedule(chat_id)
+
+    def recall(self, chat_id, message_id, text, before_id):
+        """
+        Старые сообщения чата (message_id < before_id), похожие на text: [(score, message_id)],
+        лучшие первыми. Вектор самого text сохраняется как эмбеддинг сообщения message_id.
+        """
+        import numpy as np
+        if not text or not self._available():
+            return []
+        try:
+            query = self.embed([text])
+        except Exception as e:
+            self._failed(e)
+            return []
+
+        ids, matrix = self._index(chat_id)
+        self._add(chat_id, [message_id], query)
+        if matrix is None:
+            return []
+
+        # Косинусное сходство со всеми векторами чата одним умножением матрицы на вектор
+        scores = matrix @ query[0]
+        scores[(ids >= before_id) | (scores < self.min_score)] = -np.inf
+        count = min(self.top_k, len(scores))
+        best = np.argpartition(-scores, count - 1)[:count]
+        best = best[np.argsort(-scores[best])]
+        return [(float(scores[i]), int(ids[i])) for i in best if np.isfinite(scores[i])]
+
+    def shutdown(self, wait=True):
+        self.executor.shutdown(wait=wait)
+        if self._owns_transport:
+            self.transport.close()
@@ -0,0 +1,99 @@
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from Scripts.main import ChatManager
+from Scripts.EnglishTeacher import EnglishTeacher
+
+
+class UserSession:
+    def __init__(self, user_id, chat, teacher):
+        self.user_id = user_id
+        self.chat = chat
+        self.teacher = teacher
+        self.last_used = time.monotonic()
+
+
+class SessionRegistry:
+    def __init__(self, db, transport=None, max_sessions=1000, model="llama3.1:latest",
+                 base_url="http://localhost:11434", context=None, compressor=None,
+                 keep_alive=None, exercise_pool=None):
+        """
+        Реестр сессий Telegram-пользователей: у каждого свой чат, режим и упражнение.
+
+        :param db: Общая ChatDatabase, в которой хранятся и сессии
+        :param transport: Общий HttpTransport для всех сессий
+        :param context: Общий ContextBuilder (с его кэшем подсчета токенов)
+        :param compressor: Общий HistoryCompressor для фонового сжатия истории
+        :param keep_alive: Сколько Ollama держит модель загруженной между сообщениями пользователей
+        :param exercise_pool: Общий ExercisePool с готовыми упражнениями
+        :param max_sessions: Сколько сессий держать в памяти; самые давние выгружаются в базу
+        """
+        self.db = db
+        self.transport = transport
+        self.context = context
+        self.compressor = compressor
+        self.keep_alive = keep_alive
+        self.exercise_pool = exercise_pool
+        self.max_sessions = max_sessions
+        self.model = model
+        self.base_url = base_url
+        self.sessions = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, user_id):
+        with self.lock:
+            session = self.sessions.get(user_id)
+            if session is None:
+                session = self._load(user_id)
+                self.sessions[user_id] = session
+                while len(self.sessions) > self.max_sessions:
+                    _, evicted = self.sessions.popitem(last=False)
+                    self.save(evicted)
+            else:
+                self.sessions.move_to_end(user_id)
+
+        session.last_used = time.monotonic()
+        return session
+
+    @contextmanager
+    def use(self, user_id):
+        """Выдает сессию пользователя и сохраняет ее состояние после обработки."""
+        session = self.get(user_id)
+        try:
+            yield session
+        finally:
+            self.save(session)
+
+    def _load(self, user_id):
+        chat = ChatManager(model=self.model, base_url=self.base_url, transport=self.transport, db=self.db,
+                           context=self.context, compressor=self.compressor, keep_alive=self.keep_alive,
+                           user_id=user_id)
+        teacher = EnglishTeacher(chat, pool=self.exercise_pool, user_id=user_id)
+        state = self.db.load_session(user_id)
+
+        if state and chat.find_chat_name(chat_id=state["chat_id"]):
+            chat.current_chat_id = state["chat_id"]
+            teacher.current_mode = state["mode"]
+            teacher.user_level = state["user_level"] or teacher.user_level
+            teacher.current_exercise = state["exercise"]
+        else:
+            chat.start_new_chat(f"Telegram {user_id}")
+
+        return UserSession(user_id, chat, teacher)
+
+    def save(self, session):
+        teacher = session.teacher
+        self.db.save_session(
+            session.user_id,
+            session.chat.current_chat_id,
+            teacher.current_mode,
+            teacher.user_level,
+            teacher.current_exercise
+        )
+
+    def save_all(self):
+        with self.lock:
+            sessions = list(self.sessions.values())
+        for session in sessions:
+            self.save(session)
@@ -1,19 +1,79 @@
+import queue
 import sys
-import telebot
-from API import API_bot
+import threading
+import time
+from contextlib import contextmanager
+from Scripts.TelegramStreamer import TelegramStreamer
+
+# Метка остановки фонового отправителя
+_STOP = object()
 
-API_Bot = API_bot
-bot = telebot.TeleBot(API_Bot)
 
 class TelegramLogger:
-    def __init__(self, bot, chat_id):
+    def __init__(self, bot, chat_id, streamer=None, flush_interval=0.5, max_queue=1000):
+        """
+        Подмена sys.stdout/sys.stderr: вывод пишется в консоль сразу, а в Telegram
+        отправляется фоновым потоком - строки одного чата за flush_interval
+        объединяются в одно сообщение, поэтому print не ждет сети.
+
+        :param bot: telebot.TeleBot
+        :param chat_id: Получатель по умолчанию для потоков, не назначивших свой
+        :param streamer: TelegramStreamer - деление на сообщения по 4096 символов и
+            лимиты Telegram на чат, общие с потоковыми ответами модели. Вывод чата, упершегося
+            в лимит, копится до его восстановления, а остальные чаты отправляются без ожидания
+        :param flush_interval: Сколько секунд копить вывод чата перед отправкой
+        :param max_queue: Максимум неотправленных фрагментов; лишние отбрасываются и подсчитываются
+        """
         self.bot = bot
-        self.chat_id = chat_id
-        self.buffer = ""
+        self.streamer = streamer or TelegramStreamer(bot)
+        self.flush_interval = flush_interval
+        # Получатель и буфер свои у каждого потока: диспетчер обрабатывает чаты параллельно
+        self.local = threading.local()
+        self.default_chat_id = chat_id
         # Сохраняем оригинальный stdout для консольного вывода
         self.console_out = sys.stdout
         self.console_err = sys.stderr
 
+        self.queue = queue.Queue(maxsize=max_queue)
+        self.lock = threading.Lock()
+        self.dropped = {}  # chat_id -> число отброшенных фрагментов, еще не сообщенное в чат
+        self.dropped_total = 0
+        self.sent = 0
+        self.errors = 0
+        self.sender = threading.Thread(target=self._run, name="telegram-log", daemon=True)
+        self.sender.start()
+
+    @property
+    def chat_id(self):
+        return getattr(self.local, 'chat_id', self.default_chat_id)
+
+    @chat_id.setter
+    def chat_id(self, value):
+        self.local.chat_id = value
+
+    @property
+    def buffer(self):
+        # Незавершенная строка потока; части копятся в списке и склеиваются один раз
+        if not hasattr(self.local, 'buffer'):
+            self.local.buffer = []
+        return self.local.buffer
+
+    @contextmanager
+    def route(self, chat_id):
+        """Временно направляет вывод текущего потока в chat_id."""
+        routed = hasattr(self.local, 'chat_id')
+        previous = self.chat_id
+        self.chat_id = chat_id
+        try:
+            yield
+        finally:
+            self._enqueue(self.chat_id, self._take_buffer())
+            # Поток без своего получателя снова пишет получателю по умолчанию
+            if routed:
+                self.chat_id = previous
+            else:
+                del self.local.chat_id
+
     def write_console(self, message):
         if not isinstance(message, str):
             message = str(message)
@@ -23,29 +83,108 @@ class TelegramLogger:
         # Выводим в консоль
         self.console_out.write(message)
 
-        # Добавляем сообщение в буфер для Telegram
-        self.buffer += message
-
-        # Если есть перевод строки - отправляем сообщение
-        if '\n' in message:
-            self.flush()
+        # В Telegram уходят только завершенные строки, остаток ждет следующей записи
+        newline = message.rfind('\n')
+        if newline < 0:
+            self.buffer.append(message)
+            return
+        buffer = self.buffer
+        buffer.append(message[:newline + 1])
+        text = "".join(buffer)
+        buffer.clear()
+        if newline + 1 < len(message):
+            buffer.append(message[newline + 1:])
+        self._enqueue(self.chat_id, text)
 
     def flush(self):
         # Сохраняем flush для консоли
         self.console_out.flush()
+        self._enqueue(self.chat_id, self._take_buffer())
+
+    def _take_buffer(self):
+        text = "".join(self.buffer)
+        self.buffer.clear()
+        return text
 
-        # Отправляем в Telegram
-        if self.buffer.strip():
+    def _enqueue(self, chat_id, text):
+        if chat_id is None or not text.strip():
+            return
+        try:
+            self.queue.put_nowait((chat_id, text))
+        except queue.Full:
+            # Лог не должен тормозить обработку сообщений: при заторе вывод теряется, но учитывается
+            with self.lock:
+                self.dropped[chat_id] = self.dropped.get(chat_id, 0) + 1
+                self.dropped_total += 1
+
+    def _run(self):
+        pending = {}  # chat_id -> (срок отправки, [фрагменты])
+        running = True
+        while running or pending:
+            timeout = None
+            if pending:
+                timeout = max(0.0, min(deadline for deadline, _ in pending.values()) - time.monotonic())
             try:
-                # Отправляем содержимое буфера
-                self.bot.send_message(self.chat_id, self.buffer)
-            except Exception as e:
-                # Если ошибка - выводим в консоль
-                self.console_out.write(f"Ошибка отправки лога: {e}\n")
-            finally:
-                self.buffer = ""
+                item = self.queue.get(timeout=timeout) if running else None
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                running = False
+            elif item is not None:
+                chat_id, text = item
+                entry = pending.get(chat_id)
+                if entry is None:
+                    entry = pending[chat_id] = (time.monotonic() + self.flush_interval, [])
+                entry[1].append(text)
+
+            now = time.monotonic()
+            for chat_id in [chat_id for chat_id, (deadline, _) in pending.items()
+                            if deadline <= now or not running]:
+                # При остановке оставшийся вывод отправляется с ожиданием лимитов
+                rest = self._send(chat_id, "".join(pending.pop(chat_id)[1]), block=not running)
+                if rest:
+                    # Чат ограничен Telegram: остаток и новый вывод ждут его очереди, другие чаты - нет
+                    pending[chat_id] = (self.streamer.ready_at(chat_id), [rest])
+
+    def _send(self, chat_id, text, block=False):
+        """Отправляет text; без block возвращает остаток, который не удалось отправить из-за лимитов чата."""
+        with self.lock:
+            dropped = self.dropped.pop(chat_id, 0)
+        if dropped:
+            text = f"[пропущено фрагментов лога: {dropped}]\n{text}"
+        try:
+            if block:
+                self.streamer.send(chat_id, text)
+                rest = ""
+            else:
+                rest = self.streamer.try_send(chat_id, text)
+        except Exception as e:
+            # Ошибки отправки - только в консоль, иначе они снова попадут в очередь
+            with self.lock:
+                self.errors += 1
+            self.console_out.write(f"Ошибка отправки лога: {e}\n")
+            return ""
+        if not rest:
+            with self.lock:
+                self.sent += 1
+        return rest
+
+    def stats(self):
+        with self.lock:
+            return {"queued": self.queue.qsize(), "sent": self.sent, "dropped": self.dropped_total,
+                    "errors": self.errors}
+
+    def close(self, timeout=10):
+        """Отправляет накопленный вывод и останавливает фоновый поток."""
+        self.flush()
+        if self.sender.is_alive():
+            # Метка ставится с ожиданием: при полной очереди ее освободит отправитель
+            self.queue.put(_STOP)
+            self.sender.join(timeout)
 
     # Восстанавливаем потоки при завершении
     def cleanup(self):
         sys.stdout = self.console_out
-        sys.stderr = self.console_err
\ No newline at end of file
+        sys.stderr = self.console_err
+        self.close()
@@ -0,0 +1,174 @@
+import threading
+import time
+from telebot.apihelper import ApiTelegramException
+
+# Ограничение Telegram на длину текста одного сообщения (в единицах UTF-16)
+MAX_MESSAGE_LENGTH = 4096
+
+
+def utf16_length(text):
+    """Длина текста так, как ее считает Telegram: эмодзи и другие символы вне BMP занимают две единицы."""
+    return len(text.encode('utf-16-le')) // 2
+
+
+def _utf16_prefix(text, max_length):
+    """Сколько первых символов text укладывается в max_length единиц UTF-16."""
+    count = min(len(text), max_length)
+    while True:
+        excess = utf16_length(text[:count]) - max_length
+        if excess <= 0:
+            return count
+        # Символ занимает одну или две единицы: отбрасываем по половине превышения, пока префикс не уложится
+        count -= (excess + 1) // 2
+
+
+def split_text(text, max_length=MAX_MESSAGE_LENGTH):
+    """Делит текст на части не длиннее max_length (UTF-16), по возможности по переводу строки или пробелу."""
+    parts = []
+    while utf16_length(text) > max_length:
+        limit = max(1, _utf16_prefix(text, max_length))
+        cut = text.rfind('\n', 0, limit)
+        if cut < limit // 2:
+            cut = text.rfind(' ', 0, limit)
+        if cut < limit // 2:
+            cut = limit
+        parts.append(text[:cut])
+        text = text[cut:].lstrip('\n')
+    parts.append(text)
+    return parts
+
+
+class TelegramStreamer:
+    def __init__(self, bot, placeholder="⏳", edit_interval=1.0, max_length=MAX_MESSAGE_LENGTH):
+        """
+        Доставка потокового ответа модели в Telegram: сначала отправляется заглушка,
+        затем накопленный текст подставляется в нее через edit_message_text.
+
+        :param bot: telebot.TeleBot
+        :param placeholder: Текст заглушки до первого фрагмента ответа
+        :param edit_interval: Минимальный интервал между запросами к одному чату (сек) -
+            Telegram допускает около одного сообщения или правки в секунду на чат
+        :param max_length: Длина (в единицах UTF-16), после которой ответ продолжается в новом сообщении
+        """
+        self.bot = bot
+        self.placeholder = placeholder
+        self.edit_interval = edit_interval
+        self.max_length = max_length
+        self.lock = threading.Lock()
+        self.next_allowed = {}  # chat_id -> время, раньше которого запросы к чату не шлем
+
+    def _wait_turn(self, chat_id, block):
+        # Возвращает False, если бюджет чата еще не восстановился, а ждать не нужно
+        with self.lock:
+            delay = self.next_allowed.get(chat_id, 0) - time.monotonic()
+            if delay > 0 and not block:
+                return False
+        if delay > 0:
+            time.sleep(delay)
+        with self.lock:
+            self.next_allowed[chat_id] = time.monotonic() + self.edit_interval
+        return True
+
+    def _call(self, chat_id, function, *args, block=True, **kwargs):
+        """Запрос к Bot API с учетом бюджета чата. Промежуточные правки (block=False) можно пропускать."""
+        while True:
+            if not self._wait_turn(chat_id, block):
+                return None
+            try:
+                return function(*args, **kwargs)
+            except ApiTelegramException as e:
+                if e.error_code == 429:
+                    retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+                    with self.lock:
+                        self.next_allowed[chat_id] = time.monotonic() + retry_after
+                    if block:
+                        continue
+                    return None
+                if 'message is not modified' in e.description:
+                    return None
+                raise
+
+    def send(self, chat_id, text, **kwargs):
+        """Обычная отправка длинного текста: делится на сообщения по max_length."""
+        for part in split_text(text or self.placeholder, self.max_length):
+            self._call(chat_id, self.bot.send_message, chat_id, part, **kwargs)
+
+    def try_send(self, chat_id, text, **kwargs):
+        """
+        Отправка без ожидания: если бюджет чата еще не восстановился или Telegram ответил 429,
+        возвращает неотправленный остаток text (пустая строка - отправлено все).
+        Когда чат снова доступен, показывает ready_at.
+        """
+        parts = split_text(text or self.placeholder, self.max_length)
+        for index, part in enumerate(parts):
+            if self._call(chat_id, self.bot.send_message, chat_id, part, block=False, **kwargs) is None:
+                return "\n".join(parts[index:])
+        return ""
+
+    def ready_at(self, chat_id):
+        """Время (time.monotonic), раньше которого запросы к чату не отправляются."""
+        with self.lock:
+            return self.next_allowed.get(chat_id, 0.0)
+
+    def stream(self, chat_id, chunks):
+        """
+        Показывает поток фрагментов chunks по мере поступления и возвращает весь текст.
+        Правки объединяют все фрагменты, пришедшие с прошлой правки; при переполнении
+        сообщения оно фиксируется, и ответ продолжается в новом. Если chunks бросает
+        исключение, вместо заглушки показывается сообщение об ошибке, а исключение пробрасывается.
+        """
+        message = self._call(chat_id, self.bot.send_message, chat_id, self.placeholder)
+        full_text = ""
+        text = ""  # текст текущего сообщения
+        shown = self.placeholder
+
+        try:
+            for chunk in chunks:
+                full_text += chunk
+                text += chunk
+
+                while utf16_length(text) > self.max_length:
+                    head, text = self._split_head(text)
+                    if message is None:
+                        self._call(chat_id, self.bot.send_message, chat_id, head)
+                    else:
+                        self._call(chat_id, self.bot.edit_message_text, head, chat_id, message.message_id)
+                    # Следующее сообщение создается, когда для него появится текст
+                    message = None
+                    shown = ""
+
+                if not text.strip() or text == shown:
+                    continue
+                if message is None:
+                    message = self._call(chat_id, self.bot.send_message, chat_id, text)
+                    shown = text
+                elif self._call(chat_id, self.bot.edit_message_text, text, chat_id, message.message_id,
+                                block=False) is not None:
+                    shown = text
+        except Exception as e:
+            # Заглушка "⏳" не должна висеть вечно: пользователь видит, что ответ оборвался
+            self._show_error(chat_id, message, text, e)
+            raise
+
+        # Финальная правка обязательна: в ней остаток, не попавший в промежуточные
+        if text.strip() and text != shown:
+            if message is None:
+                self._call(chat_id, self.bot.send_message, chat_id, text)
+            else:
+                self._call(chat_id, self.bot.edit_message_text, text, chat_id, message.message_id)
+        elif not full_text.strip():
+            self._call(chat_id, self.bot.edit_message_text, "…", chat_id, message.message_id)
+        return full_text
+
+    def _show_error(self, chat_id, message, text, error):
+        notice = f"[ответ прерван из-за ошибки: {error}]"
+        text = f"{text.rstrip()}\n\n{notice}" if text.strip() else notice
+        if message is not None:
+            head, text = self._split_head(text)
+            self._call(chat_id, self.bot.edit_message_text, head, chat_id, message.message_id)
+        if text:
+            self.send(chat_id, text)
+
+    def _split_head(self, text):
+        parts = split_text(text, self.max_length)
+        return parts[0], text[len(parts[0]):].lstrip('\n')
@@ -0,0 +1,155 @@
+import inspect
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from functools import wraps
+
+
+def normalize_args(rounding=None, upper=()):
+    """
+    Нормализация аргументов инструмента перед поиском в кэше, например
+    normalize_args(rounding={"latitude": 2}, upper=("currency_code",)).
+    Функция вызывается уже с нормализованными аргументами.
+    """
+    rounding = rounding or {}
+
+    def normalize(arguments):
+        for name, digits in rounding.items():
+            if isinstance(arguments.get(name), (int, float)):
+                arguments[name] = round(float(arguments[name]), digits)
+        for name in upper:
+            if isinstance(arguments.get(name), str):
+                arguments[name] = arguments[name].strip().upper()
+        return arguments
+
+    return normalize
+
+
+def cacheable(result):
+    # Ошибки не кэшируются: инструменты сообщают о них через None или {"error": ...}
+    return result is not None and not (isinstance(result, dict) and "error" in result)
+
+
+class ToolCache:
+    def __init__(self, max_entries=1024, db=None):
+        """
+        Кэш результатов инструментов с TTL: LRU в памяти, необязательная копия
+        в ChatDatabase (таблица tool_cache) и объединение одновременных одинаковых вызовов.
+
+        :param max_entries: Сколько результатов держать в памяти
+        :param db: ChatDatabase для сохранения результатов между перезапусками
+        """
+        self.max_entries = max_entries
+        self.db = db
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # ключ -> (истекает, результат)
+        self.inflight = {}  # ключ -> Future вызова, который уже выполняется
+        self.hits = 0
+        self.misses = 0
+
+    def wrap(self, name, function, ttl, normalize=None, should_cache=cacheable):
+        """
+        Возвращает function с кэшированием результата на ttl секунд.
+
+        :param name: Имя инструмента - часть ключа кэша
+        :param normalize: Функция dict -> dict для аргументов (см. normalize_args)
+        :param should_cache: Какие результаты сохранять
+        """
+        signature = inspect.signature(function)
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(bound.arguments)
+            if normalize is not None:
+                arguments = normalize(arguments)
+            key = f"{name}:{json.dumps(arguments, sort_keys=True, ensure_ascii=False, default=str)}"
+            return self.get_or_call(key, lambda: function(**arguments), ttl, should_cache)
+
+        wrapper.cache = self
+        return wrapper
+
+    def cached(self, ttl, name=None, normalize=None, should_cache=cacheable):
+        """Декоратор: @tool_cache.cached(ttl=3600, normalize=normalize_args(upper=("code",)))."""
+        def decorator(function):
+            return self.wrap(name or function.__qualname__, function, ttl, normalize, should_cache)
+        return decorator
+
+    def get_or_call(self, key, call, ttl, should_cache=cacheable):
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            future = self.inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self.inflight[key] = Future()
+
+        if not owner:
+            # Такой же вызов уже выполняется в другом потоке - ждем его результат
+            with self.lock:
+                self.hits += 1
+            return future.result()
+
+        try:
+            stored = self._load(key, now)
+            if stored is None:
+                with self.lock:
+                    self.misses += 1
+                result = call()
+                if should_cache(result):
+                    self._store(key, result, now + ttl)
+            else:
+                result, expires_at = stored
+                with self.lock:
+                    self.hits += 1
+                    self._remember(key, result, expires_at)
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+
+    def _remember(self, key, result, expires_at):
+        self.entries[key] = (expires_at, result)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def _load(self, key, now):
+        if self.db is None:
+            return None
+        row = self.db.load_tool_result(key, now)
+        if row is None:
+            return None
+        value, expires_at = row
+        return json.loads(value), expires_at
+
+    def _store(self, key, result, expires_at):
+        with self.lock:
+            self._remember(key, result, expires_at)
+        if self.db is None:
+            return
+        try:
+            value = json.dumps(result, ensure_ascii=False)
+        except TypeError:
+            return  # несериализуемые результаты живут только в памяти
+        self.db.save_tool_result(key, value, expires_at)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses}
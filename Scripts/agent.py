@@ -1,54 +1,236 @@
+import hashlib
 import json
 import os
-from googleapiclient.discovery import build
+import queue
+import re
+from html.parser import HTMLParser
 from urllib.parse import urlparse
 import requests
 from typing import Dict, Any, Callable, Optional, List, Union, Generator
-from Scripts.main import OllamaChat
+from types import MappingProxyType
+from Scripts.main import OllamaChat, ChatDatabase
+from Scripts.HttpTransport import HttpTransport
+from Scripts.ContextBuilder import ContextBuilder
+from Scripts.HistoryCompressor import HistoryCompressor
+from Scripts.ToolCache import ToolCache, normalize_args
+from Scripts.NbrbRates import NbrbRates
+import threading
 import time
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from API import Key_google, Search_ID
 
 
+class DiscoveryFileCache:
+    """
+    Файловый кэш discovery-документов для googleapiclient (интерфейс get/set):
+    после первого запуска build() не скачивает описание API заново.
+    """
+
+    def __init__(self, directory=None, ttl=7 * 24 * 3600):
+        self.directory = directory or os.getenv(
+            'GOOGLE_DISCOVERY_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'ollama_chat', 'discovery')
+        )
+        self.ttl = ttl
+
+    def _path(self, url):
+        return os.path.join(self.directory, hashlib.sha256(url.encode()).hexdigest() + '.json')
+
+    def get(self, url):
+        path = self._path(url)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path, encoding='utf-8') as file:
+                return file.read()
+        except OSError:
+            return None
+
+    def set(self, url, content):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Запись через временный файл: параллельный процесс не прочитает половину документа
+            temporary = f"{self._path(url)}.{os.getpid()}.tmp"
+            with open(temporary, 'w', encoding='utf-8') as file:
+                file.write(content)
+            os.replace(temporary, self._path(url))
+        except OSError:
+            pass
+
+
+# Общий кэш результатов инструментов; init_func подключает к нему базу агента
+tool_cache = ToolCache()
+
+
+class _TextExtractor(HTMLParser):
+    """Видимый текст HTML-страницы без скриптов, стилей и разметки."""
+
+    SKIP = {'script', 'style', 'noscript', 'template', 'svg', 'head'}
+
+    def __init__(self):
+        super().__init__()
+        self.parts = []
+        self.skipping = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self.SKIP:
+            self.skipping += 1
+
+    def handle_endtag(self, tag):
+        if tag in self.SKIP and self.skipping:
+            self.skipping -= 1
+
+    def handle_data(self, data):
+        if not self.skipping:
+            self.parts.append(data)
+
+    def text(self):
+        return re.sub(r'\s+', ' ', ' '.join(self.parts)).strip()
+
+
 class GoogleAPISearch:
-    def __init__(self, api_key=None, search_engine_id=None):
+    # Custom Search API отдает не больше 10 результатов за запрос и не дальше 100-го
+    PAGE_SIZE = 10
+    MAX_RESULTS = 100
+    # Таймаут запросов к API и загрузки страниц (сек): зависший запрос не занимает поток инструментов
+    TIMEOUT = 10
+
+    def __init__(self, api_key=None, search_engine_id=None, pool_size=4, cache=None, cache_ttl=3600,
+                 transport=None, api_endpoint=None):
         """
         :param api_key: Ваш API ключ (можно через переменную окружения GOOGLE_API_KEY)
         :param search_engine_id: ID поисковой системы (можно через GOOGLE_SEARCH_ENGINE_ID)
+        :param pool_size: Сколько запросов (страниц выдачи и загрузок сайтов) выполняется параллельно
+        :param cache: ToolCache для результатов поиска (по умолчанию общий tool_cache)
+        :param cache_ttl: Сколько секунд хранить результаты одного запроса
+        :param transport: HttpTransport для загрузки найденных страниц
+        :param api_endpoint: Адрес Custom Search API вместо стандартного (прокси, тестовый сервер)
         """
         self.api_key = api_key or os.getenv('GOOGLE_API_KEY')
         self.search_engine_id = search_engine_id or os.getenv('GOOGLE_SEARCH_ENGINE_ID')
-        self.service = build("customsearch", "v1", developerKey=self.api_key)
-
-    def search(self, query, num_results=1, lang='ru', **kwargs):
-        if not self.api_key or not self.search_engine_id:
-            raise ValueError("Требуется API ключ и ID поисковой системы")
-
+        self.cache = cache or tool_cache
+        self.cache_ttl = cache_ttl
+        self.api_endpoint = api_endpoint
+        self.transport = transport or HttpTransport(pool_size=pool_size)
+        # Клиенты googleapiclient не потокобезопасны: каждый запрос берет свободный из пула.
+        # Все запросы идут через executor, поэтому клиентов создается не больше pool_size
+        self.services = queue.LifoQueue()
+        self.executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="search")
+
+    def _build_service(self):
+        # googleapiclient тяжелый при импорте - загружаем его только при первом поиске
+        import httplib2
+        from googleapiclient.discovery import build
+        client_options = {"api_endpoint": self.api_endpoint} if self.api_endpoint else None
+        return build("customsearch", "v1", developerKey=self.api_key, cache=DiscoveryFileCache(),
+                     client_options=client_options, http=httplib2.Http(timeout=self.TIMEOUT))
+
+    def _search_page(self, query, start, num, lang, kwargs):
+        try:
+            service = self.services.get_nowait()
+        except queue.Empty:
+            service = self._build_service()
         try:
-            res = self.service.cse().list(
+            res = service.cse().list(
                 q=query,
                 cx=self.search_engine_id,
-                num=min(num_results, 10),  # Официальное API ограничивает num <= 10
+                num=num,
+                start=start,
                 hl=lang,
                 **kwargs
             ).execute()
+        finally:
+            self.services.put(service)
 
-            return [{
-                'title': item.get('title', ''),
-                'link': item.get('link', ''),
-                'snippet': item.get('snippet', ''),
-                'domain': urlparse(item.get('link', '')).netloc
-            } for item in res.get('items', [])]
+        return [{
+            'title': item.get('title', ''),
+            'link': item.get('link', ''),
+            'snippet': item.get('snippet', ''),
+            'domain': urlparse(item.get('link', '')).netloc
+        } for item in res.get('items', [])]
 
-        except Exception as e:
-            print(f"Ошибка Google API: {e}")
-            return []
+    def search(self, query, num_results=1, lang='ru', fetch_pages=0, text_tokens=1500, **kwargs):
+        """
+        :param num_results: Сколько результатов вернуть (больше 10 - несколько страниц параллельно)
+        :param fetch_pages: Для скольких первых результатов загрузить текст страницы
+        :param text_tokens: Общий бюджет токенов на тексты загруженных страниц
+        """
+        if not self.api_key or not self.search_engine_id:
+            raise ValueError("Требуется API ключ и ID поисковой системы")
+
+        num_results = max(1, min(num_results, self.MAX_RESULTS))
+        # Одинаковые по смыслу запросы (регистр, лишние пробелы) делят одну запись кэша
+        normalized = ' '.join(query.lower().split())
+        key = "google:" + json.dumps([normalized, lang, num_results, fetch_pages, text_tokens, kwargs],
+                                     sort_keys=True, ensure_ascii=False)
+        return self.cache.get_or_call(
+            key,
+            lambda: self._search(query, num_results, lang, fetch_pages, text_tokens, kwargs),
+            self.cache_ttl,
+            should_cache=bool
+        )
+
+    def _search(self, query, num_results, lang, fetch_pages, text_tokens, kwargs):
+        pages = [(start, min(self.PAGE_SIZE, num_results - start + 1))
+                 for start in range(1, num_results + 1, self.PAGE_SIZE)]
+        futures = [self.executor.submit(self._search_page, query, start, num, lang, kwargs)
+                   for start, num in pages]
+
+        results = []
+        for future in futures:
+            try:
+                items = future.result()
+            except Exception as e:
+                print(f"Ошибка Google API: {e}")
+                break
+            results.extend(items)
+            if len(items) < self.PAGE_SIZE:
+                break  # выдача закончилась раньше
+
+        if fetch_pages and results:
+            top = results[:fetch_pages]
+            budget = max(1, text_tokens // len(top))
+            texts = self.executor.map(lambda item: self._page_text(item['link'], budget), top)
+            for result, text in zip(top, texts):
+                result['text'] = text
+        return results
+
+    def _page_text(self, url, max_tokens):
+        """Текст страницы, обрезанный примерно до max_tokens токенов (та же оценка, что в estimate_tokens)."""
+        try:
+            response = self.transport.get(url, timeout=self.TIMEOUT)
+            response.raise_for_status()
+        except requests.RequestException as e:
+            return f"[не удалось загрузить страницу: {e}]"
+
+        if 'html' not in response.headers.get('Content-Type', 'text/html'):
+            return "[страница не в формате HTML]"
+        extractor = _TextExtractor()
+        extractor.feed(response.text)
+        text = extractor.text()
+
+        limit = max_tokens * 4
+        encoded = text.encode('utf-8')
+        if len(encoded) > limit:
+            text = encoded[:limit].decode('utf-8', errors='ignore').rsplit(' ', 1)[0] + '…'
+        return text
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.transport.close()
 
 
 class AgentFunctions:
+    # Общий HTTP-транспорт инструментов; init_func подменяет его транспортом агента
+    transport: HttpTransport = HttpTransport()
+    # Дневная таблица курсов НБРБ: одна загрузка на все конвертации
+    rates: NbrbRates = NbrbRates(transport)
+    # Поиск Google; создается в init_func, если в API.py заданы ключи
+    google: Optional[GoogleAPISearch] = None
+
     @staticmethod
     def get_weather(latitude: float, longitude: float) -> Dict[str, Any]:
         try:
-            response_weather = requests.get(
+            response_weather = AgentFunctions.transport.get(
                 f"https://api.open-meteo.com/v1/forecast?latitude={latitude}&longitude={longitude}&timezone=auto"
                 f"&current=temperature_2m,wind_speed_10m&hourly=temperature_2m,relative_humidity_2m,wind_speed_10m",
                 timeout=10
@@ -61,51 +243,46 @@ class AgentFunctions:
     @staticmethod
     def get_nbrb_currency_rate(currency_code):
         """Получает курс валюты по отношению к BYN."""
-        try:
-            url = f"https://api.nbrb.by/exrates/rates/{currency_code}?parammode=2"
-            response = requests.get(url)
-            response.raise_for_status()  # Проверка на ошибки HTTP
-
-            data = response.json()
-            rate = data["Cur_OfficialRate"]
-            scale = data["Cur_Scale"]  # Например, для USD scale=1, а для JPY scale=100
-
-            return rate / scale  # Возвращаем курс за 1 единицу валюты
-
-        except requests.exceptions.RequestException as e:
-            print(f"Ошибка при запросе к API: {e}")
-            return None
-        except KeyError:
-            print(f"Валюта {currency_code} не найдена или API изменилось.")
-            return None
+        return AgentFunctions.rates.rate(currency_code)
 
     @staticmethod
     def convert_currency(from_currency: str, to_currency: str, amount: float = 1) -> float or None:
         """Конвертирует сумму из одной валюты в другую."""
-        if from_currency.upper() == "BYN":
-            rate_to = AgentFunctions.get_nbrb_currency_rate(to_currency)
-            if rate_to is None:
-                return None
-            converted_amount = amount / rate_to
-        elif to_currency.upper() == "BYN":
-            rate_from = AgentFunctions.get_nbrb_currency_rate(from_currency)
-            if rate_from is None:
-                return None
-            converted_amount = amount * rate_from
-        else:
-            # Конвертация через BYN (например, USD → EUR)
-            rate_from = AgentFunctions.get_nbrb_currency_rate(from_currency)
-            rate_to = AgentFunctions.get_nbrb_currency_rate(to_currency)
+        return AgentFunctions.rates.convert(from_currency, to_currency, amount)
 
-            if rate_from is None or rate_to is None:
-                return None
+    @staticmethod
+    def convert_many(amount: float, from_currency: str, to_currencies: List[str]) -> Dict[str, Optional[float]]:
+        """Конвертирует сумму сразу в несколько валют по одной таблице курсов."""
+        results = AgentFunctions.rates.convert_batch(
+            [(from_currency, to_currency, amount) for to_currency in to_currencies]
+        )
+        return {to_currency.upper(): result for to_currency, result in zip(to_currencies, results)}
 
-            converted_amount = (amount * rate_from) / rate_to
+    @staticmethod
+    def web_search(query: str, num_results: int = 5, fetch_pages: int = 0) -> List[Dict[str, str]]:
+        """Поиск в интернете через Google Custom Search."""
+        return AgentFunctions.google.search(query, num_results=num_results, fetch_pages=fetch_pages)
 
-        return round(converted_amount, 4)
+    @staticmethod
+    def search_history(agent: "Agent", query: str, limit: int = 5) -> List[Dict[str, Any]]:
+        """
+        Ищет в прошлых разговорах владельца агента; возвращает только фрагменты совпадений,
+        а не сообщения целиком.
+        """
+        hits = agent.search_history(query, limit=max(1, min(int(limit), 20)), everywhere=True)
+        for hit in hits:
+            hit["chat_title"] = agent.find_chat_name(chat_id=hit["chat_id"])
+        return hits
 
 
 def init_func(ai_agent):
+    # Tools share the agent's connection pool, cached results are kept in its database
+    AgentFunctions.transport = ai_agent.transport
+    AgentFunctions.rates.transport = ai_agent.transport
+    tool_cache.db = ai_agent.db
+    if Key_google and Search_ID and AgentFunctions.google is None:
+        AgentFunctions.google = GoogleAPISearch(Key_google, Search_ID, transport=ai_agent.transport)
+
     # Register base tools
     ai_agent.register_tool(
         name="get_weather",
@@ -118,7 +295,10 @@ def init_func(ai_agent):
             },
             "required": ["latitude", "longitude"],
         },
-        function=AgentFunctions.get_weather
+        function=AgentFunctions.get_weather,
+        # Координаты округляются до ~1 км, чтобы соседние запросы попадали в кэш
+        cache_ttl=600,
+        cache_normalize=normalize_args(rounding={"latitude": 2, "longitude": 2})
     )
     ai_agent.register_tool(
         name="convert_currency",
@@ -135,99 +315,483 @@ def init_func(ai_agent):
         },
         function=AgentFunctions.convert_currency
     )
+    ai_agent.register_tool(
+        name="convert_many",
+        description="Convert one amount from a currency into several currencies at once",
+        parameters={
+            "type": "object",
+            "properties": {
+                "amount": {"type": "number", "description": "Amount to convert"},
+                "from_currency": {"type": "string", "description": "Currency code to convert from (e.g., USD)"},
+                "to_currencies": {"type": "array", "items": {"type": "string"},
+                                  "description": "Currency codes to convert to (e.g., [\"BYN\", \"EUR\", \"RUB\"])"}
+            },
+            "required": ["amount", "from_currency", "to_currencies"],
+        },
+        function=AgentFunctions.convert_many
+    )
+    ai_agent.register_tool(
+        name="search_history",
+        description="Full-text search over earlier conversations with the user. Returns the best matching "
+                    "message snippets with chat, role and time; use it to recall what was discussed before.",
+        parameters={
+            "type": "object",
+            "properties": {
+                "query": {"type": "string", "description": "Words to look for"},
+                "limit": {"type": "integer", "description": "Maximum number of snippets (up to 20)", "default": 5}
+            },
+            "required": ["query"],
+        },
+        function=AgentFunctions.search_history,
+        # История у каждого пользователя своя: инструмент получает агента, который его вызвал
+        bind_agent=True
+    )
+    if AgentFunctions.google is not None:
+        ai_agent.register_tool(
+            name="web_search",
+            description="Search the web with Google. Returns titles, links and snippets; "
+                        "with fetch_pages > 0 also the text of the top result pages.",
+            parameters={
+                "type": "object",
+                "properties": {
+                    "query": {"type": "string", "description": "Search query"},
+                    "num_results": {"type": "integer", "description": "Number of results (up to 100)",
+                                    "default": 5},
+                    "fetch_pages": {"type": "integer",
+                                    "description": "How many top results to open and read (0 - snippets only)",
+                                    "default": 0}
+                },
+                "required": ["query"],
+            },
+            function=AgentFunctions.web_search
+        )
 
 
-class Agent(OllamaChat):
-    def __init__(
-            self,
-            model: str = "llama3.1:latest",
-            base_url: str = "http://localhost:11434",
-            system_prompt: str = "You are a helpful AI assistant.",
-            temperature: float = 0.7,
-            verbose: bool = False,
-            tool_call_prefix: str = "TOOL:"
-    ):
-        super().__init__(model=model, base_url=base_url)
-        self.system_prompt = system_prompt
-        self.temperature = temperature
+class ToolCallError(Exception):
+    """A tool call of an agent step failed; carries the call and the original error."""
+
+    def __init__(self, call: Dict[str, Any], error: Exception):
+        super().__init__(f"{call['name']}: {error}")
+        self.call = call
+        self.error = error
+
+
+class ToolRegistry:
+    """Registered tools and the prompt section describing them."""
+
+    def __init__(self, verbose: bool = False, max_workers: int = 8, default_timeout: float = 30.0,
+                 cache: Optional[ToolCache] = None):
+        """
+        :param max_workers: Size of the executor that runs tool calls of one step concurrently
+        :param default_timeout: Seconds a tool call may take unless the tool sets its own timeout
+        :param cache: ToolCache for tools registered with cache_ttl (the shared tool_cache by default)
+        """
         self.verbose = verbose
-        self.tool_call_prefix = tool_call_prefix
+        self.cache = cache or tool_cache
         self.tools: Dict[str, Dict] = {}
-
-    def register_tool(
+        self.frozen = False
+        self._prompts: Dict[str, str] = {}
+        self._schemas: Optional[List[Dict[str, Any]]] = None
+        self.max_workers = max_workers
+        self.default_timeout = default_timeout
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._executor_lock = threading.Lock()
+        self._abandoned: set = set()
+
+    def register(
             self,
             name: str,
             description: str,
             parameters: Dict[str, Any],
-            function: Callable
+            function: Callable,
+            timeout: Optional[float] = None,
+            cache_ttl: Optional[float] = None,
+            cache_normalize: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+            bind_agent: bool = False
     ) -> None:
+        """
+        :param cache_ttl: Cache results of the tool for this many seconds (None - no caching)
+        :param cache_normalize: Argument normalization applied before the cache lookup
+        :param bind_agent: Pass the calling Agent as the first argument, for tools scoped to
+            its conversation or owner (the shared registry itself holds no per-session state)
+        """
+        if self.frozen:
+            raise ValueError("Tool registry is frozen, register tools before sharing it")
 
         if not isinstance(parameters, dict):
             raise ValueError("Parameters must be a valid JSON schema dictionary")
 
+        if bind_agent and cache_ttl is not None:
+            raise ValueError("Tools bound to the agent can't be cached: the cache key ignores the agent")
+
+        if cache_ttl is not None:
+            function = self.cache.wrap(name, function, cache_ttl, cache_normalize)
+
         self.tools[name] = {
             "description": description,
             "parameters": parameters,
-            "function": function
+            "function": function,
+            "timeout": timeout if timeout is not None else self.default_timeout,
+            "bind_agent": bind_agent
         }
 
         if self.verbose:
             print(f"Registered tool: {name}")
 
-    def _generate_tools_prompt(self) -> str:
-        """Generate prompt section describing available tools."""
+    def freeze(self) -> "ToolRegistry":
+        """Make the registry read-only so it can be shared between agents."""
+        self.tools = MappingProxyType(self.tools)
+        self.frozen = True
+        return self
+
+    def prompt(self, tool_call_prefix: str) -> str:
+        """Generate prompt section describing available tools (cached once frozen)."""
+        if tool_call_prefix in self._prompts:
+            return self._prompts[tool_call_prefix]
+
         if not self.tools:
             return ""
 
         tools_prompt = "\n\nAVAILABLE TOOLS:\n"
-        tools_prompt += f"To call a tool, respond with exactly:\n{self.tool_call_prefix} tool_name\n"
+        tools_prompt += f"To call a tool, respond with exactly:\n{tool_call_prefix} tool_name\n"
         tools_prompt += "```json\n{\"arg1\": value1, \"arg2\": value2}\n```\nDON'T ADD ANYTHING EXTRA\n\n"
 
         tools_prompt += "TOOLS:\n"
         for tool_name, tool_info in self.tools.items():
             tools_prompt += f"- {tool_name}: {tool_info['description']}\n"
-            tools_prompt += f"  Parameters: {json.dumps(tool_info['parameters'], indent=2)}\n\n"
+            tools_prompt += f"  Parameters: {json.dumps(tool_info['parameters'], indent=2, sort_keys=True)}\n\n"
 
+        if self.frozen:
+            self._prompts[tool_call_prefix] = tools_prompt
         return tools_prompt
 
-    def _extract_tool_calls(self, response: str) -> List[Dict[str, Any]]:
-        """Extract multiple tool call information from LLM response."""
-        if self.tool_call_prefix not in response:
-            return []
+    def submit(self, fn: Callable, *args: Any) -> Future:
+        # The executor is created on first use and shared by every agent that uses this registry.
+        # Submitting under the lock keeps abandon() from shutting it down between lookup and submit
+        with self._executor_lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="tool")
+            return self._executor.submit(fn, *args)
 
-        tool_calls = []
-        # Split the response by the tool call prefix to find all tool calls
-        parts = response.split(self.tool_call_prefix)[1:]  # Skip the first part (before first prefix)
+    def abandon(self, future) -> None:
+        """
+        Give up on a call that timed out. A running thread can't be stopped, so once half of
+        the workers are stuck on abandoned calls the executor is replaced: new calls get fresh
+        threads, and the stuck ones exit whenever their calls return.
+        """
+        with self._executor_lock:
+            if future.cancel():
+                return
+            self._abandoned = {stuck for stuck in self._abandoned if not stuck.done()}
+            self._abandoned.add(future)
+            if self._executor is not None and len(self._abandoned) >= max(1, self.max_workers // 2):
+                if self.verbose:
+                    print(f"Replacing tool executor: {len(self._abandoned)} calls timed out and still running")
+                self._executor.shutdown(wait=False)
+                self._executor = None
+                self._abandoned = set()
+
+    def shutdown(self) -> None:
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def schemas(self) -> List[Dict[str, Any]]:
+        """Tool definitions in the format of the native /api/chat "tools" field (cached once frozen)."""
+        if self._schemas is not None:
+            return self._schemas
+
+        schemas = [
+            {
+                "type": "function",
+                "function": {
+                    "name": tool_name,
+                    "description": tool_info["description"],
+                    "parameters": tool_info["parameters"]
+                }
+            }
+            for tool_name, tool_info in self.tools.items()
+        ]
+        if self.frozen:
+            self._schemas = schemas
+        return schemas
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.tools
+
+    def __getitem__(self, name: str) -> Dict:
+        return self.tools[name]
+
+    def __len__(self) -> int:
+        return len(self.tools)
+
+    def items(self):
+        return self.tools.items()
+
+
+class ToolCallParser:
+    """
+    Incremental parser for the text tool-call protocol:
+
+        TOOL: tool_name
+        ```json
+        {"arg": "value"}
+        ```
+
+    Chunks of a streamed reply are fed as they arrive. Text before the first tool
+    call is passed through, calls are collected as soon as their JSON object is
+    complete, and ``done`` turns True once prose follows the last complete call,
+    so the caller can stop the generation there.
+    """
+
+    _FENCE = re.compile(r'\s*(?:```(?:json)?\s*)?')
+    _GAP = re.compile(r'(?:\s|```)*')
+
+    def __init__(self, prefix: str = "TOOL:"):
+        self.prefix = prefix
+        self.text = ""
+        self.visible = 0  # how much of text has been returned as prose
+        self.start = -1  # position of the first prefix
+        self.pos = 0  # parse position inside the tool-call zone
+        self.calls: List[Dict[str, Any]] = []
+        self.done = False
+
+    def feed(self, chunk: str) -> str:
+        """Add a chunk and return the prose that became safe to show."""
+        self.text += chunk
+        if self.start < 0:
+            self.start = self.text.find(self.prefix, self.visible)
+            if self.start < 0:
+                # Hold back a tail that may be the beginning of a split prefix
+                end = len(self.text)
+                for size in range(min(len(self.prefix) - 1, end), 0, -1):
+                    if self.prefix.startswith(self.text[-size:]):
+                        end -= size
+                        break
+                return self._release(end)
+            self.pos = self.start
+            visible = self._release(self.start)
+        else:
+            visible = ""
 
-        for part in parts:
+        self._parse()
+        return visible
+
+    def finish(self) -> str:
+        """
+        Complete the parse once the stream has ended and return the text still held back.
+        A tool name at the very end counts as a call without arguments. The caller shows the
+        returned text when the reply turns out to have no known calls: then everything from
+        the first prefix on was prose after all.
+        """
+        if self.start >= 0 and not self.done:
+            self._parse(final=True)
+        return self._release(len(self.text))
+
+    def _release(self, end: int) -> str:
+        visible = self.text[self.visible:end]
+        self.visible = max(self.visible, end)
+        return visible
+
+    def _parse(self, final: bool = False) -> None:
+        """Collect complete calls; with final=True the text will not grow any more."""
+        while not self.done:
+            gap = self._GAP.match(self.text, self.pos).end()
+            rest = self.text[gap:]
+            if not rest.startswith(self.prefix):
+                # Anything but a fence or the start of another call ends the tool-call zone
+                tail = rest.strip().strip("`")
+                if tail and not self.prefix.startswith(tail[:len(self.prefix)]):
+                    self.done = bool(self.calls)
+                return
+
+            call_start = gap + len(self.prefix)
+            line_end = self.text.find("\n", call_start)
+            brace = self.text.find("{", call_start)
+            name_end = min(i for i in (line_end, brace, len(self.text)) if i >= 0)
+            name = self.text[call_start:name_end].strip()
+            if name_end == len(self.text):
+                # The tool name is not complete yet, unless the stream has ended
+                if final and name:
+                    self.calls.append({"name": name, "arguments": {}})
+                return
+
+            fence = self._FENCE.match(self.text, name_end)
+            ahead = self.text[name_end:].lstrip()
+            if fence.end() == len(self.text) or "```json".startswith(ahead):
+                # An opening fence may still follow, unless the stream has ended
+                if final and name:
+                    self.calls.append({"name": name, "arguments": {}})
+                return
+            if self.text[fence.end()] != "{":
+                # A call without arguments
+                self.calls.append({"name": name, "arguments": {}})
+                self.pos = fence.end()
+                continue
+
+            end = self._object_end(fence.end())
+            if end < 0:
+                return  # the JSON object is still streaming
             try:
-                part = part.strip()
-                if not part:
-                    continue
+                arguments = json.loads(self.text[fence.end():end])
+            except json.JSONDecodeError:
+                arguments = None
+            if isinstance(arguments, dict):
+                self.calls.append({"name": name, "arguments": arguments})
+            self.pos = end
+
+    def _object_end(self, start: int) -> int:
+        """Index just past the JSON object starting at start, or -1 if it is incomplete."""
+        depth = 0
+        in_string = escaped = False
+        for index in range(start, len(self.text)):
+            char = self.text[index]
+            if in_string:
+                if escaped:
+                    escaped = False
+                elif char == "\\":
+                    escaped = True
+                elif char == '"':
+                    in_string = False
+            elif char == '"':
+                in_string = True
+            elif char == "{":
+                depth += 1
+            elif char == "}":
+                depth -= 1
+                if depth == 0:
+                    return index + 1
+        return -1
+
+
+class Agent(OllamaChat):
+    # Models that rejected the native "tools" field; "auto" mode uses the text protocol for them
+    text_only_models = set()
+
+    def __init__(
+            self,
+            model: str = "llama3.1:latest",
+            base_url: str = "http://localhost:11434",
+            system_prompt: str = "You are a helpful AI assistant.",
+            temperature: float = 0.7,
+            verbose: bool = False,
+            tool_call_prefix: str = "TOOL:",
+            tools: Optional[ToolRegistry] = None,
+            transport: Optional[HttpTransport] = None,
+            db: Optional[ChatDatabase] = None,
+            chat_id: Optional[int] = None,
+            context: Optional[ContextBuilder] = None,
+            compressor: Optional[HistoryCompressor] = None,
+            keep_alive: Optional[str] = None,
+            tool_mode: str = "auto",
+            user_id: Optional[int] = None
+    ):
+        """
+        :param user_id: Owner of the conversation; tools bound to the agent see only the owner's chats
+        :param tool_mode: "native" passes tool schemas in the /api/chat "tools" field and reads
+            structured tool_calls; "text" describes tools in the system prompt and parses
+            tool_call_prefix lines; "auto" uses native calling unless the model rejects it
+        """
+        if tool_mode not in ("auto", "native", "text"):
+            raise ValueError(f"Unknown tool mode: {tool_mode}")
 
-                # Split tool name and JSON args
-                tool_part, *json_parts = part.split("\n", 1)
-                tool_name = tool_part.strip()
+        super().__init__(model=model, base_url=base_url, transport=transport, db=db, chat_id=chat_id,
+                         context=context, compressor=compressor, keep_alive=keep_alive, user_id=user_id)
+        self.tool_mode = tool_mode
+        self.system_prompt = system_prompt
+        self.temperature = temperature
+        self.verbose = verbose
+        self.tool_call_prefix = tool_call_prefix
+        self.tools = tools if tools is not None else ToolRegistry(verbose=verbose)
 
-                args = {}
-                if json_parts:
-                    args_part = json_parts[0].strip()
-                    try:
-                        args = json.loads(args_part)
-                    except json.JSONDecodeError:
-                        if self.verbose:
-                            print(f"Invalid JSON in tool call: {args_part}")
-                        continue  # Skip this tool call but try others
+    def register_tool(
+            self,
+            name: str,
+            description: str,
+            parameters: Dict[str, Any],
+            function: Callable,
+            timeout: Optional[float] = None,
+            cache_ttl: Optional[float] = None,
+            cache_normalize: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+            bind_agent: bool = False
+    ) -> None:
+        self.tools.register(name, description, parameters, function, timeout, cache_ttl, cache_normalize,
+                            bind_agent)
 
-                if tool_name in self.tools:
-                    tool_calls.append({"name": tool_name, "arguments": args})
+    def _generate_tools_prompt(self) -> str:
+        """Generate prompt section describing available tools."""
+        return self.tools.prompt(self.tool_call_prefix)
 
-            except Exception as e:
-                if self.verbose:
-                    print(f"Error parsing tool call: {e}")
-                continue  # Skip this tool call but try others
+    def _extract_tool_calls(self, response: str) -> List[Dict[str, Any]]:
+        """Extract multiple tool call information from LLM response."""
+        parser = ToolCallParser(self.tool_call_prefix)
+        parser.feed(response)
+        return self._known_calls(parser.calls)
 
-        return tool_calls
+    def _known_calls(self, calls: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        known = [call for call in calls if call["name"] in self.tools]
+        if self.verbose and len(known) < len(calls):
+            print(f"Skipped unknown tools: {[call['name'] for call in calls if call not in known]}")
+        return known
+
+    @staticmethod
+    def _native_calls(turn: Dict[str, Any]) -> List[Dict[str, Any]]:
+        calls = []
+        for tool_call in turn.get("tool_calls", []):
+            function = tool_call.get("function", {})
+            arguments = function.get("arguments") or {}
+            if isinstance(arguments, str):
+                # Some models return arguments as a JSON string
+                try:
+                    arguments = json.loads(arguments)
+                except json.JSONDecodeError:
+                    continue
+            calls.append({"name": function.get("name"), "arguments": arguments})
+        return calls
+
+    def _reply_text(self, assistant_msg: str, turn: Dict[str, Any]) -> str:
+        # Native calls are stored in the text protocol form, so the history reads the same in both modes
+        calls = self._native_calls(turn)
+        if not calls:
+            return assistant_msg
+        rendered = "\n".join(f"{self.tool_call_prefix} {call['name']}\n"
+                             f"{json.dumps(call['arguments'], ensure_ascii=False, sort_keys=True)}"
+                             for call in calls)
+        return f"{assistant_msg}\n{rendered}" if assistant_msg else rendered
+
+    def _use_native_tools(self) -> bool:
+        if not len(self.tools) or self.tool_mode == "text":
+            return False
+        return self.tool_mode == "native" or self.model not in Agent.text_only_models
+
+    def _request_step(self, message: str, chat_id: int, native: bool, recall: bool = True, tools: bool = True):
+        """
+        Send one step of the conversation as a stream; returns (turn, chunk generator).
+        recall=False skips semantic memory for the canned follow-up prompts of tool steps;
+        tools=False sends the step without tool definitions, so the model has to answer.
+        """
+        native = native and tools
+        system_prompt = self.system_prompt
+        if tools and not native:
+            system_prompt += self._generate_tools_prompt()
+        chat_id, payload, turn = self._prepare_request(message, True, chat_id, system_prompt, None, self.temperature,
+                                                       recall=recall)
+        if native:
+            payload["tools"] = self.tools.schemas()
+
+        try:
+            response = self._post_chat(payload, turn)
+        except Exception as e:
+            if not (native and self.tool_mode == "auto" and "does not support tools" in str(e)):
+                raise
+            # The user message is already stored: resend the same prompt in the text protocol
+            Agent.text_only_models.add(self.model)
+            del payload["tools"]
+            payload["messages"][0]["content"] = f"{self.system_prompt}{self._generate_tools_prompt()}"
+            response = self._post_chat(payload, turn)
+
+        return turn, self._stream_response(chat_id, response, turn)
 
     def _call_tool(self, tool_name: str, arguments: Dict[str, Any]) -> Any:
         """Execute a registered tool with provided arguments."""
@@ -238,7 +802,39 @@ class Agent(OllamaChat):
         tool_params = self.tools[tool_name]["parameters"]
         # Add schema validation here if needed
 
-        return self.tools[tool_name]["function"](**arguments)
+        tool = self.tools[tool_name]
+        with self.metrics.timer("client_tool_seconds", tool=tool_name):
+            if tool["bind_agent"]:
+                return tool["function"](self, **arguments)
+            return tool["function"](**arguments)
+
+    def _call_tools(self, tool_calls: List[Dict[str, Any]]) -> List[Any]:
+        """
+        Run the tool calls of one step concurrently and return their results in call order.
+        The first failure (in call order) is raised as ToolCallError; a call that exceeds its
+        tool's timeout fails with TimeoutError and is handed to ToolRegistry.abandon.
+        Native calls are not filtered, so an unknown tool name fails the same way.
+        """
+        for call in tool_calls:
+            if call["name"] not in self.tools:
+                error = ValueError(f"Tool '{call['name']}' not found in registered tools")
+                raise ToolCallError(call, error) from error
+        started = time.monotonic()
+        futures = [self.tools.submit(self._call_tool, call["name"], call["arguments"])
+                   for call in tool_calls]
+
+        results = []
+        for call, future in zip(tool_calls, futures):
+            remaining = started + self.tools[call["name"]]["timeout"] - time.monotonic()
+            try:
+                results.append(future.result(timeout=max(0.0, remaining)))
+            except FutureTimeoutError:
+                self.tools.abandon(future)
+                error = TimeoutError(f"timed out after {self.tools[call['name']]['timeout']}s")
+                raise ToolCallError(call, error) from error
+            except Exception as e:
+                raise ToolCallError(call, e) from e
+        return results
 
     @staticmethod
     def _format_tool_result(tool_name: str, result: Any) -> str:
@@ -253,55 +849,141 @@ class Agent(OllamaChat):
     def chat(
             self,
             message: str,
-            max_attempts: int = 3
-    ):
-        global response
+            max_attempts: int = 3,
+            stream: bool = False
+    ) -> Union[str, Generator[str, None, None]]:
+        """
+        Answer a message, calling tools as the model requests them.
+
+        With stream=True returns a generator of answer chunks; tool-call steps are
+        not shown, and a step is cut off as soon as its tool calls are complete.
+        """
+        steps = self._chat_steps(message, max_attempts)
+        return steps if stream else "".join(steps)
+
+    def _chat_steps(self, message: str, max_attempts: int) -> Generator[str, None, None]:
         attempts = 0
         last_response = message
+        native = self._use_native_tools()
 
         while attempts < max_attempts:
             chat_id = self.current_chat_id
-            # Generate full prompt with tools
-            full_system_prompt = f"{self.system_prompt}{self._generate_tools_prompt()}"
-
-            # Get LLM response
-            response = super().send_message(
-                message=last_response,
-                chat_id=chat_id,
-                stream=False,  # Need complete response for tool parsing
-                system_prompt=full_system_prompt,
-                temperature=self.temperature,
-                limit=attempts * 2 + 5
-            )
-
-            # Check for tool call
-            tool_calls = self._extract_tool_calls(response)
+            turn, chunks = self._request_step(last_response, chat_id, native, recall=attempts == 0)
 
+            parser = ToolCallParser(self.tool_call_prefix)
+            try:
+                for chunk in chunks:
+                    visible = parser.feed(chunk)
+                    if visible:
+                        yield visible
+                    if parser.done:
+                        break
+            finally:
+                # Closing the stream saves the partial reply and stops generation on the server
+                chunks.close()
+
+            held = parser.finish()
+            tool_calls = self._native_calls(turn) or self._known_calls(parser.calls)
             if not tool_calls:
-                return response
+                yield held
+                return
 
-            error_tool = None
-            # Execute tool
+            # Execute tools
             try:
+                with self.metrics.timer("client_tool_step_seconds", model=self.model):
+                    tool_results = self._call_tools(tool_calls)
                 tool_result_msg = ""
-                for tool_call in tool_calls:
-                    error_tool = tool_call
-                    tool_result = self._call_tool(tool_call["name"], tool_call["arguments"])
+                for tool_call, tool_result in zip(tool_calls, tool_results):
                     tool_result_msg += self._format_tool_result(tool_call["name"], tool_result) + "\n"
                 self.db.add_message(chat_id, 'user', tool_result_msg)
 
                 last_response = ("Попробуй собрать еще информацию, но только если это необходимо "
                                  "или выведи ответ в доступной форме согласно условию запроса")
                 attempts += 1
-                time.sleep(1)
 
-            except Exception as e:
-                error_msg = f"Error calling tool {error_tool['name']}: {str(e)}"
+            except ToolCallError as e:
+                error_msg = f"Error calling tool {e.call['name']}: {str(e.error)}"
                 if chat_id is not None:
                     self.db.add_message(chat_id, 'assistant', error_msg)
-                return error_msg
+                yield error_msg
+                return
 
-        return response
+        # Tool step limit reached: one last step without tools, the model answers from the results it has
+        turn, chunks = self._request_step("Лимит вызовов инструментов исчерпан. Выведи ответ в доступной форме "
+                                          "согласно условию запроса, используя уже полученную информацию",
+                                          self.current_chat_id, native, recall=False, tools=False)
+        try:
+            yield from chunks
+        finally:
+            chunks.close()
+
+
+class AgentPool:
+    def __init__(
+            self,
+            model: str = "llama3.1:latest",
+            base_url: str = "http://localhost:11434",
+            system_prompt: str = "You are a helpful AI assistant.",
+            temperature: float = 0.7,
+            verbose: bool = False,
+            transport: Optional[HttpTransport] = None,
+            db: Optional[ChatDatabase] = None,
+            context: Optional[ContextBuilder] = None,
+            compressor: Optional[HistoryCompressor] = None,
+            keep_alive: Optional[str] = None,
+            tool_mode: str = "auto",
+            setup: Callable = init_func
+    ):
+        """
+        Builds the tool registry once and hands out per-conversation Agent handles
+        that share the registry, database connection and HTTP transport.
+        """
+        self._owns_transport = transport is None
+        self._owns_db = db is None
+        self.transport = transport or HttpTransport()
+        self.db = db or ChatDatabase()
+        self.context = context or ContextBuilder(self.db)
+        self.compressor = compressor
+        self.options = {
+            "model": model,
+            "base_url": base_url,
+            "system_prompt": system_prompt,
+            "temperature": temperature,
+            "verbose": verbose,
+            "keep_alive": keep_alive,
+            "tool_mode": tool_mode
+        }
+
+        # setup() registers tools through self.register_tool, same as for a single Agent
+        self.tools = ToolRegistry(verbose=verbose)
+        setup(self)
+        self.tools.freeze()
+
+    def register_tool(
+            self,
+            name: str,
+            description: str,
+            parameters: Dict[str, Any],
+            function: Callable,
+            timeout: Optional[float] = None,
+            cache_ttl: Optional[float] = None,
+            cache_normalize: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+            bind_agent: bool = False
+    ) -> None:
+        self.tools.register(name, description, parameters, function, timeout, cache_ttl, cache_normalize,
+                            bind_agent)
+
+    def get(self, chat_id: int, user_id: Optional[int] = None) -> Agent:
+        """Return a lightweight agent bound to the given conversation of user_id."""
+        return Agent(**self.options, tools=self.tools, transport=self.transport, db=self.db, chat_id=chat_id,
+                     context=self.context, compressor=self.compressor, user_id=user_id)
+
+    def close(self) -> None:
+        self.tools.shutdown()
+        if self._owns_db:
+            self.db.close()
+        if self._owns_transport:
+            self.transport.close()
 
 
 # Пример использования
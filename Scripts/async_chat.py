@@ -0,0 +1,163 @@
+import asyncio
+import time
+import aiohttp
+from Scripts.main import OllamaChat, ChatManager
+
+
+class AsyncOllamaChat:
+    # Синхронный класс, которому делегируется работа с базой данных
+    sync_class = OllamaChat
+
+    def __init__(self, model="llama3.1:latest", base_url="http://localhost:11434",
+                 pool_size=100, connect_timeout=5.0, read_timeout=120.0):
+        self.chat = self.sync_class(model=model, base_url=base_url)
+        self.pool_size = pool_size
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self._session = None
+
+    @property
+    def model(self):
+        return self.chat.model
+
+    @property
+    def base_url(self):
+        return self.chat.base_url
+
+    @property
+    def db(self):
+        return self.chat.db
+
+    @property
+    def current_chat_id(self):
+        return self.chat.current_chat_id
+
+    @current_chat_id.setter
+    def current_chat_id(self, value):
+        self.chat.current_chat_id = value
+
+    async def _get_session(self):
+        # Сессия должна создаваться внутри работающего event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def start_new_chat(self, title=None):
+        return await asyncio.to_thread(self.chat.start_new_chat, title)
+
+    async def delete_chat(self, chat_id):
+        await asyncio.to_thread(self.chat.delete_chat, chat_id)
+
+    async def rename_chat(self, chat_id, new_title):
+        await asyncio.to_thread(self.chat.rename_chat, chat_id, new_title)
+
+    async def send_message(self, message, stream=False, chat_id=None, system_prompt=None, limit=None, temperature=0.8):
+        # Запись сообщения пользователя и чтение истории выполняются в пуле потоков
+        chat_id, payload, turn = await asyncio.to_thread(
+            self.chat._prepare_request, message, stream, chat_id, system_prompt, limit, temperature
+        )
+
+        session = await self._get_session()
+        turn["sent_at"] = time.perf_counter()
+        response = await session.post(f"{self.base_url}/api/chat", json=payload)
+
+        if response.status != 200:
+            text = await response.text()
+            response.release()
+            raise Exception(f"Ошибка API: {response.status} - {text}")
+
+        if stream:
+            return self._stream_response(chat_id, response, turn)
+        else:
+            return await self._non_stream_response(chat_id, response, turn)
+
+    async def _stream_response(self, chat_id, response, turn):
+        assistant_msg = ""
+        stats = None
+        try:
+            async for line in response.content:
+                line = line.strip()
+                if line:
+                    content, chunk = self.chat._parse_chunk(line.decode('utf-8'))
+                    if content:
+                        self.chat._mark_first_token(turn)
+                    if content is not None:
+                        assistant_msg += content
+                        yield content
+                    if chunk.get('done'):
+                        stats = self.chat._record_turn(turn, chunk)
+        finally:
+            # Как и в OllamaChat: при досрочном закрытии частичный ответ тоже сохраняется
+            response.release()
+            await asyncio.to_thread(self.db.add_message, chat_id, 'assistant', assistant_msg, stats)
+            self.chat._after_reply(chat_id)
+
+    async def _non_stream_response(self, chat_id, response, turn):
+        async with response:
+            response_data = await response.json(content_type=None)
+        assistant_msg = response_data['message']['content']
+        stats = self.chat._record_turn(turn, response_data)
+        await asyncio.to_thread(self.db.add_message, chat_id, 'assistant', assistant_msg, stats)
+        self.chat._after_reply(chat_id)
+        return assistant_msg
+
+    async def list_chats(self):
+        return await asyncio.to_thread(self.chat.list_chats)
+
+    async def load_chat(self, chat_id):
+        return await asyncio.to_thread(self.chat.load_chat, chat_id)
+
+    async def find_chat_name(self, **criteria):
+        return await asyncio.to_thread(self.chat.find_chat_name, **criteria)
+
+    async def get_chat_history(self, chat_id, limit=None):
+        return await asyncio.to_thread(self.chat.get_chat_history, chat_id, limit)
+
+    async def get_current_chat_id(self):
+        return await asyncio.to_thread(self.chat.get_current_chat_id)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+        await asyncio.to_thread(self.chat.close)
+
+
+class AsyncChatManager(AsyncOllamaChat):
+    sync_class = ChatManager
+
+    async def print_all_chats(self):
+        return await asyncio.to_thread(self.chat.print_all_chats)
+
+    async def start_chat(self):
+        await asyncio.to_thread(self.chat.start_chat)
+
+    async def do_command(self, command: str):
+        # Команды работают с базой и могут вызывать модель (/compress) - выполняем вне event loop
+        await asyncio.to_thread(self.chat.do_command, command)
+
+
+# Пример использования
+if __name__ == "__main__":
+    async def run():
+        chat = AsyncChatManager()
+        await chat.start_chat()
+
+        while True:
+            user_input = await asyncio.to_thread(input, "\nВы: ")
+            if user_input.lower() in ['/exit', '/quit', '/выход']:
+                break
+            if user_input[0] == "/":
+                await chat.do_command(command=user_input)
+                continue
+
+            try:
+                print("Ассистент: ", end="")
+                async for chunk in await chat.send_message(user_input, stream=True):
+                    print(chunk, end='', flush=True)
+            except Exception as e:
+                print(f"Произошла ошибка: {e}")
+
+        await chat.close()
+        print("Чат завершен. История сохранена.")
+
+    asyncio.run(run())
@@ -0,0 +1,255 @@
+import argparse
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from Scripts.main import ChatDatabase, OllamaChat
+
+
+def _fill_messages(db, total, chats=1000, batch=100000):
+    # Быстрое заполнение: одна транзакция на пачку, без commit на каждое сообщение.
+    # Сообщения чата идут подряд, как в реальной базе, где чаты сменяют друг друга
+    chat_ids = [db.create_chat(f"Чат {i}") for i in range(chats)]
+    rows = ((chat_ids[i * chats // total], 'user' if i % 2 else 'assistant', f"Сообщение {i} " * 8)
+            for i in range(total))
+    while True:
+        chunk = [row for _, row in zip(range(batch), rows)]
+        if not chunk:
+            break
+        db.conn.executemany('INSERT INTO messages (chat_id, role, content) VALUES (?, ?, ?)', chunk)
+        db.conn.commit()
+    return chat_ids
+
+
+def _measure(function, chat_ids, repeats):
+    sample = [random.choice(chat_ids) for _ in range(repeats)]
+    started = time.perf_counter()
+    for chat_id in sample:
+        function(chat_id)
+    return (time.perf_counter() - started) / repeats * 1000
+
+
+def bench_history(sizes, repeats=200):
+    """Задержка get_chat_history(limit=20) с индексом и без него (полный просмотр, как до миграции 2)."""
+    print(f"{'messages':>12} {'indexed, ms':>12} {'no index, ms':>13}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            db = ChatDatabase(os.path.join(directory, 'bench.db'))
+            chat_ids = _fill_messages(db, size)
+
+            indexed = _measure(lambda chat_id: db.get_chat_history(chat_id, limit=20), chat_ids, repeats)
+
+            db.conn.execute('DROP INDEX idx_messages_chat')
+            # Без индекса каждый запрос - полный просмотр таблицы, поэтому повторов меньше
+            scan = _measure(lambda chat_id: db.get_chat_history(chat_id, limit=20), chat_ids, max(3, repeats // 50))
+
+            print(f"{size:>12} {indexed:>12.3f} {scan:>13.3f}")
+            db.close()
+
+
+def _fill_search_corpus(db, total, chats=1000, words=20000, batch=100000):
+    # Словарь с распределением Ципфа, как в живом тексте: немного частых слов и длинный хвост редких.
+    # Триггеры FTS на время заполнения снимаются, индекс строится одним rebuild
+    vocabulary = [f"слово{i}" for i in range(words)]
+    weights = [1 / (rank + 1) for rank in range(words)]
+    chat_ids = [db.create_chat(f"Чат {i}") for i in range(chats)]
+    db.conn.executescript('''
+    DROP TRIGGER messages_fts_insert;
+    DROP TRIGGER messages_fts_delete;
+    DROP TRIGGER messages_fts_update;
+    ''')
+    rows = ((chat_ids[i * chats // total], 'user' if i % 2 else 'assistant',
+             " ".join(random.choices(vocabulary, weights, k=12)))
+            for i in range(total))
+    while True:
+        chunk = [row for _, row in zip(range(batch), rows)]
+        if not chunk:
+            break
+        db.conn.executemany('INSERT INTO messages (chat_id, role, content) VALUES (?, ?, ?)', chunk)
+        db.conn.commit()
+
+    started = time.perf_counter()
+    db.conn.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+    db.conn.commit()
+    return chat_ids, vocabulary, time.perf_counter() - started
+
+
+def bench_search(sizes, repeats=100):
+    """Задержка search_messages (первая страница) по FTS5 и полный просмотр через LIKE для сравнения."""
+    print(f"{'messages':>12} {'index, s':>9} {'query':<22} {'fts, ms':>9} {'like, ms':>9}")
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            db = ChatDatabase(os.path.join(directory, 'bench.db'))
+            chat_ids, vocabulary, build = _fill_search_corpus(db, size)
+
+            queries = (
+                ("частое слово", vocabulary[0], False),
+                ("редкое слово", vocabulary[-1], False),
+                ("два слова", f"{vocabulary[1]} {vocabulary[50]}", False),
+                ("префикс", "слово123*", False),
+                ("частое, в одном чате", vocabulary[0], True),
+            )
+            for label, query, in_chat in queries:
+                def fts(chat_id):
+                    db.search_messages(query, chat_id=chat_id if in_chat else None, limit=10)
+
+                def like(chat_id):
+                    # Без индекса: просмотр всех сообщений (или всего чата) и сортировка по новизне
+                    terms = query.rstrip("*").split()
+                    db._reader().execute(
+                        'SELECT message_id FROM messages WHERE (? IS NULL OR chat_id = ?) AND '
+                        + ' AND '.join('content LIKE ?' for _ in terms) + ' ORDER BY message_id DESC LIMIT 10',
+                        (chat_id if in_chat else None, chat_id if in_chat else None,
+                         *(f"%{term}%" for term in terms))
+                    ).fetchall()
+
+                indexed = _measure(fts, chat_ids, repeats)
+                scan = _measure(like, chat_ids, max(3, repeats // 50))
+                print(f"{size:>12} {build:>9.1f} {label:<22} {indexed:>9.3f} {scan:>9.3f}")
+            db.close()
+
+
+class _LegacyChat(OllamaChat):
+    """OllamaChat с прежним перехватом __getattribute__ и поиском чата через list_chats - для сравнения."""
+
+    def __getattribute__(self, name):
+        val = super().__getattribute__(name)
+        if name == "current_chat_id" and val is None:
+            val = self.get_current_chat_id()
+        return val
+
+    def get_current_chat_id(self):
+        cursor = self.db._reader().cursor()
+        cursor.row_factory = sqlite3.Row
+        cursor.execute('''SELECT 
+            ROW_NUMBER() OVER (ORDER BY chat_id DESC) as "index",
+            chat_id, title,
+            created_at FROM chats ORDER BY created_at DESC''')
+        list_chats = [dict(row) for row in cursor.fetchall()]
+        return list_chats[0]['chat_id'] if list_chats else None
+
+
+class _CannedResponse:
+    status_code = 200
+    text = ""
+
+    @staticmethod
+    def json():
+        return {"message": {"role": "assistant", "content": "ok"}}
+
+
+class _CannedTransport:
+    """Транспорт без сети: измеряется только накладной расход клиента."""
+
+    def post(self, url, **kwargs):
+        return _CannedResponse()
+
+    def close(self):
+        pass
+
+
+def bench_overhead(chats=1000, number=20000):
+    """Доступ к атрибутам и накладной расход send_message до и после замены __getattribute__."""
+    print(f"{'':<40} {'legacy, us':>11} {'current, us':>12}")
+    results = {}
+    for name, cls in (("legacy", _LegacyChat), ("current", OllamaChat)):
+        # У каждого варианта своя база, чтобы записи одного не замедляли другой
+        with tempfile.TemporaryDirectory() as directory:
+            db = ChatDatabase(os.path.join(directory, 'bench.db'))
+            for i in range(chats):
+                db.create_chat(f"Чат {i}")
+
+            chat = cls(transport=_CannedTransport(), db=db)
+            chat_id = chat.current_chat_id
+
+            def resolve():
+                # Как после удаления выбранного чата: идентификатор нужно найти заново
+                chat.invalidate_current_chat()
+                return chat.current_chat_id
+
+            results[name] = (
+                timeit.timeit(lambda: chat.model, number=number) / number * 1e6,
+                timeit.timeit(lambda: chat.current_chat_id, number=number) / number * 1e6,
+                timeit.timeit(resolve, number=number // 100) / (number // 100) * 1e6,
+                timeit.timeit(lambda: chat.send_message("ping", chat_id=chat_id), number=number // 20) / (number // 20) * 1e6
+            )
+            db.close()
+
+    labels = ("attribute access", "current_chat_id (cached)",
+              f"current_chat_id (resolve, {chats} chats)", "send_message (no network)")
+    for index, label in enumerate(labels):
+        print(f"{label:<40} {results['legacy'][index]:>11.2f} {results['current'][index]:>12.2f}")
+
+
+def _import_times(module):
+    # -X importtime пишет в stderr строки "import time: self [us] | cumulative | package"
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True, env=dict(os.environ, PYTHONDONTWRITEBYTECODE="1"))
+    if result.returncode != 0:
+        raise RuntimeError(f"Не удалось импортировать {module}:\n{result.stderr[-2000:]}")
+
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        _, self_us, cumulative_us, name = line.replace("import time:", "|", 1).split("|")
+        times.append((name.rstrip()[1:], int(self_us), int(cumulative_us)))
+
+    # Строки идут после своих зависимостей: поддерево модуля - строки с отступом прямо перед ним
+    end = next(index for index, (name, _, _) in enumerate(times) if name == module)
+    start = end
+    while start > 0 and times[start - 1][0].startswith(" "):
+        start -= 1
+    return times[start:end + 1]
+
+
+def bench_importtime(modules, budget_ms, top=10, repeats=3):
+    """Время импорта точек входа (python -X importtime). Возвращает False, если бюджет превышен."""
+    within_budget = True
+    for module in modules:
+        # Лучший из нескольких запусков: первый может включать прогрев файлового кэша ОС
+        times = min((_import_times(module) for _ in range(repeats)), key=lambda run: run[-1][2])
+        total_ms = times[-1][2] / 1000
+        status = "ok" if total_ms <= budget_ms else "OVER BUDGET"
+        within_budget = within_budget and total_ms <= budget_ms
+        print(f"{module}: {total_ms:.1f} ms (budget {budget_ms} ms) {status}")
+        for name, _, cumulative in sorted(times[:-1], key=lambda item: -item[2])[:top]:
+            print(f"    {cumulative / 1000:>8.1f} ms  {name.strip()}")
+    return within_budget
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Бенчмарки Ollama_chat")
+    subparsers = parser.add_subparsers(dest="name", required=True)
+
+    history = subparsers.add_parser("history", help="задержка чтения истории чата")
+    history.add_argument("--sizes", type=int, nargs="+", default=[10_000, 1_000_000, 10_000_000])
+    history.add_argument("--repeats", type=int, default=200)
+
+    overhead = subparsers.add_parser("overhead", help="накладной расход OllamaChat без сети")
+    overhead.add_argument("--chats", type=int, default=1000)
+    overhead.add_argument("--number", type=int, default=20000)
+
+    search = subparsers.add_parser("search", help="задержка полнотекстового поиска по истории")
+    search.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000, 5_000_000])
+    search.add_argument("--repeats", type=int, default=100)
+
+    importtime = subparsers.add_parser("importtime", help="время импорта точек входа, с бюджетом")
+    importtime.add_argument("--modules", nargs="+", default=["Scripts.agent", "Scripts.bot"])
+    importtime.add_argument("--budget-ms", type=float, default=300.0)
+    importtime.add_argument("--top", type=int, default=10)
+
+    args = parser.parse_args()
+    if args.name == "history":
+        bench_history(args.sizes, args.repeats)
+    elif args.name == "overhead":
+        bench_overhead(args.chats, args.number)
+    elif args.name == "search":
+        bench_search(args.sizes, args.repeats)
+    elif args.name == "importtime":
+        # Ненулевой код возврата, чтобы превышение бюджета можно было проверять в CI
+        sys.exit(0 if bench_importtime(args.modules, args.budget_ms, args.top) else 1)
@@ -3,54 +3,80 @@ import telebot
 import time
 from telebot.types import ReplyKeyboardMarkup
 from API import API_bot
-from Scripts import main
-from Scripts.EnglishTeacher import EnglishTeacher
+from Scripts import main as main_module
 from Scripts.TelegramLogger import TelegramLogger
+from Scripts.ChatDispatcher import ChatDispatcher
+from Scripts.HttpTransport import HttpTransport
+from Scripts.ContextBuilder import ContextBuilder
+from Scripts.HistoryCompressor import HistoryCompressor
+from Scripts.SessionRegistry import SessionRegistry
+from Scripts.agent import AgentPool
+from Scripts.Metrics import metrics
+from Scripts.TelegramStreamer import TelegramStreamer
+from Scripts.SemanticMemory import SemanticMemory
+from Scripts.ExercisePool import ExercisePool
 
 API_Bot = API_bot
-bot = telebot.TeleBot(API_Bot)
+# Обработчики только ставят задачи в очередь диспетчера, поэтому polling работает в одном потоке
+bot = telebot.TeleBot(API_Bot, threaded=False)
 
 # Инициализация
 markup = ReplyKeyboardMarkup(row_width=2, resize_keyboard=True, one_time_keyboard=False)
 markup.add("/simple", "/english", "/help")
 
-telegram_logger = TelegramLogger(bot, None)
-sys.stdout = telegram_logger
-sys.stderr = telegram_logger
+dispatcher = ChatDispatcher(
+    max_workers=8,
+    max_queue=3,
+    on_busy=lambda chat_id: bot.send_message(chat_id, "Бот еще обрабатывает ваши предыдущие сообщения, попробуйте позже")
+)
 
-chat = main.ChatManager()
-english_teacher = EnglishTeacher(chat)
+# Ресурсы создаются в main(): импорт модуля не открывает базу, не запускает потоки
+# и не подменяет stdout
+telegram_logger = None
+streamer = None
+db = None
+transport = None
+memory = None
+exercise_pool = None
+sessions = None
+agents = None
 
 
 @bot.message_handler(commands=['start'])
+@dispatcher.handler
 def send_welcome(message):
     telegram_logger.chat_id = message.chat.id
-    chat.do_command("/history -d")
-    chat.start_chat()
+    with sessions.use(message.chat.id) as session:
+        session.chat.do_command("/history -d")
     bot.send_message(message.chat.id, "Добро пожаловать! Выберите режим:",
                      reply_markup=markup)
 
 
 @bot.message_handler(commands=['english'])
+@dispatcher.handler
 def english_mode(message):
     telegram_logger.chat_id = message.chat.id
-    chat.do_command("/history -d")
-    bot.send_message(message.chat.id, "Выберите режим изучения английского:",
-                     reply_markup=english_teacher.get_mode_keyboard())
+    with sessions.use(message.chat.id) as session:
+        session.chat.do_command("/history -d")
+        bot.send_message(message.chat.id, "Выберите режим изучения английского:",
+                         reply_markup=session.teacher.get_mode_keyboard())
 
 
 @bot.message_handler(commands=['simple'])
+@dispatcher.handler
 def english_mode(message):
     telegram_logger.chat_id = message.chat.id
-    chat.do_command("/history -d")
-    english_teacher.current_mode = None
+    with sessions.use(message.chat.id) as session:
+        session.chat.do_command("/history -d")
+        session.teacher.current_mode = None
     bot.send_message(message.chat.id, "Быбран обычный режим общения с ИИ")
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('set_mode_'))
+@dispatcher.handler
 def set_mode(call):
+    telegram_logger.chat_id = call.message.chat.id
     mode = call.data.split('_')[-1]
-    english_teacher.current_mode = mode
 
     bot.edit_message_reply_markup(
         chat_id=call.message.chat.id,
@@ -58,15 +84,21 @@ def set_mode(call):
         reply_markup=None
     )
 
-    if mode == 'exercises':
-        bot.send_message(call.message.chat.id, "Выберите тип упражнений:",
-                         reply_markup=english_teacher.get_exercise_keyboard())
-    else:
-        bot.send_message(call.message.chat.id, f"Режим установлен: {english_teacher.modes[mode]}")
+    with sessions.use(call.message.chat.id) as session:
+        english_teacher = session.teacher
+        english_teacher.current_mode = mode
+
+        if mode == 'exercises':
+            bot.send_message(call.message.chat.id, "Выберите тип упражнений:",
+                             reply_markup=english_teacher.get_exercise_keyboard())
+        else:
+            bot.send_message(call.message.chat.id, f"Режим установлен: {english_teacher.modes[mode]}")
 
 
 @bot.callback_query_handler(func=lambda call: call.data.startswith('start_exercise_'))
+@dispatcher.handler
 def start_exercise(call):
+    telegram_logger.chat_id = call.message.chat.id
     bot.edit_message_reply_markup(
         chat_id=call.message.chat.id,
         message_id=call.message.message_id,
@@ -74,42 +106,94 @@ def start_exercise(call):
     )
 
     ex_type = call.data.split('_')[-1]
-    exercise = english_teacher.generate_exercise(ex_type)
-    english_teacher.current_mode = 'chat'
-    bot.send_message(call.message.chat.id, exercise)
+    with sessions.use(call.message.chat.id) as session:
+        # Поток читается внутри сессии: упражнение сохраняется вместе с ней
+        streamer.stream(call.message.chat.id, session.teacher.generate_exercise(ex_type, stream=True))
+        session.teacher.current_mode = 'chat'
 
 
 @bot.message_handler(content_types=['text'])
+@dispatcher.handler
 def handle_text(message):
     telegram_logger.chat_id = message.chat.id
     telegram_logger.write_console(f"\nВы: {message.text}\n")
 
-    if message.text.startswith('/'):
-        chat.do_command(command=message.text)
-        return
-
-    if english_teacher.current_mode == 'correction':
-        correction = english_teacher.correct_text(message.text)
-        bot.send_message(message.chat.id, ''.join(correction))
-    elif english_teacher.current_mode == 'chat':
-        answer = english_teacher.simple_converse(message)
-        bot.send_message(message.chat.id, answer)
-    else:
-        from agent import Agent, init_func
-        agent = Agent()
-        init_func(agent)
-        answer = agent.chat(message.text)
-        #answer = chat.send_message(message.text, chat_id=chat.current_chat_id)
-        answer_str = ''.join(answer) if hasattr(answer, '__iter__') else str(answer)
-        bot.send_message(message.chat.id, answer_str)
-
-
-while True:
+    with sessions.use(message.chat.id) as session:
+        chat = session.chat
+        english_teacher = session.teacher
+
+        if message.text.startswith('/'):
+            chat.do_command(command=message.text)
+            return
+
+        if english_teacher.current_mode == 'correction':
+            streamer.stream(message.chat.id, english_teacher.correct_text(message.text, stream=True))
+        elif english_teacher.current_mode == 'chat':
+            streamer.stream(message.chat.id, english_teacher.simple_converse(message, stream=True))
+        else:
+            agent = agents.get(chat.current_chat_id, user_id=chat.user_id)
+            streamer.stream(message.chat.id, agent.chat(message.text, stream=True))
+
+
+def main():
+    global telegram_logger, streamer, db, transport, memory, exercise_pool, sessions, agents
+
+    # Ответы модели показываются по мере генерации правками одного сообщения
+    streamer = TelegramStreamer(bot)
+    # Вывод print уходит в чат фоновым потоком и делит с ответами лимиты Telegram
+    telegram_logger = TelegramLogger(bot, None, streamer=streamer)
+    sys.stdout = telegram_logger
+    sys.stderr = telegram_logger
+
+    # Общие для всех пользователей ресурсы; состояние каждого пользователя - в его сессии
+    # Записи разных пользователей объединяются в общие транзакции
+    db = main_module.ChatDatabase(durability='group')
+    transport = HttpTransport()
+    keep_alive = "30m"
+    # Старые сообщения, выпавшие из окна, вспоминаются по смыслу (эмбеддинги Ollama)
+    memory = SemanticMemory(db, transport, keep_alive=keep_alive)
+    # Окно истории сдвигается редко, а модель не выгружается между сообщениями -
+    # так Ollama переиспользует уже вычисленный префикс промпта
+    context = ContextBuilder(db, prefix_stable=True, memory=memory)
+    # Длинные чаты сжимаются в фоне, чтобы размер промпта не рос вместе с историей
+    compressor = HistoryCompressor(main_module.OllamaChat(transport=transport, db=db, context=context,
+                                                            keep_alive=keep_alive))
+    # Упражнения генерируются заранее и только пока бот несколько секунд простаивает;
+    # пришедшее сообщение прерывает фоновую генерацию (она начнется заново в следующей паузе)
+    exercise_pool = ExercisePool(main_module.OllamaChat(transport=transport, db=db, keep_alive=keep_alive),
+                                 idle=lambda: dispatcher.idle_seconds() >= 3,
+                                 log=telegram_logger.write_console).start()
+    sessions = SessionRegistry(db, transport, max_sessions=1000, context=context, compressor=compressor,
+                               keep_alive=keep_alive, exercise_pool=exercise_pool)
+    agents = AgentPool(db=db, transport=transport, context=context, compressor=compressor, keep_alive=keep_alive)
+
+    # Телеметрия запросов к модели и очередей диспетчера: http://127.0.0.1:9100/metrics (и /metrics.json)
+    metrics.add_collector("dispatcher", dispatcher.metrics)
+    metrics.add_collector("telegram_log", telegram_logger.stats)
+    metrics.add_collector("exercise_pool", exercise_pool.stats)
+    metrics.serve(port=9100)
+
     try:
-        bot.infinity_polling(timeout=60, long_polling_timeout=30)
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        time.sleep(5)
+        while True:
+            try:
+                bot.infinity_polling(timeout=60, long_polling_timeout=30)
+                break
+            except Exception as e:
+                print(f"An error occurred: {e}")
+                time.sleep(5)
     finally:
+        # Сначала дожидаемся обработчиков, еще работающих с сессиями и базой
+        dispatcher.shutdown(wait=True)
+        exercise_pool.shutdown()
+        sessions.save_all()
         telegram_logger.cleanup()
-        chat.close()
+        agents.close()
+        # Фоновое сжатие пишет в базу - дожидаемся его до закрытия базы
+        compressor.shutdown()
+        memory.shutdown()
+        db.close()
+        transport.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,140 @@
+import bisect
 import json
+import queue
+import re
 import sqlite3
-import requests
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from Scripts.HttpTransport import HttpTransport
+from Scripts.ContextBuilder import ContextBuilder
+from Scripts.HistoryCompressor import HistoryCompressor
+from Scripts.Metrics import metrics as default_metrics, OLLAMA_COUNTS, OLLAMA_DURATIONS, CLIENT_TIMINGS
+
+
+class ChatCatalog:
+    def __init__(self, chats=()):
+        """
+        Каталог чатов в памяти: поиск по ID и названию за O(1), обход от новых к старым.
+        Обновляется методами записи ChatDatabase, поэтому все пользователи одной базы
+        должны работать через общий экземпляр ChatDatabase.
+        Поиск и обход ограничены владельцем чатов (user_id; None - чаты консоли).
+        """
+        self.lock = threading.RLock()
+        self.by_id = {}
+        self.by_title = {}  # название -> ID чатов с этим названием
+        self.orders = {}  # владелец -> ID его чатов по возрастанию; новые чаты добавляются в конец
+        for chat in chats:
+            self.add(*chat)
+
+    def add(self, chat_id, title, created_at, user_id=None):
+        with self.lock:
+            self.by_id[chat_id] = {"chat_id": chat_id, "title": title, "created_at": created_at,
+                                   "user_id": user_id}
+            self.by_title.setdefault(title, set()).add(chat_id)
+            order = self.orders.setdefault(user_id, [])
+            if not order or order[-1] < chat_id:
+                order.append(chat_id)
+            else:
+                bisect.insort(order, chat_id)
+
+    def rename(self, chat_id, title):
+        with self.lock:
+            chat = self.get(chat_id)
+            if chat is None:
+                return
+            self._forget_title(chat)
+            chat["title"] = title
+            self.by_title.setdefault(title, set()).add(chat["chat_id"])
+
+    def remove(self, chat_id):
+        with self.lock:
+            chat = self.get(chat_id)
+            if chat is None:
+                return
+            del self.by_id[chat["chat_id"]]
+            self._forget_title(chat)
+            order = self.orders[chat["user_id"]]
+            del order[bisect.bisect_left(order, chat["chat_id"])]
+            if not order:
+                del self.orders[chat["user_id"]]
+
+    def _forget_title(self, chat):
+        ids = self.by_title[chat["title"]]
+        ids.discard(chat["chat_id"])
+        if not ids:
+            del self.by_title[chat["title"]]
+
+    def get(self, chat_id):
+        # ID может прийти строкой из команды пользователя
+        try:
+            return self.by_id.get(int(chat_id))
+        except (TypeError, ValueError):
+            return None
 
+    def find(self, user_id=None, **criteria):
+        """
+        Первый (самый новый) чат владельца user_id, у которого все заданные поля совпадают
+        с criteria. Чужие чаты не находятся, даже по ID.
+        """
+        criteria = {k: v for k, v in criteria.items() if v is not None}
+        with self.lock:
+            if "chat_id" in criteria:
+                candidates = [self.get(criteria["chat_id"])]
+            elif "title" in criteria:
+                candidates = [self.by_id[chat_id] for chat_id in
+                              sorted(self.by_title.get(str(criteria["title"]), ()), reverse=True)]
+            else:
+                candidates = [self.by_id[chat_id] for chat_id in reversed(self.orders.get(user_id, ()))]
+
+            for chat in candidates:
+                if chat is not None and chat["user_id"] == user_id \
+                        and all(str(chat.get(k)) == str(v) for k, v in criteria.items()):
+                    return dict(chat)
+        return None
 
-class ChatDatabase:
-    def __init__(self, db_name='chat_history.db'):
-        self.conn = sqlite3.connect(db_name, check_same_thread=False)
-        self.create_tables()
+    def latest(self, user_id=None):
+        with self.lock:
+            order = self.orders.get(user_id)
+            return order[-1] if order else None
 
-    def create_tables(self):
-        cursor = self.conn.cursor()
-        cursor.execute('''
+    def page(self, limit=None, cursor=None, user_id=None):
+        """
+        Чаты владельца от новых к старым с полем index (1 - самый новый).
+        :param cursor: ID последнего чата предыдущей страницы
+        """
+        with self.lock:
+            order = self.orders.get(user_id, [])
+            end = len(order) if cursor is None else bisect.bisect_left(order, int(cursor))
+            start = 0 if limit is None else max(0, end - limit)
+            return [dict(index=len(order) - position, **self.by_id[order[position]])
+                    for position in range(end - 1, start - 1, -1)]
+
+    def __len__(self):
+        return len(self.by_id)
+
+
+class _ReaderSlot:
+    """Соединение для чтения, привязанное к потоку через threading.local: уходит вместе с потоком."""
+    __slots__ = ('conn', '__weakref__')
+
+    def __init__(self, conn):
+        self.conn = conn
+
+
+class ChatDatabase:
+    # Миграции схемы по порядку: после применения N-й миграции PRAGMA user_version = N.
+    # Новые изменения схемы добавляются только в конец списка
+    MIGRATIONS = [
+        # 1: исходная схема
+        '''
         CREATE TABLE IF NOT EXISTS chats (
             chat_id INTEGER PRIMARY KEY AUTOINCREMENT,
             title TEXT,
             created_at TEXT DEFAULT (datetime('now', 'localtime'))
-        )
-        ''')
+        );
 
-        cursor.execute('''
         CREATE TABLE IF NOT EXISTS messages (
             message_id INTEGER PRIMARY KEY AUTOINCREMENT,
             chat_id INTEGER,
@@ -26,50 +142,404 @@ class ChatDatabase:
             content TEXT,
             timestamp TEXT DEFAULT (datetime('now', 'localtime')),
             FOREIGN KEY (chat_id) REFERENCES chats (chat_id)
-        )
-        ''')
-        self.conn.commit()
+        );
 
-    def create_chat(self, title="New Chat"):
-        cursor = self.conn.cursor()
-        cursor.execute('INSERT INTO chats (title) VALUES (?)', (title,))
-        self.conn.commit()
-        return cursor.lastrowid
+        CREATE TABLE IF NOT EXISTS telegram_sessions (
+            user_id INTEGER PRIMARY KEY,
+            chat_id INTEGER,
+            mode TEXT,
+            user_level TEXT,
+            exercise TEXT,
+            updated_at TEXT DEFAULT (datetime('now', 'localtime'))
+        );
+        ''',
+        # 2: история чата выбирается по (chat_id, message_id) без полного сканирования
+        '''
+        CREATE INDEX IF NOT EXISTS idx_messages_chat ON messages (chat_id, message_id);
+        ''',
+        # 3: сжатые резюме истории; last_message_id - последнее сообщение, вошедшее в резюме
+        '''
+        CREATE TABLE IF NOT EXISTS summaries (
+            summary_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER,
+            content TEXT,
+            last_message_id INTEGER,
+            created_at TEXT DEFAULT (datetime('now', 'localtime')),
+            FOREIGN KEY (chat_id) REFERENCES chats (chat_id)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_summaries_chat ON summaries (chat_id, summary_id);
+        ''',
+        # 4: телеметрия ответов модели: счетчики Ollama (нс) и замеры клиента (мс)
+        '''
+        CREATE TABLE IF NOT EXISTS message_stats (
+            message_id INTEGER PRIMARY KEY,
+            chat_id INTEGER,
+            model TEXT,
+            prompt_messages INTEGER,
+            prompt_tokens INTEGER,
+            prompt_eval_count INTEGER,
+            prompt_eval_duration INTEGER,
+            eval_count INTEGER,
+            eval_duration INTEGER,
+            total_duration INTEGER,
+            load_duration INTEGER,
+            user_write_ms REAL,
+            history_ms REAL,
+            build_ms REAL,
+            ttft_ms REAL,
+            response_ms REAL,
+            FOREIGN KEY (message_id) REFERENCES messages (message_id)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_message_stats_chat ON message_stats (chat_id, message_id);
+        ''',
+        # 5: результаты инструментов агента (ToolCache) переживают перезапуск
+        '''
+        CREATE TABLE IF NOT EXISTS tool_cache (
+            key TEXT PRIMARY KEY,
+            value TEXT,
+            expires_at REAL
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_tool_cache_expires ON tool_cache (expires_at);
+        ''',
+        # 6: полнотекстовый поиск по истории. Индекс хранит только токены (content='messages'),
+        # триггеры держат его в соответствии с messages, rebuild индексирует уже накопленную историю.
+        # chat_id индексируется, чтобы поиск в одном чате был пересечением списков, а не фильтром;
+        # в оценке bm25 эта колонка не участвует
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+            content,
+            chat_id,
+            content='messages',
+            content_rowid='message_id',
+            tokenize='unicode61 remove_diacritics 2'
+        );
+
+        CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+            INSERT INTO messages_fts (rowid, content, chat_id) VALUES (new.message_id, new.content, new.chat_id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content, chat_id)
+            VALUES ('delete', old.message_id, old.content, old.chat_id);
+        END;
+
+        CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content, chat_id ON messages BEGIN
+            INSERT INTO messages_fts (messages_fts, rowid, content, chat_id)
+            VALUES ('delete', old.message_id, old.content, old.chat_id);
+            INSERT INTO messages_fts (rowid, content, chat_id) VALUES (new.message_id, new.content, new.chat_id);
+        END;
+
+        INSERT INTO messages_fts (messages_fts, rank) VALUES ('rank', 'bm25(1.0, 0.0)');
+        INSERT INTO messages_fts (messages_fts) VALUES ('rebuild');
+        ''',
+        # 7: эмбеддинги сообщений для семантической памяти (SemanticMemory) - float32 в BLOB
+        '''
+        CREATE TABLE IF NOT EXISTS message_embeddings (
+            message_id INTEGER PRIMARY KEY,
+            chat_id INTEGER,
+            model TEXT,
+            vector BLOB,
+            FOREIGN KEY (message_id) REFERENCES messages (message_id)
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_message_embeddings_chat ON message_embeddings (chat_id, message_id);
+        ''',
+        # 8: заранее сгенерированные упражнения (ExercisePool) и какие из них видел каждый пользователь
+        '''
+        CREATE TABLE IF NOT EXISTS exercise_pool (
+            exercise_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            ex_type TEXT,
+            user_level TEXT,
+            content TEXT,
+            uses INTEGER DEFAULT 0,
+            created_at TEXT DEFAULT (datetime('now', 'localtime'))
+        );
+
+        CREATE INDEX IF NOT EXISTS idx_exercise_pool_key ON exercise_pool (ex_type, user_level, uses, exercise_id);
+
+        CREATE TABLE IF NOT EXISTS exercise_seen (
+            user_id INTEGER,
+            exercise_id INTEGER,
+            seen_at TEXT DEFAULT (datetime('now', 'localtime')),
+            PRIMARY KEY (user_id, exercise_id),
+            FOREIGN KEY (exercise_id) REFERENCES exercise_pool (exercise_id)
+        );
+        ''',
+        # 9: владелец чата (ID пользователя Telegram; NULL - чаты консоли). Существующие чаты
+        # получают владельца по сохраненным сессиям
+        '''
+        ALTER TABLE chats ADD COLUMN user_id INTEGER;
+
+        UPDATE chats SET user_id = (SELECT s.user_id FROM telegram_sessions s WHERE s.chat_id = chats.chat_id);
+
+        CREATE INDEX IF NOT EXISTS idx_chats_user ON chats (user_id, chat_id);
+        ''',
+    ]
+
+    PRAGMAS = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",  # в режиме WAL fsync только на checkpoint, целостность сохраняется
+        "cache_size": -16000,  # 16 МБ страничного кэша
+        "mmap_size": 268435456,  # 256 МБ
+        "temp_store": "MEMORY"
+    }
+
+    # Сколько самых новых совпадений поиска ранжируется по bm25
+    SEARCH_WINDOW = 2000
+
+    # Колонки message_stats, заполняемые из телеметрии ответа
+    STATS_COLUMNS = ("model", "prompt_messages", "prompt_tokens", "prompt_eval_count", "prompt_eval_duration",
+                     "eval_count", "eval_duration", "total_duration", "load_duration",
+                     "user_write_ms", "history_ms", "build_ms", "ttft_ms", "response_ms")
+
+    def __init__(self, db_name='chat_history.db', durability='full', batch_window=0.005, batch_size=100):
+        """
+        :param durability: Режим записи:
+            'full' - commit на каждую запись (по умолчанию);
+            'group' - фоновый поток объединяет записи в одну транзакцию, вызывающий ждет commit;
+            'async' - запись в фоне без ожидания, сохранность гарантирует flush()
+        :param batch_window: Сколько секунд писатель ждет новые записи для общей транзакции
+        :param batch_size: Максимум записей в одной транзакции
+        """
+        if durability not in ('full', 'group', 'async'):
+            raise ValueError(f"Неизвестный режим записи: {durability}")
+
+        self.db_name = db_name
+        # Единственное соединение для записи: в режиме 'full' защищено блокировкой,
+        # в 'group'/'async' им пользуется только фоновый писатель
+        self.conn = self._connect()
+        self.write_lock = threading.Lock()
+        self.migrate()
+        self.catalog = ChatCatalog(self.conn.execute('SELECT chat_id, title, created_at, user_id FROM chats'))
+
+        # Соединения для чтения - по одному на поток, читатели не ждут писателя (WAL)
+        self.local = threading.local()
+        self.readers = []
+        self.readers_lock = threading.Lock()
+
+        self.durability = durability
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        # После close() записи отклоняются: в 'group'/'async' их уже некому выполнить
+        self.closed = False
+        self.writer = None
+        if durability != 'full':
+            self.write_queue = queue.Queue()
+            # Незафиксированные записи по ключам: чтение ключа ждет их commit (read-your-writes)
+            self.pending = {}
+            self.pending_changed = threading.Condition()
+            self.writer = threading.Thread(target=self._writer_loop, name="db-writer", daemon=True)
+            self.writer.start()
+
+    def _connect(self):
+        # cached_statements - кэш подготовленных запросов внутри соединения
+        conn = sqlite3.connect(self.db_name, check_same_thread=False, cached_statements=256)
+        self.configure(conn)
+        return conn
+
+    def _reader(self):
+        slot = getattr(self.local, 'reader', None)
+        if slot is None:
+            slot = _ReaderSlot(self._connect())
+            self.local.reader = slot
+            with self.readers_lock:
+                self.readers.append(slot.conn)
+            # Короткоживущие потоки (сервер метрик, исполнитель инструментов) не копят соединения:
+            # при завершении потока threading.local отпускает slot и соединение закрывается
+            weakref.finalize(slot, self._release_reader, slot.conn)
+        return slot.conn
+
+    def _release_reader(self, conn):
+        with self.readers_lock:
+            if conn not in self.readers:
+                # Уже закрыто в close()
+                return
+            self.readers.remove(conn)
+        conn.close()
 
-    def add_message(self, chat_id, role, content):
-        #content = self.generator_to_string(content)
+    def configure(self, conn):
+        for name, value in self.PRAGMAS.items():
+            conn.execute(f'PRAGMA {name} = {value}')
+
+    def migrate(self):
+        version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+        for number, script in enumerate(self.MIGRATIONS[version:], start=version + 1):
+            # Миграция и смена версии применяются одной транзакцией
+            self.conn.executescript(f'BEGIN; {script} PRAGMA user_version = {number}; COMMIT;')
+
+    def _write(self, operation, keys=(), wait=False):
+        """
+        Выполняет operation(cursor) в транзакции и возвращает ее результат.
+        В режимах 'group'/'async' операция уходит фоновому писателю; в 'async'
+        результат возвращается только при wait=True.
+        """
+        if self.writer is None:
+            with self.write_lock:
+                self._check_open()
+                cursor = self.conn.cursor()
+                try:
+                    result = operation(cursor)
+                except Exception:
+                    self.conn.rollback()
+                    raise
+                self.conn.commit()
+            return result
+
+        future = Future()
+        # Проверка и постановка в очередь под одной блокировкой: close() не проскочит между ними
+        with self.pending_changed:
+            self._check_open()
+            for key in keys:
+                self.pending[key] = self.pending.get(key, 0) + 1
+            self.write_queue.put((operation, keys, future))
+
+        if wait or self.durability == 'group':
+            return future.result()
+        return None
+
+    def _check_open(self):
+        if self.closed:
+            raise sqlite3.ProgrammingError("База данных закрыта")
+
+    def _wait_pending(self, key):
+        if self.writer is None:
+            return
+        with self.pending_changed:
+            self.pending_changed.wait_for(lambda: key not in self.pending)
+
+    def _writer_loop(self):
+        running = True
+        while running:
+            item = self.write_queue.get()
+            if item is None:
+                break
+
+            batch = [item]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.write_queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+
+            self._commit_batch(batch)
+
+    def _commit_batch(self, batch):
         cursor = self.conn.cursor()
-        cursor.execute('''
-        INSERT INTO messages (chat_id, role, content)
-        VALUES (?, ?, ?)
-        ''', (chat_id, role, content))
-        self.conn.commit()
-        return cursor.lastrowid
+        results = []
+        try:
+            cursor.execute('BEGIN')
+            for operation, _, _ in batch:
+                # Точка сохранения на каждую операцию: ошибка одной не откатывает остальные
+                cursor.execute('SAVEPOINT write')
+                try:
+                    results.append((operation(cursor), None))
+                    cursor.execute('RELEASE write')
+                except Exception as e:
+                    cursor.execute('ROLLBACK TO write')
+                    cursor.execute('RELEASE write')
+                    results.append((None, e))
+            self.conn.commit()
+        except Exception as e:
+            self.conn.rollback()
+            results = [(None, e)] * len(batch)
+        self._finish_batch(batch, results)
+
+    def _finish_batch(self, batch, results):
+        with self.pending_changed:
+            for _, keys, _ in batch:
+                for key in keys:
+                    self.pending[key] -= 1
+                    if not self.pending[key]:
+                        del self.pending[key]
+            self.pending_changed.notify_all()
+
+        for (_, _, future), (result, error) in zip(batch, results):
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def flush(self):
+        """Дожидается фиксации всех поставленных в очередь записей."""
+        if self.writer is not None:
+            self._write(lambda cursor: None, wait=True)
+
+    def create_chat(self, title="New Chat", user_id=None):
+        """:param user_id: Владелец чата (ID пользователя Telegram; None - чат консоли)"""
+        def operation(cursor):
+            cursor.execute('INSERT INTO chats (title, user_id) VALUES (?, ?)', (title, user_id))
+            chat_id = cursor.lastrowid
+            cursor.execute('SELECT created_at FROM chats WHERE chat_id = ?', (chat_id,))
+            return chat_id, cursor.fetchone()[0]
+        # Идентификатор нового чата нужен сразу, поэтому всегда ждем записи
+        chat_id, created_at = self._write(operation, wait=True)
+        self.catalog.add(chat_id, title, created_at, user_id)
+        return chat_id
+
+    def add_message(self, chat_id, role, content, stats=None):
+        """
+        :param stats: Телеметрия ответа модели (см. OllamaChat._record_turn) - пишется
+            в message_stats той же транзакцией, что и сообщение
+        """
+        #content = self.generator_to_string(content)
+        def operation(cursor):
+            cursor.execute('''
+            INSERT INTO messages (chat_id, role, content)
+            VALUES (?, ?, ?)
+            ''', (chat_id, role, content))
+            message_id = cursor.lastrowid
+            if stats is not None:
+                cursor.execute(f'''
+                INSERT INTO message_stats (message_id, chat_id, {", ".join(self.STATS_COLUMNS)})
+                VALUES (?, ?, {", ".join("?" * len(self.STATS_COLUMNS))})
+                ''', (message_id, chat_id, *(stats.get(column) for column in self.STATS_COLUMNS)))
+            return message_id
+        return self._write(operation, keys=(("chat", str(chat_id)),))
 
     def delete_chat(self, chat_id):
-        cursor = self.conn.cursor()
-        cursor.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
-        cursor.execute('DELETE FROM chats WHERE chat_id = ?', (chat_id,))
-        self.conn.commit()
+        def operation(cursor):
+            cursor.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+            cursor.execute('DELETE FROM summaries WHERE chat_id = ?', (chat_id,))
+            cursor.execute('DELETE FROM message_stats WHERE chat_id = ?', (chat_id,))
+            cursor.execute('DELETE FROM message_embeddings WHERE chat_id = ?', (chat_id,))
+            cursor.execute('DELETE FROM chats WHERE chat_id = ?', (chat_id,))
+        self._write(operation, keys=(("chat", str(chat_id)), ("embeddings", str(chat_id))))
+        self.catalog.remove(chat_id)
 
     def rename_chat(self, chat_id, new_title):
-        cursor = self.conn.cursor()
-        cursor.execute('UPDATE chats SET title = ? WHERE chat_id = ?', (new_title, chat_id))
-        self.conn.commit()
+        def operation(cursor):
+            cursor.execute('UPDATE chats SET title = ? WHERE chat_id = ?', (new_title, chat_id))
+        self._write(operation)
+        self.catalog.rename(chat_id, new_title)
 
     def clear_chat_history(self, chat_id):
-        cursor = self.conn.cursor()
-        cursor.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
-        self.conn.commit()
+        def operation(cursor):
+            cursor.execute('DELETE FROM messages WHERE chat_id = ?', (chat_id,))
+            cursor.execute('DELETE FROM summaries WHERE chat_id = ?', (chat_id,))
+            cursor.execute('DELETE FROM message_stats WHERE chat_id = ?', (chat_id,))
+            cursor.execute('DELETE FROM message_embeddings WHERE chat_id = ?', (chat_id,))
+        self._write(operation, keys=(("chat", str(chat_id)), ("embeddings", str(chat_id))))
 
     def get_chat_history(self, chat_id, limit=20, offset=0):
+        self._wait_pending(("chat", str(chat_id)))
         try:
-            cursor = self.conn.cursor()
+            cursor = self._reader().cursor()
             cursor.execute('''
             SELECT role, content, timestamp 
             FROM messages 
             WHERE chat_id = ? 
-            ORDER BY timestamp DESC 
+            ORDER BY message_id DESC 
             LIMIT ? OFFSET ?
             ''', (chat_id, limit, offset))
             return cursor.fetchall()
@@ -84,157 +554,624 @@ class ChatDatabase:
             print(f"Неожиданная ошибка: {str(e)}")
             return []
 
-    def list_chats(self):
-        self.conn.row_factory = sqlite3.Row  # Устанавливаем row_factory
-        cursor = self.conn.cursor()
-        cursor.execute('''SELECT 
-            ROW_NUMBER() OVER (ORDER BY chat_id DESC) as "index",
-            chat_id, title,
-            created_at FROM chats ORDER BY created_at DESC''')
+    def iter_chat_history(self, chat_id, after_id=0, batch_size=32):
+        """
+        Лениво отдает сообщения чата (message_id, role, content, timestamp) от новых к старым,
+        только с message_id > after_id. Строки читаются пачками растущего размера.
+        """
+        self._wait_pending(("chat", str(chat_id)))
+        before_id = None
+        while True:
+            cursor = self._reader().cursor()
+            cursor.execute('''
+            SELECT message_id, role, content, timestamp
+            FROM messages
+            WHERE chat_id = ? AND message_id > ? AND message_id < coalesce(?, 9223372036854775807)
+            ORDER BY message_id DESC
+            LIMIT ?
+            ''', (chat_id, after_id, before_id, batch_size))
+            rows = cursor.fetchall()
+            yield from rows
+            if len(rows) < batch_size:
+                return
+            before_id = rows[-1][0]
+            batch_size = min(batch_size * 2, 1024)
+
+    @staticmethod
+    def _match_expression(query, chat_ids=None):
+        # Слова запроса ищутся как есть (все сразу) и только в тексте, без синтаксиса FTS5:
+        # кавычки, NEAR, OR и двоеточия в пользовательском тексте не ломают запрос. "слово*" - префикс
+        terms = re.findall(r'\w+\*?', query)
+        if not terms:
+            return None
+        match = "content : (" + " ".join(f'"{term.rstrip("*")}"' + ("*" if term.endswith("*") else "")
+                                         for term in terms) + ")"
+        if chat_ids is not None:
+            match = "chat_id : (" + " OR ".join(f'"{int(chat_id)}"' for chat_id in chat_ids) + f") AND {match}"
+        return match
 
-        # Возвращаем словари напрямую
-        return [dict(row) for row in cursor.fetchall()]
+    def search_messages(self, query, chat_id=None, limit=10, offset=0, chat_ids=None):
+        """
+        Полнотекстовый поиск по сообщениям: лучшие совпадения (bm25) первыми.
+        Оцениваются только SEARCH_WINDOW самых новых совпадений - для частых слов это
+        ограничивает время запроса, для остальных результат точный.
+        Возвращает словари message_id, chat_id, role, timestamp, snippet, где snippet -
+        фрагмент сообщения с совпадениями в [квадратных скобках].
+
+        :param chat_id: Искать только в этом чате (None - во всех)
+        :param limit: Размер страницы
+        :param offset: Сколько лучших совпадений пропустить
+        :param chat_ids: Искать только в этих чатах, например во всех чатах владельца
+        """
+        if chat_id is not None:
+            chat_ids = [chat_id]
+        if chat_ids is not None and not chat_ids:
+            return []
+        match = self._match_expression(query, chat_ids)
+        if match is None:
+            return []
+        for chat_id in chat_ids or ():
+            self._wait_pending(("chat", str(chat_id)))
+
+        cursor = self._reader().cursor()
+        # Сначала только идентификаторы: без сортировки всех совпадений и без фрагментов для каждого
+        cursor.execute('''
+        SELECT rowid FROM (
+            SELECT rowid, rank FROM messages_fts
+            WHERE messages_fts MATCH ?
+            ORDER BY rowid DESC
+            LIMIT ?
+        )
+        ORDER BY rank
+        LIMIT ? OFFSET ?
+        ''', (match, self.SEARCH_WINDOW, limit, offset))
+        message_ids = [row[0] for row in cursor.fetchall()]
+        if not message_ids:
+            return []
+
+        cursor.execute(f'''
+        SELECT m.message_id, m.chat_id, m.role, m.timestamp,
+               snippet(messages_fts, 0, '[', ']', '…', 16)
+        FROM messages_fts
+        JOIN messages m ON m.message_id = messages_fts.rowid
+        WHERE messages_fts MATCH ? AND messages_fts.rowid IN ({", ".join("?" * len(message_ids))})
+        ''', (match, *message_ids))
+        rows = {row[0]: row for row in cursor.fetchall()}
+        # Сообщение могли удалить между запросами - такие пропускаются
+        return [{"message_id": message_id, "chat_id": chat_id, "role": role, "timestamp": timestamp,
+                 "snippet": snippet}
+                for message_id, chat_id, role, timestamp, snippet in
+                (rows[message_id] for message_id in message_ids if message_id in rows)]
+
+    def get_messages(self, message_ids):
+        """Сообщения по идентификаторам: словарь message_id -> (role, content, timestamp)."""
+        message_ids = list(message_ids)
+        if not message_ids:
+            return {}
+        cursor = self._reader().cursor()
+        cursor.execute(f'''
+        SELECT message_id, role, content, timestamp
+        FROM messages
+        WHERE message_id IN ({", ".join("?" * len(message_ids))})
+        ''', message_ids)
+        return {message_id: (role, content, timestamp) for message_id, role, content, timestamp in cursor.fetchall()}
+
+    def get_unembedded_messages(self, chat_id, model, limit=32):
+        """Непустые сообщения чата без эмбеддинга модели model: [(message_id, content)], от старых к новым."""
+        self._wait_pending(("chat", str(chat_id)))
+        self._wait_pending(("embeddings", str(chat_id)))
+        cursor = self._reader().cursor()
+        cursor.execute('''
+        SELECT m.message_id, m.content
+        FROM messages m
+        LEFT JOIN message_embeddings e ON e.message_id = m.message_id AND e.model = ?
+        WHERE m.chat_id = ? AND e.message_id IS NULL AND coalesce(m.content, '') != ''
+        ORDER BY m.message_id
+        LIMIT ?
+        ''', (model, chat_id, limit))
+        return cursor.fetchall()
+
+    def save_embeddings(self, chat_id, model, vectors):
+        """
+        Сохраняет эмбеддинги сообщений чата.
+        :param vectors: Список (message_id, bytes) - векторы float32 в байтах
+        """
+        def operation(cursor):
+            cursor.executemany('''
+            INSERT OR REPLACE INTO message_embeddings (message_id, chat_id, model, vector)
+            VALUES (?, ?, ?, ?)
+            ''', [(message_id, chat_id, model, vector) for message_id, vector in vectors])
+        self._write(operation, keys=(("embeddings", str(chat_id)),))
+
+    def load_embeddings(self, chat_id, model):
+        """Все эмбеддинги чата для модели model: [(message_id, bytes)] по возрастанию message_id."""
+        self._wait_pending(("embeddings", str(chat_id)))
+        cursor = self._reader().cursor()
+        cursor.execute('''
+        SELECT message_id, vector
+        FROM message_embeddings
+        WHERE chat_id = ? AND model = ?
+        ORDER BY message_id
+        ''', (chat_id, model))
+        return cursor.fetchall()
+
+    def clear_embeddings(self, chat_id):
+        def operation(cursor):
+            cursor.execute('DELETE FROM message_embeddings WHERE chat_id = ?', (chat_id,))
+        self._write(operation, keys=(("embeddings", str(chat_id)),))
+
+    def add_summary(self, chat_id, content, last_message_id):
+        def operation(cursor):
+            cursor.execute('''
+            INSERT INTO summaries (chat_id, content, last_message_id)
+            VALUES (?, ?, ?)
+            ''', (chat_id, content, last_message_id))
+            return cursor.lastrowid
+        return self._write(operation, keys=(("chat", str(chat_id)),))
+
+    def get_latest_summary(self, chat_id):
+        """Последнее резюме чата: (content, last_message_id) или None."""
+        self._wait_pending(("chat", str(chat_id)))
+        cursor = self._reader().cursor()
+        cursor.execute('''
+        SELECT content, last_message_id
+        FROM summaries
+        WHERE chat_id = ?
+        ORDER BY summary_id DESC
+        LIMIT 1
+        ''', (chat_id,))
+        return cursor.fetchone()
+
+    def get_last_message_id(self, chat_id):
+        self._wait_pending(("chat", str(chat_id)))
+        cursor = self._reader().cursor()
+        cursor.execute('''
+        SELECT message_id
+        FROM messages
+        WHERE chat_id = ?
+        ORDER BY message_id DESC
+        LIMIT 1
+        ''', (chat_id,))
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def list_chats(self, limit=None, cursor=None, user_id=None):
+        """
+        Чаты владельца от новых к старым из каталога в памяти, без запроса к базе.
+        :param limit: Размер страницы (None - все чаты)
+        :param cursor: chat_id последнего чата предыдущей страницы
+        :param user_id: Владелец чатов (None - чаты консоли)
+        """
+        return self.catalog.page(limit, cursor, user_id=user_id)
+
+    def get_latest_chat_id(self, user_id=None):
+        return self.catalog.latest(user_id)
 
     def get_message_count(self, chat_id):
-        cursor = self.conn.cursor()
+        self._wait_pending(("chat", str(chat_id)))
+        cursor = self._reader().cursor()
         cursor.execute('SELECT COUNT(*) FROM messages WHERE chat_id = ?', (chat_id,))
         return cursor.fetchone()[0]
 
     def get_last_activity(self, chat_id):
-        cursor = self.conn.cursor()
+        self._wait_pending(("chat", str(chat_id)))
+        cursor = self._reader().cursor()
         cursor.execute('''
-        SELECT MAX(timestamp) 
+        SELECT timestamp 
         FROM messages 
         WHERE chat_id = ?
+        ORDER BY message_id DESC
+        LIMIT 1
         ''', (chat_id,))
-        return cursor.fetchone()[0]
+        row = cursor.fetchone()
+        return row[0] if row else None
+
+    def load_session(self, user_id):
+        self._wait_pending(("session", user_id))
+        cursor = self._reader().cursor()
+        cursor.execute('''
+        SELECT chat_id, mode, user_level, exercise
+        FROM telegram_sessions
+        WHERE user_id = ?
+        ''', (user_id,))
+        row = cursor.fetchone()
+        if row is None:
+            return None
+
+        chat_id, mode, user_level, exercise = row
+        return {
+            "chat_id": chat_id,
+            "mode": mode,
+            "user_level": user_level,
+            "exercise": json.loads(exercise) if exercise else None
+        }
+
+    def save_session(self, user_id, chat_id, mode, user_level, exercise):
+        exercise = json.dumps(exercise, ensure_ascii=False) if exercise else None
+
+        def operation(cursor):
+            cursor.execute('''
+            INSERT INTO telegram_sessions (user_id, chat_id, mode, user_level, exercise, updated_at)
+            VALUES (?, ?, ?, ?, ?, datetime('now', 'localtime'))
+            ON CONFLICT(user_id) DO UPDATE SET
+                chat_id = excluded.chat_id,
+                mode = excluded.mode,
+                user_level = excluded.user_level,
+                exercise = excluded.exercise,
+                updated_at = excluded.updated_at
+            ''', (user_id, chat_id, mode, user_level, exercise))
+        self._write(operation, keys=(("session", user_id),))
+
+    def load_tool_result(self, key, now):
+        """Сохраненный результат инструмента: (value, expires_at) или None, если его нет или он истек."""
+        self._wait_pending(("tool", key))
+        cursor = self._reader().cursor()
+        cursor.execute('SELECT value, expires_at FROM tool_cache WHERE key = ? AND expires_at > ?', (key, now))
+        return cursor.fetchone()
+
+    def save_tool_result(self, key, value, expires_at):
+        def operation(cursor):
+            cursor.execute('''
+            INSERT INTO tool_cache (key, value, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(key) DO UPDATE SET value = excluded.value, expires_at = excluded.expires_at
+            ''', (key, value, expires_at))
+            # Заодно убираем истекшие записи - по индексу это дешево
+            cursor.execute('DELETE FROM tool_cache WHERE expires_at <= ?', (time.time(),))
+        self._write(operation, keys=(("tool", key),))
+
+    def add_exercise(self, ex_type, user_level, content, seen_by=None, max_per_key=None):
+        """
+        Добавляет упражнение в пул. seen_by - пользователь, которому оно уже показано.
+        max_per_key - сколько упражнений ключа (ex_type, user_level) хранить: лишними
+        считаются самые использованные и старые.
+        """
+        def operation(cursor):
+            cursor.execute('''
+            INSERT INTO exercise_pool (ex_type, user_level, content, uses) VALUES (?, ?, ?, ?)
+            ''', (ex_type, user_level, content, 0 if seen_by is None else 1))
+            exercise_id = cursor.lastrowid
+            if seen_by is not None:
+                cursor.execute('INSERT INTO exercise_seen (user_id, exercise_id) VALUES (?, ?)',
+                               (seen_by, exercise_id))
+            if max_per_key is not None:
+                cursor.execute('''
+                SELECT exercise_id FROM exercise_pool
+                WHERE ex_type = ? AND user_level = ?
+                ORDER BY uses DESC, exercise_id
+                LIMIT max(0, (SELECT COUNT(*) FROM exercise_pool WHERE ex_type = ? AND user_level = ?) - ?)
+                ''', (ex_type, user_level, ex_type, user_level, max_per_key))
+                stale = cursor.fetchall()
+                cursor.executemany('DELETE FROM exercise_seen WHERE exercise_id = ?', stale)
+                cursor.executemany('DELETE FROM exercise_pool WHERE exercise_id = ?', stale)
+            return exercise_id
+        return self._write(operation, keys=(("exercise_pool",),), wait=True)
+
+    def take_exercise(self, user_id, ex_type, user_level):
+        """
+        Выдает пользователю упражнение ключа, которое он еще не видел (сначала - ни разу
+        не выданные), и отмечает его просмотренным. Возвращает content или None.
+        """
+        def operation(cursor):
+            cursor.execute('''
+            SELECT exercise_id, content FROM exercise_pool p
+            WHERE ex_type = ? AND user_level = ?
+              AND NOT EXISTS (SELECT 1 FROM exercise_seen s WHERE s.user_id = ? AND s.exercise_id = p.exercise_id)
+            ORDER BY uses, exercise_id
+            LIMIT 1
+            ''', (ex_type, user_level, user_id))
+            row = cursor.fetchone()
+            if row is None:
+                return None
+            exercise_id, content = row
+            cursor.execute('INSERT INTO exercise_seen (user_id, exercise_id) VALUES (?, ?)', (user_id, exercise_id))
+            cursor.execute('UPDATE exercise_pool SET uses = uses + 1 WHERE exercise_id = ?', (exercise_id,))
+            return content
+        # Выбор и отметка - одна транзакция: два запроса пользователя не получат одно упражнение
+        return self._write(operation, keys=(("exercise_pool",),), wait=True)
+
+    def count_fresh_exercises(self):
+        """Сколько еще ни разу не выданных упражнений в пуле: {(ex_type, user_level): число}."""
+        self._wait_pending(("exercise_pool",))
+        cursor = self._reader().cursor()
+        cursor.execute('''
+        SELECT ex_type, user_level, COUNT(*) FROM exercise_pool WHERE uses = 0 GROUP BY ex_type, user_level
+        ''')
+        return {(ex_type, user_level): count for ex_type, user_level, count in cursor.fetchall()}
 
     @staticmethod
     def generator_to_string(generator):
         return ''.join(str(item) for item in generator)
 
     def close(self):
+        if self.writer is not None:
+            with self.pending_changed:
+                if self.closed:
+                    return
+                self.closed = True
+                self.write_queue.put(None)
+            self.writer.join()
+            # Записи, оставшиеся в очереди (если писатель завершился с ошибкой), не должны ждать вечно
+            leftover = []
+            while True:
+                try:
+                    item = self.write_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    leftover.append(item)
+            error = sqlite3.ProgrammingError("База данных закрыта")
+            self._finish_batch(leftover, [(None, error)] * len(leftover))
+        else:
+            with self.write_lock:
+                if self.closed:
+                    return
+                self.closed = True
+        with self.readers_lock:
+            for conn in self.readers:
+                conn.close()
+            self.readers.clear()
         self.conn.close()
 
 
 class OllamaChat:
-    def __init__(self, model="llama3.1:latest", base_url="http://localhost:11434"):
+    def __init__(self, model="llama3.1:latest", base_url="http://localhost:11434", transport=None, db=None,
+                 chat_id=None, context=None, context_tokens=3072, compressor=None, keep_alive=None,
+                 metrics=None, user_id=None):
         self.model = model
         self.base_url = base_url
-        self.db = ChatDatabase()
-        self.current_chat_id = None
-        self.current_chat_id = self.get_current_chat_id()
-
-    def __getattribute__(self, name):
-        val = super().__getattribute__(name)
-        if name == "current_chat_id" and val is None:
-            val = self.get_current_chat_id()
-        return val
+        # Транспорт и базу можно передать снаружи, чтобы несколько чатов делили один пул соединений.
+        # Закрываем при close() только то, что создали сами
+        self._owns_transport = transport is None
+        self._owns_db = db is None
+        self.transport = transport or HttpTransport()
+        self.db = db or ChatDatabase()
+        # Контекст собирается по бюджету токенов; ContextBuilder можно разделять между чатами
+        self.context = context or ContextBuilder(self.db, token_budget=context_tokens)
+        # HistoryCompressor для автоматического сжатия длинных чатов (None - только по команде)
+        self.compressor = compressor
+        # Сколько модель держится в памяти сервера после запроса ("30m", -1 - всегда); None - по умолчанию Ollama
+        self.keep_alive = keep_alive
+        # Телеметрия запросов; по умолчанию - общий реестр процесса
+        self.metrics = metrics or default_metrics
+        # Владелец чатов (ID пользователя Telegram; None - консоль): остальные чаты базы ему не видны
+        self.user_id = user_id
+        # Если чат не указан, последний чат владельца определяется при первом обращении к current_chat_id
+        self._current_chat_id = chat_id
+
+    @property
+    def current_chat_id(self):
+        if self._current_chat_id is None:
+            self._current_chat_id = self.get_current_chat_id()
+        return self._current_chat_id
+
+    @current_chat_id.setter
+    def current_chat_id(self, value):
+        self._current_chat_id = value
+
+    def invalidate_current_chat(self):
+        """Сбрасывает выбранный чат: при следующем обращении будет выбран последний чат владельца."""
+        self._current_chat_id = None
 
     def start_new_chat(self, title=None):
-        if not self.list_chats():
-            title = "Новый чат"
+        chat_count = len(self.list_chats())
         if title is None:
-            title = f"Чат {int(self.list_chats()[0]['chat_id']) + 1}"
-        self.current_chat_id = self.db.create_chat(title)
+            title = f"Чат {chat_count + 1}" if chat_count else "Новый чат"
+        self.current_chat_id = self.db.create_chat(title, user_id=self.user_id)
         return self.current_chat_id
 
     def delete_chat(self, chat_id):
         self.db.delete_chat(chat_id)
-        if self.current_chat_id == chat_id:
-            self.current_chat_id = None
+        # ID из команды приходит строкой
+        if str(self._current_chat_id) == str(chat_id):
+            self.invalidate_current_chat()
 
     def rename_chat(self, chat_id, new_title):
         self.db.rename_chat(chat_id, new_title)
 
-    def send_message(self, message, stream=False, chat_id=None, system_prompt=None, limit=20, temperature=0.8):
-        # Общая логика для обоих режимов (stream и non-stream)
+    def send_message(self, message, stream=False, chat_id=None, system_prompt=None, limit=None, temperature=0.8):
+        chat_id, payload, turn = self._prepare_request(message, stream, chat_id, system_prompt, limit, temperature)
+        response = self._post_chat(payload, turn)
+
+        if stream:
+            return self._stream_response(chat_id, response, turn)
+        else:
+            return self._non_stream_response(chat_id, response, turn)
+
+    def _prepare_request(self, message, stream, chat_id, system_prompt, limit, temperature, recall=True):
+        # Общая логика для обоих режимов (stream и non-stream), а также для AsyncOllamaChat
         if chat_id is None:
             if self.current_chat_id is None:
                 self.start_new_chat()
             chat_id = self.current_chat_id
 
+        # turn - телеметрия одного хода; замеры клиента в секундах
+        started = time.perf_counter()
         self.db.add_message(chat_id, 'user', message)
-        messages = self.get_chat_history(chat_id, limit)
-
-        if system_prompt:
-            messages.insert(0, {"role": "system", "content": system_prompt})
-
-        response = requests.post(
-            f"{self.base_url}/api/chat",
-            json={
-                "model": self.model,
-                "messages": messages,
-                "options": {"temperature": temperature},
-                "stream": stream
-            },
-            stream=stream
-        )
+        written = time.perf_counter()
+        messages = self.context.build(chat_id, system_prompt=system_prompt, limit=limit, recall=recall)
+        built = time.perf_counter()
+
+        payload = self._payload(messages, temperature, stream)
+        turn = {
+            "chat_id": chat_id,
+            "prompt_messages": len(messages),
+            "prompt_tokens": sum(self.context.tokenizer(m["content"]) for m in messages),
+            "user_write": written - started,
+            "history": built - written
+        }
+        turn["build"] = time.perf_counter() - built
+        return chat_id, payload, turn
+
+    def _post_chat(self, payload, turn):
+        turn["sent_at"] = time.perf_counter()
+        response = self.transport.post(f"{self.base_url}/api/chat", json=payload, stream=payload["stream"])
+
+        if response.status_code != 200:
+            raise Exception(f"Ошибка API: {response.status_code} - {response.text}")
+        return response
+
+    def _payload(self, messages, temperature, stream):
+        payload = {
+            "model": self.model,
+            "messages": messages,
+            "options": {"temperature": temperature},
+            "stream": stream
+        }
+        if self.keep_alive is not None:
+            payload["keep_alive"] = self.keep_alive
+        return payload
+
+    def complete(self, messages, temperature=0.8, stream=False):
+        """
+        Запрос к модели с готовым списком сообщений, без записи в историю чата.
+        При stream=True возвращает генератор фрагментов; его закрытие останавливает генерацию.
+        """
+        response = self.transport.post(f"{self.base_url}/api/chat", json=self._payload(messages, temperature, stream),
+                                       stream=stream)
 
         if response.status_code != 200:
             raise Exception(f"Ошибка API: {response.status_code} - {response.text}")
 
         if stream:
-            return self._stream_response(chat_id, response)
-        else:
-            return self._non_stream_response(chat_id, response)
+            return self._stream_completion(response)
+        return response.json()['message']['content']
 
-    def _stream_response(self, chat_id, response):
+    def _stream_completion(self, response):
+        try:
+            for line in response.iter_lines():
+                if line:
+                    content, _ = self._parse_chunk(line.decode('utf-8'))
+                    if content:
+                        yield content
+        finally:
+            response.close()
+
+    def _after_reply(self, chat_id):
+        if self.compressor is not None:
+            self.compressor.schedule(chat_id)
+        # Новые сообщения попадают в семантическую память в фоне
+        if self.context.memory is not None:
+            self.context.memory.schedule(chat_id)
+
+    def _mark_first_token(self, turn):
+        if "ttft" not in turn:
+            turn["ttft"] = time.perf_counter() - turn["sent_at"]
+
+    def _record_turn(self, turn, data):
+        """
+        Дополняет turn итоговыми счетчиками Ollama (ответ без потока или последний чанк
+        потока с done=true), учитывает его в метриках и возвращает строку для message_stats.
+        """
+        for key in OLLAMA_COUNTS + OLLAMA_DURATIONS:
+            turn[key] = data.get(key)
+        turn["response"] = time.perf_counter() - turn["sent_at"]
+        self._mark_first_token(turn)
+        self.metrics.record_turn(turn, self.model)
 
-        assistant_msg = ""
-        for line in response.iter_lines():
-            if line:
-                chunk = json.loads(line.decode('utf-8'))
-                if 'message' in chunk and 'content' in chunk['message']:
-                    content = chunk['message']['content']
-                    assistant_msg += content
-                    yield content
+        stats = dict(turn, model=self.model)
+        for key in CLIENT_TIMINGS:
+            stats[f"{key}_ms"] = turn[key] * 1000
+        return stats
 
-        self.db.add_message(chat_id, 'assistant', assistant_msg)
+    @staticmethod
+    def _parse_chunk(line):
+        # Возвращает текст из строки потокового ответа Ollama (или None) и сам чанк
+        chunk = json.loads(line)
+        if 'message' in chunk and 'content' in chunk['message']:
+            return chunk['message']['content'], chunk
+        return None, chunk
 
-    def _non_stream_response(self, chat_id, response):
+    @staticmethod
+    def _collect_tool_calls(turn, message):
+        # Вызовы инструментов в нативном режиме Ollama (запрос с "tools")
+        tool_calls = message.get('tool_calls')
+        if tool_calls:
+            turn.setdefault("tool_calls", []).extend(tool_calls)
+
+    def _reply_text(self, assistant_msg, turn):
+        """Текст ответа, который сохраняется в истории; наследники дописывают в него вызовы инструментов."""
+        return assistant_msg
+
+    def _stream_response(self, chat_id, response, turn):
+
+        assistant_msg = ""
+        stats = None
+        # Если потребитель закроет генератор досрочно, в finally сохраняется уже полученная
+        # часть ответа, а закрытое соединение останавливает генерацию на сервере
+        try:
+            for line in response.iter_lines():
+                if line:
+                    content, chunk = self._parse_chunk(line.decode('utf-8'))
+                    if content:
+                        self._mark_first_token(turn)
+                    self._collect_tool_calls(turn, chunk.get('message', {}))
+                    if content is not None:
+                        assistant_msg += content
+                        yield content
+                    if chunk.get('done'):
+                        stats = self._record_turn(turn, chunk)
+        finally:
+            response.close()
+            self.db.add_message(chat_id, 'assistant', self._reply_text(assistant_msg, turn), stats=stats)
+            self._after_reply(chat_id)
+
+    def _non_stream_response(self, chat_id, response, turn):
         response_data = response.json()
         assistant_msg = response_data['message']['content']
-        self.db.add_message(chat_id, 'assistant', assistant_msg)
+        self._collect_tool_calls(turn, response_data['message'])
+        stats = self._record_turn(turn, response_data)
+        self.db.add_message(chat_id, 'assistant', self._reply_text(assistant_msg, turn), stats=stats)
+        self._after_reply(chat_id)
         return assistant_msg
 
-    def list_chats(self):
-        return self.db.list_chats()
+    def list_chats(self, limit=None, cursor=None):
+        return self.db.list_chats(limit, cursor, user_id=self.user_id)
 
     def load_chat(self, chat_id):
         self.current_chat_id = chat_id
         return self.db.get_chat_history(chat_id)
 
     def find_chat_name(self, **criteria):
-        for chat in self.list_chats():
-            if all(
-                    str(chat.get(k)) == str(v)
-                    for k, v in criteria.items()
-                    if v is not None
-            ):
-                return chat['title']
-        return None
+        chat = self.db.catalog.find(user_id=self.user_id, **criteria)
+        return chat['title'] if chat else None
 
-    def get_chat_history(self, chat_id, limit=20):
-        # Получаем историю чата для контекста
-        history = self.db.get_chat_history(chat_id, limit=limit)
+    def search_history(self, query, limit=10, offset=0, everywhere=False):
+        """Поиск по текущему чату или (everywhere) по всем чатам владельца - чужие чаты не затрагиваются."""
+        if everywhere:
+            chat_ids = [chat["chat_id"] for chat in self.list_chats()]
+        else:
+            chat_ids = [self.current_chat_id] if self.current_chat_id is not None else []
+        return self.db.search_messages(query, limit=limit, offset=offset, chat_ids=chat_ids)
 
-        # Формируем сообщения для Ollama API
-        return [{"role": "user" if role == "user" else "assistant", "content": content}
-                    for role, content, _ in reversed(history)]
+    def get_chat_history(self, chat_id, limit=None):
+        # История для Ollama API: резюме и последние сообщения в пределах бюджета токенов
+        return self.context.build(chat_id, limit=limit)
 
     def get_current_chat_id(self):
-        list_chats = self.list_chats()
-        if list_chats:
-            return list_chats[0]['chat_id']
-        else:
-            return None
+        return self.db.get_latest_chat_id(self.user_id)
 
     def close(self):
-        self.db.close()
+        if self._owns_db:
+            self.db.close()
+        if self._owns_transport:
+            self.transport.close()
 
 
 class ChatManager(OllamaChat):
+    # Результатов поиска на одной странице /search
+    SEARCH_PAGE_SIZE = 5
+
+    def record_exchange(self, prompt, reply):
+        """
+        Записывает в текущий чат запрос и готовый ответ, полученный без модели (например, из пула
+        упражнений), так же, как ответ модели: дальнейший разговор видит оба сообщения.
+        """
+        chat_id = self.current_chat_id
+        self.db.add_message(chat_id, 'user', prompt)
+        self.db.add_message(chat_id, 'assistant', reply)
+        self._after_reply(chat_id)
+        return chat_id
+
     def print_all_chats(self):
         chat_list = self.list_chats()
         if not chat_list:
@@ -251,11 +1188,12 @@ class ChatManager(OllamaChat):
         self.print_all_chats()
 
         # Создаем новый чат или используем существующий
-        if not self.list_chats():
+        latest_chat_id = self.get_current_chat_id()
+        if latest_chat_id is None:
             self.start_new_chat()
             print("Создан новый чат")
         else:
-            self.current_chat_id = self.list_chats()[0]["chat_id"]
+            self.current_chat_id = latest_chat_id
             print(f"Используем существующий чат ID: {self.current_chat_id}")
 
     def do_command(self, command: str):
@@ -266,7 +1204,10 @@ class ChatManager(OllamaChat):
         else:
             command_text = ""
 
-        if "/show" in command:
+        # Запрос поиска - произвольный текст, он может содержать имена других команд
+        if words and words[0] == "/search":
+            self._handle_search_command(words[1:])
+        elif "/show" in command:
             self._handle_show_command()
         elif "/delete" in command:
             self._handle_delete_command(command_text)
@@ -280,6 +1221,8 @@ class ChatManager(OllamaChat):
             self._handle_rename_command(command_text, command)
         elif "/compress" in command:
             self._handle_compress_command(command_text)
+        elif "/reindex" in command:
+            self._handle_reindex_command(command_text)
         elif "/help" in command or "/?" in command:
             print(
                 "\nДоступные команды:\n"
@@ -290,7 +1233,9 @@ class ChatManager(OllamaChat):
                 "/delete [ID] - удалить конкретный чат или все чаты\n"
                 "/rename [ID] <новое_имя> - изменить имя текущего или указанного чата\n"
                 "/compress [ID] - сжать историю чата с помощью ИИ (текущего или указанного)\n"
-                "/history [N/-d] - показать историю сообщений (N последних или всю), -d - удалить историю"
+                "/history [N/-d] - показать историю сообщений (N последних или всю), -d - удалить историю\n"
+                "/reindex [ID] - заново построить семантическую память чата (текущего или указанного)\n"
+                "/search [-a] [-p N] <запрос> - поиск по истории текущего чата (-a - по всем чатам, -p - страница)"
             )
 
         elif "/try" in command:
@@ -312,8 +1257,8 @@ class ChatManager(OllamaChat):
             self.delete_chat(command_text)
             print(f'Чат "{chat_name}" удален!')
 
-            # Если удаляем текущий чат, создаем новый автоматически
-            if self.current_chat_id == command_text:
+            # Если удаляем текущий чат (delete_chat сбросил выбор), создаем новый автоматически
+            if self._current_chat_id is None:
                 self.start_new_chat()
                 new_chat_name = self.find_chat_name(chat_id=self.current_chat_id)
                 print(f"Автоматически создан новый чат: {new_chat_name}")
@@ -382,6 +1327,43 @@ class ChatManager(OllamaChat):
         for message in messages:
             print(f"{message['role']}: {message['content']}")
 
+    def _handle_search_command(self, words):
+        everywhere = False
+        page = 1
+        while words and words[0] in ("-a", "-p"):
+            if words[0] == "-a":
+                everywhere = True
+                words = words[1:]
+            elif len(words) > 1 and words[1].isdigit() and int(words[1]) > 0:
+                page = int(words[1])
+                words = words[2:]
+            else:
+                print("Номер страницы должен быть положительным числом")
+                return
+
+        query = " ".join(words)
+        if not query:
+            print("Укажите, что искать: /search [-a] [-p N] <запрос>")
+            return
+
+        # Лишняя строка показывает, есть ли следующая страница
+        hits = self.search_history(query, limit=self.SEARCH_PAGE_SIZE + 1,
+                                   offset=(page - 1) * self.SEARCH_PAGE_SIZE, everywhere=everywhere)
+        if not hits:
+            print("Ничего не найдено" if page == 1 else "На этой странице результатов нет")
+            return
+
+        where = "во всех чатах" if everywhere else "в текущем чате"
+        lines = [f"Результаты поиска {where} (страница {page}):"]
+        for number, hit in enumerate(hits[:self.SEARCH_PAGE_SIZE], start=(page - 1) * self.SEARCH_PAGE_SIZE + 1):
+            chat = f' (ID-{hit["chat_id"]}) "{self.find_chat_name(chat_id=hit["chat_id"])}"' if everywhere else ""
+            lines.append(f"{number}.{chat} {hit['timestamp']} {hit['role']}: {hit['snippet']}")
+        if len(hits) > self.SEARCH_PAGE_SIZE:
+            flags = "-a " if everywhere else ""
+            lines.append(f"Следующая страница: /search {flags}-p {page + 1} {query}")
+        # Одним print: в Telegram это одно сообщение, а не по сообщению на строку
+        print("\n".join(lines))
+
     def _handle_rename_command(self, command_text: str, full_command: str):
         if not command_text:
             print("Укажите новое имя чата")
@@ -433,64 +1415,42 @@ class ChatManager(OllamaChat):
 
         print(f"Начато сжатие истории чата '{chat_name}'...")
 
-        system_prompt = """
-Ты — ассистент, который превращает переписку в связный и сжатый конспект.
-
-Формат вывода:
-Наша история чата выглядит следующим образом...
-[Краткий связный текст на русском]
-
-Требования:
-• Преобразуй диалог в связный рассказ  
-• Сохрани:
-  – Главные вопросы и решения  
-  – Технические детали (код, ошибки, команды)  
-  – Изменения контекста  
-  - Информацию о пользователе
-• Удали:  
-  – Повторы  
-  – Приветствия/прощания  
-  – Несущественные уточнения  
-
-Стиль:
-• Четкий, деловой  
-• Используй `обратные кавычки` для кода  
-• Маркеры • для списков  
-• Без интерпретаций и домыслов  
-
-Примечания:
-• Для технических тем — точно сохраняй команды и ошибки  
-• Для творческих — фиксируй ключевые идеи  
-• При потере контекста — добавь [пояснение]
-
-Пример:
-assistant: Наша история чата выглядит следующим образом...  
-Пользователь спрашивал о Python.  
-• Предложили Pandas для CSV (`pd.read_csv()`)  
-• Обнаружили проблему кодировки — исправили `encoding='utf-8'`
-        """
-
         try:
-            # Получаем историю сообщений
-            history = self.get_chat_history(chat_id)
-
-            if not history:
+            # Вся горячая история сворачивается в резюме, построенное из предыдущего;
+            # сообщения остаются в базе, но в контекст больше не попадают
+            compressor = self.compressor or HistoryCompressor(self)
+            if not compressor.compress(chat_id, force=True):
                 print("История чата пуста")
                 return
 
-            # Вызываем нейросеть для сжатия
-            compressed_history = self.send_message(message=None,
-                                                   chat_id=chat_id, system_prompt=system_prompt, temperature=0.7)
-
-            # Заменяем историю на сжатую версию
-            self.db.clear_chat_history(chat_id=self.current_chat_id)
-            self.db.add_message(chat_id, 'assistant', compressed_history)
-
             print(f"История чата успешно сжата!")
 
         except Exception as e:
             print(f"Ошибка при сжатии истории: {str(e)}")
 
+    def _handle_reindex_command(self, command_text: str):
+        memory = self.context.memory
+        if memory is None:
+            print("Семантическая память не подключена")
+            return
+
+        if not command_text:
+            chat_id = self.current_chat_id
+        elif command_text.isdigit():
+            chat_id = command_text
+        else:
+            print("Неправильный параметр - ID чата должен быть числом")
+            return
+
+        chat_name = self.find_chat_name(chat_id=chat_id)
+        if not chat_name:
+            print("Чат с таким ID не найден")
+            return
+
+        # Векторы удаляются сразу, сообщения индексируются заново в фоне
+        memory.rebuild(chat_id)
+        print(f"Семантическая память чата '{chat_name}' перестраивается")
+
 
 # Пример использования
 if __name__ == "__main__":
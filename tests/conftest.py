@@ -0,0 +1,86 @@
+import json
+import sys
+import threading
+import types
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+if str(ROOT) not in sys.path:
+    sys.path.insert(0, str(ROOT))
+
+# API.py с ключами не хранится в репозитории; без ключей модули импортируются, а внешние сервисы отключены
+try:
+    import API  # noqa: F401
+except ImportError:
+    API = types.ModuleType("API")
+    API.API_bot = None
+    API.Key_google = None
+    API.Search_ID = None
+    sys.modules["API"] = API
+
+
+class LocalServer:
+    """
+    HTTP-сервер на свободном порту вместо внешнего API.
+    handler(method, path, query, body) возвращает (status, content_type, body); body - str, bytes
+    или объект для JSON. Все запросы записываются в requests.
+    """
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _handle(self):
+                url = urlparse(self.path)
+                query = {key: values[-1] for key, values in parse_qs(url.query).items()}
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length)) if length else None
+                server.requests.append((self.command, url.path, query, body))
+
+                status, content_type, content = server.handler(self.command, url.path, query, body)
+                if not isinstance(content, (str, bytes)):
+                    content = json.dumps(content)
+                if isinstance(content, str):
+                    content = content.encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            do_GET = do_POST = _handle
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+
+    def paths(self, path):
+        return [request for request in self.requests if request[1] == path]
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+@pytest.fixture
+def local_server():
+    servers = []
+
+    def start(handler):
+        server = LocalServer(handler)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.close()
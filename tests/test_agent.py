@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from Scripts.agent import Agent
+from Scripts.main import ChatDatabase
+
+
+def stream_body(reply, size=7):
+    """Потоковый ответ /api/chat: текст фрагментами по size символов (или готовое сообщение) и итоговая строка."""
+    if isinstance(reply, dict):
+        chunks = [{"message": reply, "done": False}]
+    else:
+        chunks = [{"message": {"role": "assistant", "content": reply[i:i + size]}, "done": False}
+                  for i in range(0, len(reply), size)]
+    chunks.append({"message": {"role": "assistant", "content": ""}, "done": True,
+                   "prompt_eval_count": 10, "eval_count": 5})
+    return "\n".join(json.dumps(chunk) for chunk in chunks) + "\n"
+
+
+@pytest.fixture
+def agent(local_server, tmp_path):
+    """Agent против локального /api/chat: ответы модели берутся по очереди из agent.replies."""
+    replies = []
+
+    def handler(method, path, query, body):
+        return 200, "application/x-ndjson", stream_body(replies.pop(0))
+
+    server = local_server(handler)
+    db = ChatDatabase(str(tmp_path / "chat.db"))
+    agent = Agent(base_url=server.url, db=db, tool_mode="text")
+    agent.replies = replies
+    agent.calls = []
+    agent.register_tool("get_weather", "Weather", {"type": "object", "properties": {}},
+                        lambda **arguments: agent.calls.append(arguments) or {"temperature": 20})
+    agent.start_new_chat("test")
+    yield agent
+    agent.tools.shutdown()
+    db.close()
+
+
+def test_prefix_in_prose_is_shown_in_full(agent):
+    reply = "Use the TOOL: prefix to call things, e.g. for weather. Anything else?"
+    agent.replies.append(reply)
+
+    assert agent.chat("how do tools work?") == reply
+    assert agent.calls == []
+
+
+def test_tool_name_at_end_of_stream_is_called_without_arguments(agent):
+    agent.replies.extend(["TOOL: get_weather", "Sunny, 20 degrees"])
+
+    assert agent.chat("weather?") == "Sunny, 20 degrees"
+    assert agent.calls == [{}]
+
+
+def test_unknown_native_tool_reports_error(agent):
+    agent.tool_mode = "native"
+    agent.replies.append({"role": "assistant", "content": "",
+                          "tool_calls": [{"function": {"name": "nope", "arguments": {}}}]})
+
+    answer = agent.chat("do something")
+
+    assert answer.startswith("Error calling tool nope:")
+    assert agent.calls == []
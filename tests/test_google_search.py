@@ -0,0 +1,101 @@
+import pytest
+
+from Scripts.ToolCache import ToolCache
+from Scripts.agent import GoogleAPISearch
+
+PAGE_TEXT = " ".join(f"слово{i}" for i in range(500))
+
+
+@pytest.fixture
+def google(local_server):
+    """Custom Search и найденные страницы на локальном сервере; state задает размер выдачи и ошибки."""
+    state = {"total": 23, "fail": False}
+
+    def handler(method, path, query, body):
+        if path == "/customsearch/v1":
+            if state["fail"]:
+                return 500, "application/json", {"error": {"code": 500, "message": "backend error"}}
+            start, num = int(query["start"]), int(query["num"])
+            items = [{"title": f"Result {i}", "link": f"{server.url}/page/{i}", "snippet": f"snippet {i}"}
+                     for i in range(start, min(start + num, state["total"] + 1))]
+            return 200, "application/json", {"items": items}
+        if path == "/page/1":
+            return 200, "text/html; charset=utf-8", f"<html><head><title>t</title></head><body>" \
+                                                    f"<script>var hidden = 1;</script><p>{PAGE_TEXT}</p></body></html>"
+        if path == "/page/2":
+            return 200, "application/pdf", b"%PDF-1.4"
+        return 404, "text/plain", "not found"
+
+    server = local_server(handler)
+    search = GoogleAPISearch("key", "engine", cache=ToolCache(), api_endpoint=server.url)
+    yield search, server, state
+    search.close()
+
+
+def test_pages_are_requested_by_start(google):
+    search, server, _ = google
+
+    results = search.search("python", num_results=23)
+
+    assert [result["title"] for result in results] == [f"Result {i}" for i in range(1, 24)]
+    pages = sorted((int(query["start"]), int(query["num"])) for _, _, query, _ in server.paths("/customsearch/v1"))
+    assert pages == [(1, 10), (11, 10), (21, 3)]
+    assert results[0]["domain"] == server.url.split("//")[1]
+
+
+def test_short_listing_stops_pagination(google):
+    search, _, state = google
+    state["total"] = 15
+
+    results = search.search("python", num_results=30)
+
+    assert len(results) == 15
+
+
+def test_repeated_query_is_served_from_cache(google):
+    search, server, _ = google
+
+    first = search.search("Python  Tips", num_results=3)
+    second = search.search("python tips", num_results=3)
+
+    assert first == second
+    assert len(server.paths("/customsearch/v1")) == 1
+    assert search.cache.hits == 1
+
+
+def test_fetch_pages_truncates_text_to_budget(google):
+    search, _, _ = google
+
+    results = search.search("python", num_results=3, fetch_pages=3, text_tokens=60)
+
+    # Бюджет делится между страницами: 20 токенов - около 80 байт текста
+    text = results[0]["text"]
+    assert text.startswith("слово0 слово1")
+    assert "hidden" not in text
+    assert text.endswith("…")
+    assert len(text[:-1].encode("utf-8")) <= 80
+    assert results[1]["text"] == "[страница не в формате HTML]"
+    assert results[2]["text"].startswith("[не удалось загрузить страницу:")
+
+
+def test_api_error_returns_no_results_and_is_not_cached(google, capsys):
+    search, server, state = google
+    state["fail"] = True
+
+    assert search.search("python", num_results=3) == []
+    assert "Ошибка Google API" in capsys.readouterr().out
+
+    state["fail"] = False
+    assert len(search.search("python", num_results=3)) == 3
+    assert len(server.paths("/customsearch/v1")) == 2
+
+
+def test_search_requires_credentials(monkeypatch):
+    monkeypatch.delenv("GOOGLE_API_KEY", raising=False)
+    monkeypatch.delenv("GOOGLE_SEARCH_ENGINE_ID", raising=False)
+    search = GoogleAPISearch(api_key="", search_engine_id="", cache=ToolCache())
+    try:
+        with pytest.raises(ValueError):
+            search.search("python")
+    finally:
+        search.close()
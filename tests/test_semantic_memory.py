@@ -0,0 +1,150 @@
+import time
+
+import pytest
+
+from Scripts.ContextBuilder import ContextBuilder
+from Scripts.SemanticMemory import SemanticMemory
+from Scripts.main import ChatDatabase, ChatManager
+
+# Эмбеддинг - счетчики слов словаря, остальные слова - в последнем измерении
+VOCABULARY = ["кошка", "спит", "собака", "лает", "дома", "мяукает"]
+
+
+def embedding(text):
+    vector = [0.0] * (len(VOCABULARY) + 1)
+    for word in text.lower().split():
+        vector[VOCABULARY.index(word) if word in VOCABULARY else -1] += 1
+    return vector
+
+
+@pytest.fixture
+def embed_server(local_server):
+    state = {"fail": False}
+
+    def handler(method, path, query, body):
+        if state["fail"]:
+            return 500, "text/plain", "model not found"
+        return 200, "application/json", {"embeddings": [embedding(text) for text in body["input"]]}
+
+    server = local_server(handler)
+    server.state = state
+    return server
+
+
+@pytest.fixture
+def db(tmp_path):
+    db = ChatDatabase(str(tmp_path / "chat.db"))
+    yield db
+    db.close()
+
+
+@pytest.fixture
+def memory(db, embed_server):
+    memory = SemanticMemory(db, base_url=embed_server.url, batch_size=2, top_k=2)
+    yield memory
+    memory.shutdown()
+
+
+def wait_background(memory):
+    # Исполнитель памяти однопоточный: пустая задача завершится после уже поставленных
+    memory.executor.submit(lambda: None).result(timeout=10)
+
+
+def add_messages(db, chat_id, *texts):
+    return [db.add_message(chat_id, "user", text) for text in texts]
+
+
+def test_index_pending_embeds_in_batches(db, memory, embed_server):
+    chat_id = db.create_chat("chat")
+    add_messages(db, chat_id, "кошка спит", "собака лает", "кошка дома", "", "собака спит", "кошка мяукает")
+
+    counts = []
+    while True:
+        count = memory.index_pending(chat_id)
+        counts.append(count)
+        if not count:
+            break
+
+    # Пустые сообщения не индексируются
+    assert counts == [2, 2, 1, 0]
+    assert [len(body["input"]) for _, _, _, body in embed_server.paths("/api/embed")] == [2, 2, 1]
+    assert len(db.load_embeddings(chat_id, memory.model)) == 5
+
+
+def test_recall_ranks_by_similarity_before_cutoff(db, memory):
+    chat_id = db.create_chat("chat")
+    first, second, third, fourth = add_messages(db, chat_id, "кошка мяукает", "собака лает", "кошка спит",
+                                                "кошка спит дома")
+    while memory.index_pending(chat_id):
+        pass
+    question = db.add_message(chat_id, "user", "кошка спит дома")
+
+    hits = memory.recall(chat_id, question, "кошка спит дома", before_id=fourth)
+
+    # Непохожее сообщение отсекается min_score, сообщения из окна истории - before_id
+    assert [message_id for _, message_id in hits] == [third, first]
+    assert hits[0][0] > hits[1][0] >= memory.min_score
+    # Вектор вопроса сохранен и при индексации не запрашивается повторно
+    assert memory.index_pending(chat_id) == 0
+
+
+def test_rebuild_reindexes_chat(db, memory, embed_server):
+    chat_id = db.create_chat("chat")
+    add_messages(db, chat_id, "кошка спит", "собака лает", "кошка дома")
+    while memory.index_pending(chat_id):
+        pass
+    requests_before = len(embed_server.requests)
+
+    memory.rebuild(chat_id)
+    wait_background(memory)
+
+    assert len(db.load_embeddings(chat_id, memory.model)) == 3
+    assert len(embed_server.requests) == requests_before + 2
+
+
+def test_reindex_command_rebuilds_current_chat(db, memory, embed_server, capsys):
+    chat = ChatManager(db=db, context=ContextBuilder(db, memory=memory))
+    chat.start_new_chat("chat")
+    add_messages(db, chat.current_chat_id, "кошка спит", "собака лает")
+
+    chat.do_command("/reindex")
+    wait_background(memory)
+
+    assert "перестраивается" in capsys.readouterr().out
+    assert len(db.load_embeddings(chat.current_chat_id, memory.model)) == 2
+
+    chat.do_command(f"/reindex {chat.current_chat_id + 100}")
+    assert "не найден" in capsys.readouterr().out
+
+
+def test_server_error_backs_off_for_a_minute(db, memory, embed_server, capsys):
+    chat_id = db.create_chat("chat")
+    question = add_messages(db, chat_id, "кошка спит")[0]
+    embed_server.state["fail"] = True
+
+    assert memory.recall(chat_id, question, "кошка спит", before_id=question) == []
+    assert "Ошибка семантической памяти" in capsys.readouterr().out
+    assert 59 < memory.retry_at - time.monotonic() <= 60
+    requests_before = len(embed_server.requests)
+
+    # До конца паузы сервер не опрашивается ни при вспоминании, ни фоновой индексацией
+    assert memory.recall(chat_id, question, "кошка спит", before_id=question) == []
+    memory.schedule(chat_id)
+    wait_background(memory)
+    assert len(embed_server.requests) == requests_before
+
+    embed_server.state["fail"] = False
+    memory.retry_at -= 60
+    memory.schedule(chat_id)
+    wait_background(memory)
+    assert len(db.load_embeddings(chat_id, memory.model)) == 1
+
+
+def test_context_skips_recall_when_asked(db, memory, embed_server):
+    chat_id = db.create_chat("chat")
+    add_messages(db, chat_id, "кошка спит", "Попробуй собрать еще информацию")
+
+    messages = ContextBuilder(db, memory=memory).build(chat_id, recall=False)
+
+    assert [message["role"] for message in messages] == ["user", "user"]
+    assert embed_server.requests == []